@@ -0,0 +1,100 @@
+"""
+Compare listing an entry with get_list_of_empiar_files over one connection
+(a serial walk) against several concurrent connections, on a local
+pyftpdlib server that delays every command to stand in for the round-trip
+time to the EBI archive. Exits non-zero if the two listings differ or the
+concurrent walk is not faster.
+
+    python benchmarks/bench_concurrent_walk.py [latency_ms] [connections]
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from fs.ftpfs import FTPFS
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from empiar_cets.empiar_utils import get_list_of_empiar_files
+from empiar_cets.storage import EBI_DATA_ROOT
+
+
+ACCESSION_NO = "10000"
+
+
+def make_entry(root: str, n_tilt_series: int = 12, n_frames: int = 4) -> int:
+    # Tilt series directories with a frames subdirectory each, as in a
+    # typical cryo-ET entry
+    data_root = os.path.join(root, EBI_DATA_ROOT.format(accession_no=ACCESSION_NO).lstrip("/"))
+    n_files = 0
+    for i in range(n_tilt_series):
+        ts_dir = os.path.join(data_root, "tilt_series", f"TS_{i:03d}")
+        os.makedirs(os.path.join(ts_dir, "frames"))
+        for name in (f"TS_{i:03d}.mrc", f"TS_{i:03d}.mdoc"):
+            with open(os.path.join(ts_dir, name), "wb") as fh:
+                fh.write(b"\0" * (i + 1))
+        for j in range(n_frames):
+            with open(os.path.join(ts_dir, "frames", f"TS_{i:03d}_{j:03d}.eer"), "wb") as fh:
+                fh.write(b"\0" * j)
+        n_files += 2 + n_frames
+    return n_files
+
+
+def start_server(root: str, latency: float) -> tuple[ThreadedFTPServer, int]:
+    class DelayedHandler(FTPHandler):
+        def process_command(self, cmd, *args, **kwargs):
+            time.sleep(latency)
+            super().process_command(cmd, *args, **kwargs)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    DelayedHandler.authorizer = authorizer
+    server = ThreadedFTPServer(("127.0.0.1", 0), DelayedHandler)
+    threading.Thread(target=server.serve_forever, kwargs={"timeout": 0.1}, daemon=True).start()
+    return server, server.address[1]
+
+
+def measure(label: str, port: int, max_connections: int):
+    start = time.perf_counter()
+    file_list = get_list_of_empiar_files(
+        ACCESSION_NO,
+        max_connections=max_connections,
+        fs_factory=lambda: FTPFS("127.0.0.1", port=port),
+    )
+    elapsed = time.perf_counter() - start
+    print(f"{label:>24}: {len(file_list.files)} files in {elapsed:6.2f} s")
+    return file_list, elapsed
+
+
+def main(latency_ms: float = 20.0, connections: int = 8) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as root:
+        n_files = make_entry(root)
+        server, port = start_server(root, latency_ms / 1000)
+        try:
+            print(f"{n_files} files, {latency_ms:.0f} ms per FTP command")
+            serial_list, serial_time = measure("serial (1 connection)", port, 1)
+            concurrent_list, concurrent_time = measure(f"concurrent ({connections} connections)", port, connections)
+        finally:
+            server.close_all()
+
+    failed = False
+    if [(str(f.path), f.size_in_bytes) for f in serial_list.files] != [(str(f.path), f.size_in_bytes) for f in concurrent_list.files]:
+        print("FAIL: the serial and concurrent listings differ")
+        failed = True
+    if len(serial_list.files) != n_files:
+        print(f"FAIL: listed {len(serial_list.files)} files, expected {n_files}")
+        failed = True
+    print(f"speed-up: {serial_time / concurrent_time:.1f}x")
+    if concurrent_time >= serial_time:
+        print("FAIL: the concurrent walk is not faster than the serial one")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(*(float(arg) for arg in sys.argv[1:2]), *(int(arg) for arg in sys.argv[2:3]))
@@ -0,0 +1,61 @@
+"""
+Compare the memory taken per file by EMPIARFileList's compact file sequence
+against a plain list of EMPIARFile models (the previous representation).
+
+    python benchmarks/bench_file_list_memory.py [n_files]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from empiar_cets.empiar_utils import EMPIARFile, EMPIARFileList
+
+
+def make_paths(n_files: int) -> list[tuple[str, int]]:
+    # Frame-level layout typical of cryo-ET entries: a few directories with
+    # many similarly named movie files each
+    files_per_dir = 2000
+    return [
+        (f"Control/frames/TS_{i // files_per_dir:03d}/TS_{i // files_per_dir:03d}_{i % files_per_dir:05d}_-12.0.tif", 100_000_000 + i)
+        for i in range(n_files)
+    ]
+
+
+def measure(label: str, build, n_files: int) -> object:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:>28}: {current / n_files:8.1f} bytes/file, built in {elapsed:6.2f} s")
+    return result
+
+
+def main(n_files: int = 1_000_000) -> None:
+    paths = make_paths(n_files)
+    print(f"{n_files} files")
+
+    models = measure(
+        "list[EMPIARFile]",
+        lambda: [EMPIARFile(path=path, size_in_bytes=size) for path, size in paths],
+        n_files,
+    )
+    del models
+
+    file_dicts = [{"path": path, "size_in_bytes": size} for path, size in paths]
+    file_list = measure(
+        "EMPIARFileList (compact)",
+        lambda: EMPIARFileList.model_validate({"files": file_dicts}),
+        n_files,
+    )
+
+    start = time.perf_counter()
+    n_matches = sum(1 for path in file_list.iter_paths() if path.endswith("_00001_-12.0.tif"))
+    print(f"{'iterate paths':>28}: {time.perf_counter() - start:6.2f} s ({n_matches} matches)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
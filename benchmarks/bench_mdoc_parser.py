@@ -0,0 +1,116 @@
+"""
+Compare the throughput of the streaming mdoc parser (parse_mdoc_file) against
+the previous implementation, which read the whole file with readlines() and
+inferred the type of every value with exceptions. Both must give the same
+MdocFile.
+
+    python benchmarks/bench_mdoc_parser.py [n_sections] [frames_per_section]
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+
+from empiar_cets.metadata_models import MdocFile, ZValueSection
+from empiar_cets.metadata_parsing import parse_mdoc_file, parse_value
+
+
+def legacy_parse_mdoc_file(filepath: str) -> MdocFile:
+    mdoc = MdocFile(filename=str(filepath))
+
+    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+        lines = f.readlines()
+
+    current_section = None
+    in_global_headers = True
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('[T =') and line.endswith(']'):
+            mdoc.comments.append(line[4:-1].strip())
+            continue
+        z_value_match = re.match(r'\[ZValue\s*=\s*(\d+)\]', line)
+        if z_value_match:
+            current_section = ZValueSection(z_value=int(z_value_match.group(1)))
+            mdoc.z_sections.append(current_section)
+            in_global_headers = False
+            continue
+        if '=' in line and not line.startswith('['):
+            key, value = line.split('=', 1)
+            parsed_value = parse_value(value.strip())
+            if in_global_headers:
+                mdoc.global_headers[key.strip()] = parsed_value
+            elif current_section is not None:
+                current_section[key.strip()] = parsed_value
+
+    return mdoc
+
+
+def write_mdoc(filepath: str, n_sections: int, frames_per_section: int) -> None:
+    # SerialEM tilt series mdoc, with per-frame entries as written for
+    # frame-level metadata
+    with open(filepath, "w") as fh:
+        fh.write("PixelSpacing = 1.35\nImageFile = TS_01.mrc\nImageSize = 4096 4096\nDataMode = 1\n\n")
+        fh.write("[T = SerialEM: Digitized on EMBL Krios  30-Jun-23  14:02:13]\n\n")
+        for z in range(n_sections):
+            angle = -60.0 + 3.0 * (z % 41)
+            fh.write(
+                f"[ZValue = {z}]\n"
+                f"TiltAngle = {angle:.2f}\n"
+                f"StagePosition = 123.456 -78.9\n"
+                f"StageZ = -12.34\n"
+                f"Magnification = 42000\n"
+                f"Intensity = 0.123456\n"
+                f"ExposureDose = 3.5\n"
+                f"DoseRate = 7.8\n"
+                f"PixelSpacing = 1.35\n"
+                f"SpotSize = 9\n"
+                f"Defocus = -2.5\n"
+                f"ImageShift = 0.1 -0.2\n"
+                f"RotationAngle = 175.5\n"
+                f"ExposureTime = 1.2\n"
+                f"Binning = 1\n"
+                f"MagIndex = 31\n"
+                f"CountsPerElectron = 32\n"
+                f"TargetDefocus = -3\n"
+                f"SubFramePath = X:\\DATA\\TS_01\\TS_01_{z:03d}_{angle:.1f}.tif\n"
+                f"NumSubFrames = {frames_per_section}\n"
+                f"DateTime = 30-Jun-23  14:{z % 60:02d}:13\n"
+                f"FilterSlitAndLoss = 20 0\n"
+                f"UncroppedSize = -4096 -4096\n"
+                f"MinMaxMean = -10 1200 305.2\n"
+            )
+            for frame in range(frames_per_section):
+                fh.write(f"FrameDosesAndNumber{frame} = 0.2 1\n")
+            fh.write("\n")
+
+
+def measure(label: str, parse, filepath: str, n_sections: int, repeats: int = 3) -> MdocFile:
+    size_mb = os.path.getsize(filepath) / 1e6
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        mdoc = parse(filepath)
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:>10}: {size_mb / best:7.1f} MB/s, {n_sections / best:10.0f} sections/s ({best:.3f} s)")
+    return mdoc
+
+
+def main(n_sections: int = 20_000, frames_per_section: int = 10) -> None:
+    with tempfile.TemporaryDirectory() as dirpath:
+        filepath = os.path.join(dirpath, "bench.mdoc")
+        write_mdoc(filepath, n_sections, frames_per_section)
+        print(f"{n_sections} sections, {os.path.getsize(filepath) / 1e6:.1f} MB")
+
+        legacy = measure("legacy", legacy_parse_mdoc_file, filepath, n_sections)
+        streaming = measure("streaming", parse_mdoc_file, filepath, n_sections)
+
+        if streaming != legacy:
+            raise SystemExit("Parsers disagree")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,108 @@
+"""
+Check ftp_pool.read_range against local pyftpdlib servers: the stock
+handler, which answers both the cut-short RETR and the ABOR, and a handler
+that stays silent on an ABOR once the transfer has ended. Every read must
+return the right bytes, leave the control connection usable for the next
+command, and not wait out the abort-reply timeout. Exits non-zero otherwise.
+
+    python benchmarks/check_ftp_ranged_reads.py [reads]
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from fs.ftpfs import FTPFS
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+from empiar_cets.ftp_pool import ABORT_REPLY_TIMEOUT, read_range
+
+
+FILE_SIZE = 4 * 1024 * 1024
+
+
+class SilentAbortHandler(FTPHandler):
+    """Sends no reply to an ABOR that arrives after the transfer has ended"""
+
+    def ftp_ABOR(self, line):
+        if self.data_channel is None or not self.data_channel.transfer_in_progress():
+            if self.data_channel is not None:
+                self.data_channel.close()
+                self.data_channel = None
+            return
+        super().ftp_ABOR(line)
+
+
+def start_server(root: str, handler_class: type) -> tuple[FTPServer, int]:
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = type(handler_class.__name__, (handler_class,), {"authorizer": authorizer})
+    server = FTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={"timeout": 0.1}, daemon=True).start()
+    return server, server.address[1]
+
+
+def check_server(port: int, data: bytes, reads: int) -> list[str]:
+    failures = []
+    fs = FTPFS("127.0.0.1", port=port)
+    size = len(data)
+    cases = [
+        (0, 100),
+        (size // 2, 65536),
+        (size - 10, 100),  # runs past the end of the file
+        (size, 10),  # starts at the end of the file
+        (0, size),  # the whole file, so the RETR completes on its own
+    ]
+    cases += [((i * 7919) % size, 1 + (i * 104729) % 200000) for i in range(reads)]
+
+    start = time.perf_counter()
+    for offset, length in cases:
+        try:
+            got = read_range(fs, "/data.bin", offset, length)
+        except Exception as e:
+            failures.append(f"read_range({offset}, {length}) raised {e!r}")
+            break
+        if got != data[offset:offset + length]:
+            failures.append(f"read_range({offset}, {length}) returned {len(got)} wrong bytes")
+        try:
+            fs.ftp.voidcmd("NOOP")
+        except Exception as e:
+            failures.append(f"NOOP after read_range({offset}, {length}) raised {e!r}")
+            break
+    elapsed = time.perf_counter() - start
+
+    if not failures and fs.listdir("/") != ["data.bin"]:
+        failures.append("listing after the reads did not return the test file")
+    if elapsed > ABORT_REPLY_TIMEOUT:
+        failures.append(f"{len(cases)} reads took {elapsed:.1f} s, longer than the abort-reply timeout")
+    print(f"  {len(cases)} reads in {elapsed:.2f} s")
+    fs.close()
+    return failures
+
+
+def main(reads: int = 50) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    data = os.urandom(FILE_SIZE)
+    failed = False
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, "data.bin"), "wb") as fh:
+            fh.write(data)
+        for handler_class in (FTPHandler, SilentAbortHandler):
+            print(handler_class.__name__)
+            server, port = start_server(root, handler_class)
+            try:
+                failures = check_server(port, data, reads)
+            finally:
+                server.close_all()
+            for failure in failures:
+                print(f"  FAIL: {failure}")
+            failed = failed or bool(failures)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
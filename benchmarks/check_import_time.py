@@ -0,0 +1,71 @@
+"""
+Check that importing the CLI stays cheap: it must not pull in the CETS
+implementations, the network stacks or the generated EMPIAR models, and its
+cumulative import time (best of several fresh interpreters, as reported by
+python -X importtime) must stay within a budget. Exits non-zero otherwise.
+
+    python benchmarks/check_import_time.py [budget_ms] [runs]
+"""
+import subprocess
+import sys
+
+
+MODULE = "empiar_cets.cli"
+DEFAULT_BUDGET_MS = 150.0
+
+# Top-level packages that only the commands that need them may import
+DEFERRED_PACKAGES = (
+    "cryoet_metadata",
+    "fs",
+    "numpy",
+    "pydantic",
+    "requests",
+    "tomobabel",
+    "empiar_cets.models",
+    "empiar_cets.cets",
+    "empiar_cets.empiar_utils",
+    "empiar_cets.work_queue",
+)
+
+
+def import_times(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of each module imported by a fresh interpreter"""
+
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main(budget_ms: float = DEFAULT_BUDGET_MS, runs: int = 5) -> None:
+    best_us = None
+    for _ in range(runs):
+        times = import_times(MODULE)
+        best_us = times[MODULE] if best_us is None else min(best_us, times[MODULE])
+
+    deferred = sorted(
+        name for name in times
+        if any(name == package or name.startswith(f"{package}.") for package in DEFERRED_PACKAGES)
+    )
+    print(f"import {MODULE}: {best_us / 1000:.1f} ms (budget {budget_ms:.0f} ms)")
+
+    failures = []
+    if deferred:
+        failures.append(f"imports modules that should be deferred: {', '.join(deferred)}")
+    if best_us / 1000 > budget_ms:
+        failures.append(f"import time over budget: {best_us / 1000:.1f} ms > {budget_ms:.0f} ms")
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main(*(float(arg) for arg in sys.argv[1:2]), *(int(arg) for arg in sys.argv[2:3]))
@@ -0,0 +1,217 @@
+"""
+On-disk cache shared by everything that keeps fetched or parsed data around
+between runs: file lists, file headers, mdoc and xf files.
+
+Entries live under <root>/<accession>/cache/<kind>/ where the root is
+EMPIAR_CETS_CACHE_DIR (default local-data). Entries derived from a source
+file are named by a content key of the source path, its size in bytes and
+the version of the parser that produced them, so a changed file or parser
+misses the cache instead of reading stale data. Writes are atomic.
+
+A file's modification time records when it was last used, so that with a
+size budget (EMPIAR_CETS_CACHE_MAX_BYTES) the least recently used entries
+can be evicted first.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union
+
+
+logger = logging.getLogger("empiar_cets.cache")
+
+
+CACHE_ROOT_ENV_VAR = "EMPIAR_CETS_CACHE_DIR"
+CACHE_MAX_BYTES_ENV_VAR = "EMPIAR_CETS_CACHE_MAX_BYTES"
+DEFAULT_CACHE_ROOT = "local-data"
+
+_SIZE_UNITS = {"": 1, "K": 1000, "M": 1000**2, "G": 1000**3, "T": 1000**4}
+
+
+def get_cache_root() -> Path:
+    return Path(os.environ.get(CACHE_ROOT_ENV_VAR) or DEFAULT_CACHE_ROOT)
+
+
+def set_cache_root(root: Union[str, Path]) -> None:
+    """Set the cache root, for this process and any it starts"""
+    os.environ[CACHE_ROOT_ENV_VAR] = str(root)
+
+
+def parse_size(size: Union[str, int]) -> int:
+    """Bytes in a size such as 500M or 20G (decimal units)"""
+    if isinstance(size, int):
+        return size
+    size_match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", size.upper())
+    if size_match is None:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(size_match.group(1)) * _SIZE_UNITS[size_match.group(2)])
+
+
+def get_cache_budget() -> Optional[int]:
+    max_bytes = os.environ.get(CACHE_MAX_BYTES_ENV_VAR)
+    return parse_size(max_bytes) if max_bytes else None
+
+
+def set_cache_budget(max_bytes: Union[str, int, None]) -> None:
+    if max_bytes is None:
+        os.environ.pop(CACHE_MAX_BYTES_ENV_VAR, None)
+    else:
+        os.environ[CACHE_MAX_BYTES_ENV_VAR] = str(parse_size(max_bytes))
+
+
+def content_key(source_path: str, size_in_bytes: Optional[int], parser_version: int) -> str:
+    """Short key identifying what a cache entry was derived from"""
+    key_source = f"{source_path}\0{size_in_bytes}\0{parser_version}"
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_dir(accession_id: str, kind: Optional[str] = None) -> Path:
+    dirpath = get_cache_root() / accession_id / "cache"
+    if kind is not None:
+        dirpath = dirpath / kind
+    dirpath.mkdir(parents=True, exist_ok=True)
+    return dirpath
+
+
+def cache_path(accession_id: str, kind: Optional[str], name: str) -> Path:
+    return cache_dir(accession_id, kind) / name
+
+
+def mark_used(path: Path) -> None:
+    """Record a cache hit, for least recently used eviction"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _temp_path(path: Path) -> Path:
+    # Unique per writer, as the cache (or a work queue) may be shared by
+    # several machines, so that readers on any of them never see a partial file
+    return path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+@contextmanager
+def atomic_write_path(path: Union[str, Path]) -> Iterator[Path]:
+    """
+    A temporary path to write an entry to, which replaces path once the
+    with block completes (and is removed if it raises)
+    """
+    path = Path(path)
+    temp_path = _temp_path(path)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def write_bytes_atomic(path: Union[str, Path], data: bytes) -> None:
+    with atomic_write_path(path) as temp_path:
+        temp_path.write_bytes(data)
+
+
+def write_json_atomic(path: Union[str, Path], data: Any, indent: Optional[int] = None) -> None:
+    with atomic_write_path(path) as temp_path:
+        with open(temp_path, "w") as fh:
+            json.dump(data, fh, indent=indent)
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    path: Path
+    accession_id: str
+    kind: str
+    size_in_bytes: int
+    last_used: float
+
+
+def iter_cache_entries(accession_id: Optional[str] = None) -> Iterator[CacheEntry]:
+    root = get_cache_root()
+    if not root.is_dir():
+        return
+    accession_dirpaths = [root / accession_id] if accession_id else sorted(root.iterdir())
+    for accession_dirpath in accession_dirpaths:
+        cache_dirpath = accession_dirpath / "cache"
+        if not cache_dirpath.is_dir():
+            continue
+        for dirpath, _, filenames in os.walk(cache_dirpath):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = Path(dirpath) / filename
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                relative_dirpath = Path(dirpath).relative_to(cache_dirpath)
+                yield CacheEntry(
+                    path=path,
+                    accession_id=accession_dirpath.name,
+                    kind=relative_dirpath.parts[0] if relative_dirpath.parts else "",
+                    size_in_bytes=stat.st_size,
+                    last_used=stat.st_mtime,
+                )
+
+
+def cache_stats(accession_id: Optional[str] = None) -> dict[tuple[str, str], dict[str, float]]:
+    """Number of files, bytes and last use of the cache, per accession and kind"""
+
+    stats: dict[tuple[str, str], dict[str, float]] = {}
+    for entry in iter_cache_entries(accession_id):
+        entry_stats = stats.setdefault(
+            (entry.accession_id, entry.kind), {"files": 0, "bytes": 0, "last_used": 0.0}
+        )
+        entry_stats["files"] += 1
+        entry_stats["bytes"] += entry.size_in_bytes
+        entry_stats["last_used"] = max(entry_stats["last_used"], entry.last_used)
+
+    return dict(sorted(stats.items()))
+
+
+def prune_cache(
+        max_bytes: Optional[int] = None,
+        older_than: Optional[float] = None,
+        accession_id: Optional[str] = None,
+        dry_run: bool = False,
+) -> list[CacheEntry]:
+    """
+    Evict entries unused for older_than seconds, then the least recently
+    used until the cache takes at most max_bytes. Returns what was evicted.
+    """
+
+    entries = sorted(iter_cache_entries(accession_id), key=lambda entry: entry.last_used)
+    total_bytes = sum(entry.size_in_bytes for entry in entries)
+    now = time.time()
+
+    evicted = []
+    for entry in entries:
+        stale = older_than is not None and now - entry.last_used > older_than
+        over_budget = max_bytes is not None and total_bytes > max_bytes
+        if not (stale or over_budget):
+            continue
+        if not dry_run:
+            entry.path.unlink(missing_ok=True)
+        evicted.append(entry)
+        total_bytes -= entry.size_in_bytes
+
+    if evicted:
+        logger.info(f"Evicted {len(evicted)} cache entries ({sum(e.size_in_bytes for e in evicted)} bytes)")
+
+    return evicted
+
+
+def enforce_cache_budget() -> list[CacheEntry]:
+    """Prune the cache down to its configured size budget, if there is one"""
+    max_bytes = get_cache_budget()
+    if max_bytes is None:
+        return []
+    return prune_cache(max_bytes=max_bytes)
@@ -1,31 +1,40 @@
+from empiar_cets.metadata_models import XFAlignment
 
 
 def create_cets_czii_alignment_from_region_directive(
-        alignment_metadata: dict,
+        alignment_metadata: XFAlignment,
+        compose: bool = False,
 ) -> list[dict]:
+    """
+    CETS alignment of a region, with each projection's transform either as
+    an affine followed by a translation or, with compose, as a single affine
+    """
     
     # TODO: should Alignment class have a path field?
 
-    alignments = []
-    for i, alignment in enumerate(alignment_metadata["projection_alignments"]):
-        cets_projection_alignment_sequence = []
-        for transform in alignment["sequence"]:
-            if transform["type"] == "translation":
-                cets_projection_alignment_sequence.append({
-                    "translation": transform["translation"],
-                    "name": transform["name"],
-                })
-            elif transform["type"] == "affine":
-                cets_projection_alignment_sequence.append({
-                    "affine": transform["affine"],
-                    "name": transform["name"],
-                })
-        cets_projection_alignment_dict = {
-            "sequence": cets_projection_alignment_sequence,
-        }
-        alignments.append(cets_projection_alignment_dict)
+    projection_indices = alignment_metadata.projection_indices.tolist()
+    if compose:
+        alignments = [
+            {"sequence": [{"affine": matrix, "name": f"alignment_projection_{i}"}]}
+            for i, matrix in zip(projection_indices, alignment_metadata.composed_matrices().tolist())
+        ]
+    else:
+        alignments = [
+            {
+                "sequence": [
+                    {
+                        "affine": [[a11, a12, 0.0], [a21, a22, 0.0], [0.0, 0.0, 1.0]],
+                        "name": f"rotation_projection_{i}",
+                    },
+                    {
+                        "translation": [dx, dy],
+                        "name": f"translation_projection_{i}",
+                    },
+                ],
+            }
+            for i, (a11, a12, a21, a22, dx, dy) in zip(projection_indices, alignment_metadata.transforms.tolist())
+        ]
     
     cets_alignments = {"projection_alignments": alignments}
     
     return [cets_alignments]
-    
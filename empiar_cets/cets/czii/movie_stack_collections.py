@@ -1,9 +1,14 @@
+import re
 import rich
 from pathlib import Path
+from typing import Optional
+
+import numpy as np
 
 from empiar_cets.yaml_parsing import RegionDirective, MovieStack
 from empiar_cets.empiar_utils import EMPIARFileList, get_files_matching_pattern
-from empiar_cets.metadata_models import MdocFile
+from empiar_cets.metadata_models import MdocFile, ZValueSection
+from empiar_cets.movie_header import MOVIE_FILE_EXTENSIONS, get_movie_header_cached
 
 
 def create_cets_czii_movie_stack_collection_from_region_directive(
@@ -30,6 +35,10 @@ def create_cets_czii_movie_stacks_from_region_directive(
         movie_metadata: MdocFile = None,
 ) -> list[dict]:
     
+    metadata_sections = {}
+    if movie_metadata:
+        metadata_sections = match_movie_stacks_to_mdoc_sections(region.movie_stacks, movie_metadata)
+
     cets_movie_stacks = []
     for movie_stack in region.movie_stacks:
         
@@ -49,24 +58,92 @@ def create_cets_czii_movie_stacks_from_region_directive(
         if movie_metadata:
             cets_movie_frames = create_cets_czii_movie_frames_for_volume_movie(
                 movie_stack, 
-                movie_metadata
+                movie_metadata,
+                metadata_sections.get(movie_stack.label),
             )
             cets_movie_stack_dict["images"] = cets_movie_frames
+        elif movie_stack_paths[0].lower().endswith(MOVIE_FILE_EXTENSIONS):
+            movie_header = get_movie_header_cached(accession_id, empiar_files, movie_stack_paths[0])
+            if movie_header is None:
+                rich.print(f"[yellow]No frames for {movie_stack_paths[0]}: its header could not be parsed[/yellow]")
+            else:
+                cets_movie_frames = create_cets_czii_movie_frames_from_movie_header(movie_header)
+                cets_movie_stack_dict["images"] = cets_movie_frames
 
         cets_movie_stacks.append(cets_movie_stack_dict)
     
     return cets_movie_stacks
 
 
+# Tilt angle at the end of a movie's file name, e.g. "TS_006_00002_-2.0.tif".
+# It must have a decimal point, as a trailing integer is as likely to be a
+# tilt or position index ("TS_01_003.tif", "Position_1_2.eer")
+_FILE_NAME_TILT_ANGLE = re.compile(r"_([-+]?\d+\.(\d+))(?:\.[^._]+)+$")
+
+
+def _tilt_angle_from_file_pattern(file_pattern: str) -> Optional[tuple[float, float]]:
+    """Tilt angle captured from a file pattern, with the tolerance its precision allows"""
+    angle_match = _FILE_NAME_TILT_ANGLE.search(Path(file_pattern).name)
+    if angle_match is None:
+        return None
+    decimals = len(angle_match.group(2))
+    return float(angle_match.group(1)), 0.5 * 10 ** -decimals
+
+
+def match_movie_stacks_to_mdoc_sections(
+        movie_stacks: list[MovieStack],
+        movie_metadata: MdocFile,
+) -> dict[str, ZValueSection]:
+    """
+    The mdoc section of each movie stack, keyed by label.
+
+    Stacks are joined on the file name of the section's SubFramePath; a
+    stack whose file name is not found falls back to the one section whose
+    TiltAngle matches a decimal angle at the end of its file name (such as
+    "_-2.0.tif"). Stacks matched by neither are left out.
+    """
+    
+    sections = {}
+    tilt_angles = None
+    for movie_stack in movie_stacks:
+        name_matches = movie_metadata.get_sections_by_subframe_name(Path(movie_stack.file_pattern).name)
+        if name_matches:
+            if len(name_matches) > 1:
+                rich.print(
+                    f"[yellow]{Path(movie_stack.file_pattern).name} is the SubFramePath of "
+                    f"{len(name_matches)} mdoc sections; using the first (ZValue {name_matches[0].z_value})[/yellow]"
+                )
+            sections[movie_stack.label] = name_matches[0]
+            continue
+
+        captured = _tilt_angle_from_file_pattern(movie_stack.file_pattern)
+        if captured is None:
+            continue
+        if tilt_angles is None:
+            tilt_angles = movie_metadata.numeric_column("TiltAngle")
+        angle, tolerance = captured
+        angle_matches = np.flatnonzero(np.abs(tilt_angles - angle) <= tolerance)
+        if len(angle_matches) == 1:
+            sections[movie_stack.label] = movie_metadata.z_sections[angle_matches[0]]
+        elif len(angle_matches) > 1:
+            rich.print(
+                f"[yellow]Tilt angle {angle} of {movie_stack.file_pattern} matches "
+                f"{len(angle_matches)} mdoc sections[/yellow]"
+            )
+
+    return sections
+
+
 def create_cets_czii_movie_frames_for_volume_movie(
         movie_stack: MovieStack,
         movie_metadata: MdocFile,
+        metadata_section: Optional[ZValueSection] = None,
 ) -> list[dict]:
     
-    file_name_pattern = Path(movie_stack.file_pattern).name
-    metadata_section = movie_metadata.search_by_subframe_path(file_name_pattern)[0] 
+    if metadata_section is None:
+        metadata_section = match_movie_stacks_to_mdoc_sections([movie_stack], movie_metadata).get(movie_stack.label)
     if not metadata_section:
-        raise ValueError(f"No metadata section found for file pattern: {file_name_pattern}")
+        raise ValueError(f"No metadata section found for file pattern: {movie_stack.file_pattern}")
 
     # TODO: accumlated dose?
     # TODO: proper file paths for each frame
@@ -81,4 +158,21 @@ def create_cets_czii_movie_frames_for_volume_movie(
         }
         cets_movie_frames.append(cets_movie_frame_dict)
     
-    return cets_movie_frames
\ No newline at end of file
+    return cets_movie_frames
+
+
+def create_cets_czii_movie_frames_from_movie_header(
+        movie_header: dict,
+) -> list[dict]:
+    
+    # Without mdoc metadata, only the frame count and dimensions are known
+    cets_movie_frames = []
+    for f in range(movie_header["frames"]):
+        cets_movie_frame_dict = {
+            "section": str(f),
+            "width": movie_header["width"],
+            "height": movie_header["height"],
+        }
+        cets_movie_frames.append(cets_movie_frame_dict)
+    
+    return cets_movie_frames
@@ -1,28 +1,51 @@
+from typing import Optional
+
 from empiar_cets.yaml_parsing import RegionDirective
-from empiar_cets.empiar_utils import EMPIARFileList
+from empiar_cets.empiar_utils import EMPIARFileList, get_files_matching_region_directive
 
 from empiar_cets.cets.czii.movie_stack_collections import create_cets_czii_movie_stack_collection_from_region_directive
 from empiar_cets.cets.czii.tilt_series import create_cets_czii_tilt_series_from_region_directive
 from empiar_cets.cets.czii.alignment import create_cets_czii_alignment_from_region_directive
 from empiar_cets.cets.czii.tomogram import create_cets_czii_tomograms_from_region_directive
 from empiar_cets.metadata_parsing import load_mdoc_with_cache, load_xf_with_cache
+from empiar_cets.movie_header import get_movie_paths_for_region, probe_movie_headers
+
+def _size_in_bytes(empiar_files: EMPIARFileList, path: str) -> Optional[int]:
+    file = empiar_files.get(path)
+    return None if file is None else file.size_in_bytes
+
 
 def create_cets_czii_region_from_region_directive(
         accession_id: str,
         region: RegionDirective, 
         empiar_files: EMPIARFileList,
+        compose_alignments: bool = False,
 ) -> dict:
     
     cets_region = {}
 
+    # Match all of the region's file patterns in one pass; the builders below
+    # then get their results from the file list's memoised matcher.
+    get_files_matching_region_directive(empiar_files, region)
+
     movie_metadata = None
     if region.movie_metadata:
         movie_metadata = load_mdoc_with_cache(
             accession_id, 
             region.movie_metadata.file_pattern, 
-            region.movie_metadata.label
+            region.movie_metadata.label,
+            _size_in_bytes(empiar_files, region.movie_metadata.file_pattern),
         )
     
+    if region.movie_stacks and movie_metadata is None:
+        # Frame information has to come from the movies themselves; read
+        # their headers concurrently before building the movie stacks
+        probe_movie_headers(
+            accession_id, 
+            empiar_files, 
+            get_movie_paths_for_region(empiar_files, region)
+        )
+
     if region.movie_stacks:
         cets_movie_stack_collection = create_cets_czii_movie_stack_collection_from_region_directive(
             accession_id, 
@@ -32,11 +55,13 @@ def create_cets_czii_region_from_region_directive(
         )
         cets_region["movie_stack_collections"] = cets_movie_stack_collection
     
+    tilt_series_metadata = None
     if region.tilt_series_metadata:
         tilt_series_metadata = load_mdoc_with_cache(
             accession_id, 
             region.tilt_series_metadata.file_pattern, 
-            region.tilt_series_metadata.label
+            region.tilt_series_metadata.label,
+            _size_in_bytes(empiar_files, region.tilt_series_metadata.file_pattern),
         )
 
     if region.tilt_series:
@@ -51,9 +76,13 @@ def create_cets_czii_region_from_region_directive(
         alignment_metadata = load_xf_with_cache(
             accession_id, 
             region.alignments.file_pattern, 
-            region.alignments.label
+            region.alignments.label,
+            _size_in_bytes(empiar_files, region.alignments.file_pattern),
+        )
+        cets_alignments = create_cets_czii_alignment_from_region_directive(
+            alignment_metadata, 
+            compose=compose_alignments
         )
-        cets_alignments = create_cets_czii_alignment_from_region_directive(alignment_metadata)
         cets_region["alignments"] = cets_alignments
     
     if region.tomograms:
@@ -1,5 +1,8 @@
+import rich
+
 from empiar_cets.yaml_parsing import RegionDirective
 from empiar_cets.empiar_utils import EMPIARFileList, get_files_matching_pattern
+from empiar_cets.header_probe import MRC_FILE_EXTENSIONS, get_mrc_header_cached
 from empiar_cets.metadata_models import MdocFile
 
 
@@ -30,6 +33,15 @@ def create_cets_czii_tilt_series_from_region_directive(
         if tilt_series_metadata:
             cets_projection_images = create_cets_czii_projection_images_for_tilt_series(tilt_series_metadata)
             cets_tilt_series_dict["images"] = cets_projection_images
+        elif tilt_series_paths[0].lower().endswith(MRC_FILE_EXTENSIONS):
+            mrc_header_info = get_mrc_header_cached(accession_id, empiar_files, tilt_series_paths[0])
+            # TODO: pixel spacing (mrc_header_info["pixel_size"], in Angstrom) and
+            # origin, once the czii models' coordinate transformations are built
+            if mrc_header_info is None:
+                rich.print(f"[yellow]No images for {tilt_series_paths[0]}: its MRC header could not be read[/yellow]")
+            else:
+                cets_projection_images = create_cets_czii_projection_images_from_mrc_header(mrc_header_info)
+                cets_tilt_series_dict["images"] = cets_projection_images
         
         cets_tilt_series.append(cets_tilt_series_dict)
 
@@ -53,3 +65,20 @@ def create_cets_czii_projection_images_for_tilt_series(
     
     return cets_projection_images
 
+
+def create_cets_czii_projection_images_from_mrc_header(
+        mrc_header_info: dict,
+) -> list[dict]:
+    
+    # Without mdoc metadata, only the section count and dimensions are known
+    image_width, image_height, n_sections = mrc_header_info["dimensions"]
+    cets_projection_images = []
+    for z in range(n_sections):
+        cets_projection_image_dict = {
+            "section": str(z),
+            "width": image_width,
+            "height": image_height,
+        }
+        cets_projection_images.append(cets_projection_image_dict)
+    
+    return cets_projection_images
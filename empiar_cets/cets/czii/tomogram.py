@@ -1,7 +1,8 @@
 import rich
 
 from empiar_cets.yaml_parsing import RegionDirective
-from empiar_cets.empiar_utils import EMPIARFileList, get_files_matching_pattern, read_mrc_header_pyfs
+from empiar_cets.empiar_utils import EMPIARFileList, get_files_matching_pattern
+from empiar_cets.header_probe import get_mrc_header_cached
 
 
 def create_cets_czii_tomograms_from_region_directive(
@@ -25,13 +26,16 @@ def create_cets_czii_tomograms_from_region_directive(
         if len(tomogram_paths) == 1:
             cets_tomogram_dict["path"] = f"https://ftp.ebi.ac.uk/empiar/world_availability/{accession_no}/data/{tomogram_paths[0]}"
         
-        # Read MRC header information
-        file_path = f"/empiar/world_availability/{accession_no}/data/{tomogram_paths[0]}"
-        mrc_header_info = read_mrc_header_pyfs(file_path)
-
-        cets_tomogram_dict["width"] = mrc_header_info["dimensions"][0]
-        cets_tomogram_dict["height"] = mrc_header_info["dimensions"][1]
-        cets_tomogram_dict["depth"] = mrc_header_info["dimensions"][2]
+        # Read MRC header information (from the header cache if already probed)
+        mrc_header_info = get_mrc_header_cached(accession_id, empiar_files, tomogram_paths[0])
+        if mrc_header_info is None:
+            rich.print(f"[yellow]No dimensions for {tomogram_paths[0]}: its MRC header could not be read[/yellow]")
+        else:
+            cets_tomogram_dict["width"] = mrc_header_info["dimensions"][0]
+            cets_tomogram_dict["height"] = mrc_header_info["dimensions"][1]
+            cets_tomogram_dict["depth"] = mrc_header_info["dimensions"][2]
+        # TODO: voxel spacing (mrc_header_info["pixel_size"], in Angstrom) and
+        # origin, once the czii models' coordinate transformations are built
 
         cets_tomograms.append(cets_tomogram_dict)
 
@@ -4,6 +4,7 @@ from empiar_cets.yaml_parsing import (
 from empiar_cets.empiar_utils import (
     EMPIARFileList, 
     get_files_matching_pattern, 
+    get_files_matching_region_directive,
 )
 
 def  create_cets_tomobabel_movie_stack_set_from_region(
@@ -13,6 +14,8 @@ def  create_cets_tomobabel_movie_stack_set_from_region(
     
     cets_movie_stack_set_dict = {}
 
+    get_files_matching_region_directive(empiar_files, region)
+
     cets_movie_stacks = []
     for movie_stack in region.movie_stacks:
         # each movie stack dict correspond to a CETS MovieStack
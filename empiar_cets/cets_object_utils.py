@@ -1,11 +1,64 @@
 import rich
+import gzip
 import json
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any, Optional, Type
+from typing import Any, Iterable, Iterator, Optional, TextIO, Type, Union, get_args, get_origin
 from pydantic import BaseModel, ValidationError
 from pydantic.alias_generators import to_snake
 
 
+class CETSValidationError(ValueError):
+    """A CETS model failed validation; the message says where, not what the whole input was"""
+
+
+def format_validation_error(
+        error: ValidationError,
+        label: str,
+        max_errors: int = 10,
+) -> str:
+    """One line per error, with the path into the offending object, e.g. tilt_series[3].images[2].tilt_angle"""
+
+    lines = [f"Invalid CETS {label}: {error.error_count()} validation error(s)"]
+    for error_details in error.errors()[:max_errors]:
+        location = ""
+        for part in error_details["loc"]:
+            location += f"[{part}]" if isinstance(part, int) else f".{part}"
+        lines.append(f"  {location.lstrip('.') or '<root>'}: {error_details['msg']}")
+    if error.error_count() > max_errors:
+        lines.append(f"  ... and {error.error_count() - max_errors} more")
+
+    return "\n".join(lines)
+
+
+def validate_cets_model(
+        data: dict[str, Any],
+        cets_model_class: Type[BaseModel],
+        label: Optional[str] = None,
+) -> BaseModel:
+    """Validate data into a CETS model, raising a CETSValidationError if it is invalid"""
+
+    try:
+        return cets_model_class.model_validate(data)
+    except ValidationError as e:
+        raise CETSValidationError(format_validation_error(e, label or cets_model_class.__name__)) from None
+
+
+def trusted_cets_model(
+        data: dict[str, Any],
+        cets_model_class: Type[BaseModel],
+) -> BaseModel:
+    """
+    A CETS model built without validation, for data that was dumped from an
+    already validated model. Nested objects stay as dicts, which serialise
+    as they were dumped.
+    """
+    return cets_model_class.model_construct(**data)
+
+
 def dict_to_cets_model(
     dict: dict[str, Any],
     cets_model_class: Type[BaseModel],
@@ -13,11 +66,9 @@ def dict_to_cets_model(
     
     cets_model = None
     try:
-        cets_model = cets_model_class.model_validate(dict)
-    except ValidationError as e:
-        rich.print(
-            f"[red]Validation error for {cets_model_class.__name__} with data: {dict}. Error: {e}[/red]"
-        )
+        cets_model = validate_cets_model(dict, cets_model_class)
+    except CETSValidationError as e:
+        rich.print(f"[red]{e}[/red]")
     
     return cets_model
 
@@ -28,24 +79,253 @@ def get_model_type_dir(cache_dirpath, model: Type[BaseModel]) -> Path:
     return cache_dirpath / model_type
 
 
+def get_cets_model_json_path(
+        accession_id: str,
+        region_title: str,
+        model_class: Type[BaseModel],
+        compress: bool = False,
+        shard: bool = False,
+) -> Path:
+    """Where save_cets_model_to_json (or CETSDatasetWriter) writes a model of this class"""
+    
+    cache_dirpath = Path(f"local-data/{accession_id}")
+    model_dir = get_model_type_dir(cache_dirpath, model_class)
+    if shard:
+        return model_dir / region_title / "index.json"
+    return model_dir / (f"{region_title}.json.gz" if compress else f"{region_title}.json")
+
+
+def _open_for_writing(path: Path, compress: bool) -> TextIO:
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+    return open(path, "w", encoding="utf-8")
+
+
 def save_cets_model_to_json(
         accession_id: str,
         region_title: str, 
         cets_model: BaseModel,
-) -> None:
+        compact: bool = False,
+        compress: bool = False,
+) -> Path:
     
     if not isinstance(cets_model, BaseModel):
         raise TypeError("Object must be a Pydantic model")
     
-    cache_dirpath = Path(f"local-data/{accession_id}")
-    cache_dirpath.mkdir(exist_ok=True, parents=True)
-
-    model_dir = get_model_type_dir(cache_dirpath, cets_model.__class__)
-    model_dir.mkdir(parents=True, exist_ok=True)
-    
-    model_path = model_dir / f"{region_title}.json"
+    model_path = get_cets_model_json_path(accession_id, region_title, cets_model.__class__, compress)
+    model_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(model_path, 'w') as f:
-        json.dump(cets_model.model_dump(), f, indent=2)
+    temp_path = model_path.with_name(f".{model_path.name}.tmp")
+    with _open_for_writing(temp_path, compress) as f:
+        f.write(cets_model.model_dump_json(indent=None if compact else 2))
+    os.replace(temp_path, model_path)
     rich.print(f"[green]Saved CETS model to {model_path}[/green]")
 
+    return model_path
+
+
+def list_item_model_class(model_class: Type[BaseModel], field_name: str) -> Type[BaseModel]:
+    """The model class of the items of a list field, e.g. a Dataset's regions"""
+
+    annotation = model_class.model_fields[field_name].annotation
+    # Unwrap Optional[List[...]] down to the item type
+    while get_origin(annotation) is not None:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        annotation = args[0]
+    return annotation
+
+
+class CETSDatasetWriter:
+    """
+    Write a CETS Dataset region by region, so that the whole dataset never
+    has to be held as dicts or dumped in one go.
+
+    The dataset's other fields come from a shell model with no regions.
+    Regions are validated models, serialised with model_dump_json as they
+    are written. With shard, each region goes to its own file next to an
+    index.json holding the shell's fields and the shard paths, so one region
+    can be loaded without parsing the others.
+    """
+
+    def __init__(
+            self,
+            accession_id: str,
+            dataset_shell: BaseModel,
+            compact: bool = False,
+            compress: bool = False,
+            shard: bool = False,
+    ):
+        self.accession_id = accession_id
+        self.dataset_shell = dataset_shell
+        self.indent = None if compact else 2
+        self.compress = compress
+        self.shard = shard
+        self.output_path = get_cets_model_json_path(
+            accession_id, accession_id, dataset_shell.__class__, compress, shard
+        )
+        self._n_regions = 0
+        self._shards: list[dict] = []
+        self._fh: Optional[TextIO] = None
+        self._temp_path: Optional[Path] = None
+
+    def _shell_json(self) -> str:
+        return self.dataset_shell.model_dump_json(indent=self.indent, exclude={"regions"})
+
+    def __enter__(self) -> 'CETSDatasetWriter':
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.shard:
+            self._temp_path = self.output_path.with_name(f".{self.output_path.name}.tmp")
+            self._fh = _open_for_writing(self._temp_path, self.compress)
+            # The shell's fields, then the opening of the regions list
+            shell_json = self._shell_json().rstrip()[:-1].rstrip()
+            separator = "," if shell_json != "{" else ""
+            if self.indent is None:
+                self._fh.write(f'{shell_json}{separator}"regions":[')
+            else:
+                self._fh.write(f'{shell_json}{separator}\n  "regions": [')
+        return self
+
+    def write_region(self, region: Union[BaseModel, str], title: Optional[str] = None) -> None:
+        """Write a region model, or a region already serialised with this writer's indent"""
+        if isinstance(region, str):
+            region_json = region
+        else:
+            # Trusted regions hold their nested objects as dicts, which
+            # serialise correctly but would warn about their type
+            region_json = region.model_dump_json(indent=self.indent, warnings=False)
+
+        if self.shard:
+            shard_name = f"region_{self._n_regions:05d}.json" + (".gz" if self.compress else "")
+            shard_path = self.output_path.parent / shard_name
+            temp_path = shard_path.with_name(f".{shard_name}.tmp")
+            with _open_for_writing(temp_path, self.compress) as fh:
+                fh.write(region_json)
+            os.replace(temp_path, shard_path)
+            self._shards.append({"index": self._n_regions, "title": title, "path": shard_name})
+        else:
+            if self.indent is None:
+                self._fh.write(("," if self._n_regions else "") + region_json)
+            else:
+                # Nest the region's lines two levels deep; JSON strings never
+                # contain raw newlines, so this only touches layout
+                region_json = region_json.replace("\n", "\n    ")
+                self._fh.write(("," if self._n_regions else "") + "\n    " + region_json)
+
+        self._n_regions += 1
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self.shard:
+            if exc_type is None:
+                index = json.loads(self._shell_json())
+                index["regions"] = self._shards
+                temp_path = self.output_path.with_name(f".{self.output_path.name}.tmp")
+                with open(temp_path, "w", encoding="utf-8") as fh:
+                    json.dump(index, fh, indent=self.indent)
+                os.replace(temp_path, self.output_path)
+                rich.print(f"[green]Saved CETS model index to {self.output_path}[/green]")
+            return
+
+        if exc_type is None:
+            if self.indent is None:
+                self._fh.write("]}")
+            else:
+                self._fh.write(("\n  " if self._n_regions else "") + "]\n}")
+        self._fh.close()
+        if exc_type is None:
+            os.replace(self._temp_path, self.output_path)
+            rich.print(f"[green]Saved CETS model to {self.output_path}[/green]")
+        else:
+            self._temp_path.unlink(missing_ok=True)
+
+
+def _validate_region_json(
+        region_dict: dict,
+        region_model_class: Type[BaseModel],
+        label: str,
+        indent: Optional[int],
+) -> str:
+    # Run in a validation process: only the serialised region is sent back
+    return validate_cets_model(region_dict, region_model_class, label).model_dump_json(indent=indent)
+
+
+def _iter_validated_regions(
+        regions: Iterable[tuple[str, Union[dict, BaseModel]]],
+        region_model_class: Type[BaseModel],
+        indent: Optional[int],
+        validation_processes: int,
+) -> Iterator[tuple[str, Union[BaseModel, str]]]:
+    """
+    Validate region dicts as they arrive, in order. Models are taken as
+    already validated. With validation_processes, dicts are validated and
+    serialised in that many worker processes, a bounded number ahead of the
+    region being written.
+    """
+
+    def label(title: str) -> str:
+        return f"{region_model_class.__name__} {title}"
+
+    if validation_processes <= 0:
+        for title, region in regions:
+            if not isinstance(region, BaseModel):
+                region = validate_cets_model(region, region_model_class, label(title))
+            yield title, region
+        return
+
+    # Spawned rather than forked, as the regions are usually produced by
+    # threads that hold locks (FTP and HTTP connection pools, logging)
+    with ProcessPoolExecutor(
+        max_workers=validation_processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        in_flight = deque()
+        for title, region in regions:
+            if not isinstance(region, BaseModel):
+                region = executor.submit(_validate_region_json, region, region_model_class, label(title), indent)
+            in_flight.append((title, region))
+            while len(in_flight) > 2 * validation_processes:
+                title, region = in_flight.popleft()
+                yield title, region if isinstance(region, BaseModel) else region.result()
+        while in_flight:
+            title, region = in_flight.popleft()
+            yield title, region if isinstance(region, BaseModel) else region.result()
+
+
+def write_cets_dataset(
+        accession_id: str,
+        dataset_model_class: Type[BaseModel],
+        regions: Iterable[tuple[str, Union[dict, BaseModel]]],
+        compact: bool = False,
+        compress: bool = False,
+        shard: bool = False,
+        validation_processes: int = 0,
+) -> Path:
+    """
+    Write the (title, region) pairs of a dataset one at a time as they are
+    produced, returning the path written. Region dicts are validated as they
+    arrive (in validation_processes worker processes, if given); region
+    models, validated or trusted, are written as they are.
+    """
+
+    region_model_class = list_item_model_class(dataset_model_class, "regions")
+    dataset_shell = validate_cets_model(
+        {"name": accession_id, "regions": []}, dataset_model_class, f"{dataset_model_class.__name__} {accession_id}"
+    )
+
+    with CETSDatasetWriter(accession_id, dataset_shell, compact, compress, shard) as writer:
+        for region_title, cets_region in _iter_validated_regions(
+            regions, region_model_class, writer.indent, validation_processes
+        ):
+            writer.write_region(cets_region, title=region_title)
+
+    return writer.output_path
+
+
+def load_cets_dataset_region(index_path: Union[str, Path], region_index: int) -> dict:
+    """Load one region of a dataset written with shard, without reading the others"""
+
+    index_path = Path(index_path)
+    with open(index_path, encoding="utf-8") as fh:
+        index = json.load(fh)
+    shard_path = index_path.parent / index["regions"][region_index]["path"]
+
+    with (gzip.open if shard_path.suffix == ".gz" else open)(shard_path, "rt", encoding="utf-8") as fh:
+        return json.load(fh)
@@ -1,59 +1,153 @@
-import tomobabel.models.top_level
 import typer
-import requests
-import json
 import logging
 import rich
+import time
+import traceback
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
 
-import tomobabel.models
-import cryoet_metadata._base._models
-
-from .models import Entry
-from .cets_object_utils import dict_to_cets_model, save_cets_model_to_json
-from .empiar_utils import get_files_for_empiar_entry_cached
-from .yaml_parsing import (
-    load_empiar_yaml_for_tomobabel, 
-    load_empiar_yaml_for_czii, 
-    parse_regions
+# Only what every command needs is imported here. The CETS implementations,
+# the network stacks and the generated EMPIAR models take hundreds of
+# milliseconds to import, so each command imports what it uses, and
+# convert_accession only the implementation it was asked for.
+from .cache import (
+    CACHE_MAX_BYTES_ENV_VAR,
+    CACHE_ROOT_ENV_VAR,
+    enforce_cache_budget,
+    get_cache_root,
+    parse_size,
+    set_cache_budget,
+    set_cache_root,
 )
+from .defaults import DEFAULT_FTP_CONNECTIONS, DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_LEASE_TIMEOUT
+from .storage import OFFLINE_ENV_VAR, STORAGE_ENV_VAR, set_offline, set_storage_spec
 
-from .cets.tomobabel.dataset import start_cets_tomobabel_dataset_from_empiar_entry
-from .cets.tomobabel.movie_stack_set import create_cets_tomobabel_movie_stack_set_from_region
-
-from .cets.czii.region import create_cets_czii_region_from_region_directive
+if TYPE_CHECKING:
+    from .models import Entry
 
 
 logger = logging.getLogger("empiar_cets.cli")
 
 
 app = typer.Typer()
+cache_app = typer.Typer(help="Inspect and prune the on-disk cache")
+app.add_typer(cache_app, name="cache")
 
 
-def empiar_entry_from_accession_id(accession_id: str) -> Entry:
-
-    accession_no = accession_id.split("-")[1]
-    empiar_uri = f"https://www.ebi.ac.uk/empiar/api/entry/{accession_no}"
+@app.callback()
+def main(
+    cache_dir: Optional[Path] = typer.Option(
+        None, envvar=CACHE_ROOT_ENV_VAR, help="Root directory of the on-disk cache [default: local-data]"
+    ),
+    cache_max_size: Optional[str] = typer.Option(
+        None, envvar=CACHE_MAX_BYTES_ENV_VAR, help="Size budget of the cache, e.g. 20G; least recently used entries are evicted after each conversion"
+    ),
+    storage: Optional[str] = typer.Option(
+        None, envvar=STORAGE_ENV_VAR, help="Where entries' data is read from: ebi, a local mirror directory (<accession_no>/data/...) or a pyfilesystem2 URL [default: ebi]"
+    ),
+    offline: bool = typer.Option(
+        False, envvar=OFFLINE_ENV_VAR, help="Use only cached data and local storage; fail at once on anything that would need the network"
+    ),
+):
+    if cache_dir is not None:
+        set_cache_root(cache_dir)
+    if cache_max_size is not None:
+        set_cache_budget(cache_max_size)
+    if storage is not None:
+        set_storage_spec(storage)
+    set_offline(offline)
 
-    r = requests.get(empiar_uri)
-    raw_data = json.loads(r.content)
 
-    accession_obj = raw_data[accession_id]
-    entry = Entry.model_validate(accession_obj)
+def empiar_entry_from_accession_id(accession_id: str) -> "Entry":
+    from .entry_metadata import get_empiar_entry
 
-    return entry
+    return get_empiar_entry(accession_id)
 
 
 @app.command()
 def convert_empiar_to_cets(
     accession_id: str, 
-    cets_implementation: str = "czii"
+    cets_implementation: str = "czii",
+    ftp_connections: int = typer.Option(
+        DEFAULT_FTP_CONNECTIONS, help="Number of concurrent FTP connections used to list the entry"
+    ),
+    refresh: bool = typer.Option(
+        False, help="Revalidate the cached file list if the EMPIAR entry has changed. Only directories whose modification time changed are listed again, so a file overwritten in place keeps its cached size; use --full-refresh for that"
+    ),
+    full_refresh: bool = typer.Option(
+        False, help="Ignore the cached file list and list the entry again from scratch"
+    ),
+    cache_format: str = typer.Option(
+        "json", help="Format of the file list cache: json, binary or binary-zstd"
+    ),
+    jobs: int = typer.Option(
+        1, help="Number of regions to convert concurrently (czii only)"
+    ),
+    compose_alignments: bool = typer.Option(
+        False, help="Write each projection's alignment as one composed affine matrix (czii only)"
+    ),
+    compact: bool = typer.Option(
+        False, help="Write the dataset JSON without indentation"
+    ),
+    compress: bool = typer.Option(
+        False, help="Gzip the dataset JSON"
+    ),
+    shard_regions: bool = typer.Option(
+        False, help="Write each region to its own file, with an index.json"
+    ),
+    validation_processes: int = typer.Option(
+        0, help="Number of worker processes validating regions as they are converted (czii only; 0 validates in this process)"
+    ),
 ):
     
-    entry = empiar_entry_from_accession_id(accession_id)
-    rich.print(f"[green]Got EMPIAR Entry for {accession_id}:[/green]")
+    convert_accession(
+        accession_id,
+        cets_implementation,
+        ftp_connections=ftp_connections,
+        refresh=refresh,
+        cache_format=cache_format,
+        full_refresh=full_refresh,
+        jobs=jobs,
+        compose_alignments=compose_alignments,
+        compact=compact,
+        compress=compress,
+        shard_regions=shard_regions,
+        validation_processes=validation_processes,
+    )
+    enforce_cache_budget()
+
 
+def convert_accession(
+    accession_id: str,
+    cets_implementation: str = "czii",
+    ftp_connections: int = DEFAULT_FTP_CONNECTIONS,
+    refresh: bool = False,
+    cache_format: str = "json",
+    full_refresh: bool = False,
+    jobs: int = 1,
+    definitions_dirpath: Optional[Path] = None,
+    compose_alignments: bool = False,
+    compact: bool = False,
+    compress: bool = False,
+    shard_regions: bool = False,
+    validation_processes: int = 0,
+) -> Optional[Path]:
+    """Convert one EMPIAR entry, returning the path of the saved CETS dataset (czii only)"""
+
+    from .empiar_utils import get_regions_for_empiar_entry
+    
     if cets_implementation == "tomobabel":
 
+        import tomobabel.models.top_level
+
+        from .cets_object_utils import dict_to_cets_model
+        from .cets.tomobabel.dataset import start_cets_tomobabel_dataset_from_empiar_entry
+        from .cets.tomobabel.movie_stack_set import create_cets_tomobabel_movie_stack_set_from_region
+        from .yaml_parsing import load_empiar_yaml_for_tomobabel
+
+        entry = empiar_entry_from_accession_id(accession_id)
+        rich.print(f"[green]Got EMPIAR Entry for {accession_id}:[/green]")
+
         # make_dataset
         cets_dataset_dict = start_cets_tomobabel_dataset_from_empiar_entry(entry)
         cets_dataset = dict_to_cets_model(
@@ -63,17 +157,23 @@ def convert_empiar_to_cets(
         rich.print(cets_dataset)
 
         # process_regions
-        directive_dict = load_empiar_yaml_for_tomobabel(accession_id)
+        directive_dict = load_empiar_yaml_for_tomobabel(accession_id, definitions_dirpath)
         rich.print(f"[green]Loaded YAML for {accession_id}:[/green]")
 
-        regions = parse_regions(directive_dict)
+        # get_empiar_files, expanding any region templates against them
+        regions, empiar_files = get_regions_for_empiar_entry(
+            accession_id, 
+            directive_dict, 
+            ftp_connections, 
+            entry=entry, 
+            refresh=refresh, 
+            cache_format=cache_format, 
+            full_refresh=full_refresh,
+        )
+        rich.print(f"[green]Got {len(empiar_files.files)} files for {accession_id}:[/green]")
         rich.print(f"[green]Processed regions for {accession_id}:[/green]")
         rich.print(regions)
 
-        # get_empiar_files
-        empiar_files = get_files_for_empiar_entry_cached(accession_id)
-        rich.print(f"[green]Got {len(empiar_files.files)} files for {accession_id}:[/green]")
-
         # make movie stack sets (in tomo image sets)
         cets_regions = {}
         for region in regions:
@@ -88,31 +188,415 @@ def convert_empiar_to_cets(
                 rich.print(cets_movie_stack_set)
         
         rich.print(f"[green]cets_regions: {cets_regions}[/green]")
+        empiar_files.close()
     
     elif cets_implementation == "czii":
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        import cryoet_metadata._base._models
+
+        from .cets_object_utils import write_cets_dataset
+        from .cets.czii.region import create_cets_czii_region_from_region_directive
+        from .entry_metadata import get_empiar_entry_version
+        from .header_probe import get_mrc_paths_for_regions, probe_mrc_headers
+        from .yaml_parsing import load_empiar_yaml_for_czii
         
-        directive_dict = load_empiar_yaml_for_czii(accession_id)
-        regions = parse_regions(directive_dict)
+        # Only which version of the entry this is matters, to the file list cache
+        entry = get_empiar_entry_version(accession_id)
 
-        empiar_files = get_files_for_empiar_entry_cached(accession_id)
+        directive_dict = load_empiar_yaml_for_czii(accession_id, definitions_dirpath)
+        regions, empiar_files = get_regions_for_empiar_entry(
+            accession_id, 
+            directive_dict, 
+            ftp_connections, 
+            entry=entry, 
+            refresh=refresh, 
+            cache_format=cache_format, 
+            full_refresh=full_refresh,
+        )
 
-        cets_dataset_dict = {}
-        dataset_regions = []
-        for region in regions:
-            cets_region_dict = create_cets_czii_region_from_region_directive(
+        # Fetch all tomogram and tilt series headers up front, concurrently
+        probe_mrc_headers(
+            accession_id,
+            empiar_files,
+            get_mrc_paths_for_regions(empiar_files, regions),
+            max_workers=ftp_connections,
+        )
+
+        def convert_region(region):
+            return create_cets_czii_region_from_region_directive(
                 accession_id,
                 region, 
-                empiar_files
+                empiar_files,
+                compose_alignments=compose_alignments,
             )
-            dataset_regions.append(cets_region_dict)
 
-        cets_dataset_dict["name"] = accession_id
-        cets_dataset_dict["regions"] = dataset_regions
-        cets_dataset = dict_to_cets_model(
-            cets_dataset_dict, 
-            cets_model_class=cryoet_metadata._base._models.Dataset
+        # Regions are independent, so their (network-bound) conversions can
+        # overlap; map keeps the output in directive order, and each region
+        # is written out as soon as it and those before it are done
+        with empiar_files, ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            return write_cets_dataset(
+                accession_id,
+                cryoet_metadata._base._models.Dataset,
+                zip((region.title for region in regions), executor.map(convert_region, regions)),
+                compact=compact,
+                compress=compress,
+                shard=shard_regions,
+                validation_processes=validation_processes,
+            )
+
+
+def is_conversion_up_to_date(
+    accession_id: str,
+    cets_implementation: str = "czii",
+    definitions_dirpath: Optional[Path] = None,
+    compress: bool = False,
+    shard_regions: bool = False,
+    cache_format: str = "json",
+) -> bool:
+    """
+    Whether the saved czii dataset is newer than the entry's definition file,
+    and the cached file list it was made from (if stamped with the version
+    of the entry it was listed against) is of the entry as it is now
+    """
+
+    if cets_implementation != "czii":
+        return False
+
+    import cryoet_metadata._base._models
+
+    from .cets_object_utils import get_cets_model_json_path
+    from .empiar_utils import file_list_matches_entry, load_cached_file_list
+    from .entry_metadata import get_empiar_entry_version
+    from .yaml_parsing import get_definition_file_path
+
+    output_path = get_cets_model_json_path(
+        accession_id, accession_id, cryoet_metadata._base._models.Dataset, compress, shard_regions
+    )
+    definition_path = get_definition_file_path(accession_id, cets_implementation, definitions_dirpath)
+    if not output_path.exists() or not definition_path.exists():
+        return False
+    if output_path.stat().st_mtime < definition_path.stat().st_mtime:
+        return False
+
+    cached_files = load_cached_file_list(accession_id, cache_format)
+    if cached_files is None:
+        return False
+    with cached_files:
+        if cached_files.entry_update_date is None and cached_files.entry_version_history is None:
+            return True
+        try:
+            entry = get_empiar_entry_version(accession_id)
+        except Exception as e:
+            # Converting it again will report the problem properly
+            logger.warning(f"Could not get the current version of {accession_id}: {type(e).__name__}: {e}")
+            return False
+        return file_list_matches_entry(cached_files, entry)
+
+
+def _convert_accession_isolated(accession_id: str, conversion_kwargs: dict) -> dict:
+    """Run one conversion in a batch worker, reporting failure instead of raising"""
+
+    start = time.monotonic()
+    try:
+        output_path = convert_accession(accession_id, **conversion_kwargs)
+        status, detail = "converted", str(output_path or "")
+        enforce_cache_budget()
+    except Exception as e:
+        logger.error(f"Conversion of {accession_id} failed:\n{traceback.format_exc()}")
+        status, detail = "failed", f"{type(e).__name__}: {e}"
+
+    return {
+        "accession_id": accession_id,
+        "status": status,
+        "detail": detail,
+        "seconds": time.monotonic() - start,
+    }
+
+
+@app.command()
+def convert_batch(
+    accession_ids: Optional[List[str]] = typer.Argument(
+        None, help="EMPIAR accession IDs to convert"
+    ),
+    definitions_dir: Optional[Path] = typer.Option(
+        None, help="Convert every empiar_<no>.yaml definition file in this directory"
+    ),
+    cets_implementation: str = "czii",
+    processes: int = typer.Option(
+        4, help="Number of accessions to convert in parallel, each in its own worker process"
+    ),
+    resume: bool = typer.Option(
+        True, help="Skip accessions whose saved dataset is newer than their definition file, unless their cached file list is of an older version of the entry"
+    ),
+    ftp_connections: int = typer.Option(
+        DEFAULT_FTP_CONNECTIONS, help="Number of concurrent FTP connections per accession"
+    ),
+    refresh: bool = typer.Option(
+        False, help="Revalidate cached file lists of entries that have changed. Only directories whose modification time changed are listed again, so a file overwritten in place keeps its cached size; use --full-refresh for that"
+    ),
+    full_refresh: bool = typer.Option(
+        False, help="Ignore cached file lists and list every entry again from scratch (implies --no-resume)"
+    ),
+    cache_format: str = typer.Option(
+        "json", help="Format of the file list cache: json, binary or binary-zstd"
+    ),
+    jobs: int = typer.Option(
+        1, help="Number of regions to convert concurrently within each accession"
+    ),
+    compact: bool = typer.Option(
+        False, help="Write the dataset JSON without indentation"
+    ),
+    compress: bool = typer.Option(
+        False, help="Gzip the dataset JSON"
+    ),
+    shard_regions: bool = typer.Option(
+        False, help="Write each region to its own file, with an index.json"
+    ),
+):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    import rich.table
+
+    from .entry_metadata import prefetch_empiar_entries
+    from .yaml_parsing import accession_ids_from_definitions_dir
+    
+    accession_ids = list(accession_ids or [])
+    if definitions_dir is not None:
+        accession_ids += accession_ids_from_definitions_dir(definitions_dir)
+    accession_ids = list(dict.fromkeys(accession_ids))
+    if not accession_ids:
+        raise typer.BadParameter("Give accession IDs or a --definitions-dir")
+
+    conversion_kwargs = {
+        "cets_implementation": cets_implementation,
+        "ftp_connections": ftp_connections,
+        "refresh": refresh,
+        "cache_format": cache_format,
+        "full_refresh": full_refresh,
+        "jobs": jobs,
+        "definitions_dirpath": definitions_dir,
+        "compact": compact,
+        "compress": compress,
+        "shard_regions": shard_regions,
+    }
+
+    def failure(accession_id: str, e: BaseException, seconds: float = 0.0) -> dict:
+        return {
+            "accession_id": accession_id,
+            "status": "failed",
+            "detail": f"{type(e).__name__}: {e}",
+            "seconds": seconds,
+        }
+
+    # Fetch (or revalidate) all entries' metadata up front, concurrently; the
+    # resume check and the workers then read it from the cache
+    for accession_id, error in prefetch_empiar_entries(accession_ids).items():
+        if error is not None:
+            logger.warning(f"Could not prefetch entry metadata for {accession_id}: {error}")
+
+    results = {}
+    to_convert = []
+    for accession_id in accession_ids:
+        try:
+            up_to_date = resume and not full_refresh and is_conversion_up_to_date(
+                accession_id, cets_implementation, definitions_dir, compress, shard_regions, cache_format
+            )
+        except Exception as e:
+            logger.error(f"Could not check whether {accession_id} is up to date:\n{traceback.format_exc()}")
+            results[accession_id] = failure(accession_id, e)
+            continue
+        if up_to_date:
+            results[accession_id] = {
+                "accession_id": accession_id, "status": "skipped", "detail": "up to date", "seconds": 0.0
+            }
+        else:
+            to_convert.append(accession_id)
+
+    # Each accession runs in a worker process: a failure in one is reported
+    # in the summary without affecting the others. A worker that dies (and
+    # so breaks the pool) fails the accessions still to come back
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=max(1, processes)) as executor:
+        futures = {
+            executor.submit(_convert_accession_isolated, accession_id, conversion_kwargs): accession_id
+            for accession_id in to_convert
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Worker converting {futures[future]} failed:\n{traceback.format_exc()}")
+                result = failure(futures[future], e, time.monotonic() - start)
+            results[result["accession_id"]] = result
+            rich.print(f"{result['accession_id']}: {result['status']} ({result['seconds']:.1f}s)")
+
+    table = rich.table.Table(title="Batch conversion summary")
+    for column in ("Accession", "Status", "Time (s)", "Detail"):
+        table.add_column(column)
+    status_colours = {"converted": "green", "skipped": "yellow", "failed": "red"}
+    for accession_id in accession_ids:
+        result = results[accession_id]
+        colour = status_colours[result["status"]]
+        table.add_row(
+            accession_id, 
+            f"[{colour}]{result['status']}[/{colour}]", 
+            f"{result['seconds']:.1f}", 
+            result["detail"]
         )
-        save_cets_model_to_json(accession_id, accession_id, cets_dataset)      
+    rich.print(table)
+
+    if any(result["status"] == "failed" for result in results.values()):
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def queue_init(
+    queue_dir: Path,
+    accession_ids: Optional[List[str]] = typer.Argument(
+        None, help="EMPIAR accession IDs to queue"
+    ),
+    definitions_dir: Optional[Path] = typer.Option(
+        None, help="Queue every empiar_<no>.yaml definition file in this directory"
+    ),
+    ftp_connections: int = typer.Option(
+        DEFAULT_FTP_CONNECTIONS, help="Number of concurrent FTP connections used to list each entry"
+    ),
+    cache_format: str = typer.Option(
+        "json", help="Format of the file list cache: json, binary or binary-zstd"
+    ),
+):
+    """Queue one work unit per region of each accession (czii only)"""
+    from .work_queue import WorkQueue, prepare_accession
+    from .yaml_parsing import accession_ids_from_definitions_dir
+    
+    accession_ids = list(accession_ids or [])
+    if definitions_dir is not None:
+        accession_ids += accession_ids_from_definitions_dir(definitions_dir)
+    if not accession_ids:
+        raise typer.BadParameter("Give accession IDs or a --definitions-dir")
+
+    queue = WorkQueue(queue_dir)
+    queue.create()
+    for accession_id in dict.fromkeys(accession_ids):
+        n_units = prepare_accession(
+            queue, accession_id, ftp_connections, cache_format, definitions_dir
+        )
+        rich.print(f"[green]Queued {n_units} regions of {accession_id}[/green]")
+
+
+@app.command()
+def queue_work(
+    queue_dir: Path,
+    ftp_connections: int = typer.Option(
+        DEFAULT_FTP_CONNECTIONS, help="Number of concurrent FTP connections"
+    ),
+    cache_format: str = typer.Option(
+        "json", help="Format of the file list cache: json, binary or binary-zstd"
+    ),
+    lease_timeout: float = typer.Option(
+        DEFAULT_LEASE_TIMEOUT, help="Seconds without a heartbeat after which a lease is re-queued"
+    ),
+    heartbeat_interval: float = typer.Option(
+        DEFAULT_HEARTBEAT_INTERVAL, help="Seconds between heartbeats of a held lease"
+    ),
+    max_attempts: int = typer.Option(
+        3, help="Attempts at a region before it is marked as failed"
+    ),
+    wait: bool = typer.Option(
+        True, help="Keep polling while other workers hold leases that may expire"
+    ),
+):
+    """Convert queued regions until the queue is drained"""
+    from .work_queue import WorkQueue, run_worker
+
+    queue = WorkQueue(queue_dir, lease_timeout=lease_timeout)
+    counts = run_worker(
+        queue, ftp_connections, cache_format, heartbeat_interval, max_attempts, wait
+    )
+    rich.print(f"[green]Converted {counts['done']} regions, {counts['failed']} failed[/green]")
+
+
+@app.command()
+def queue_reduce(
+    queue_dir: Path,
+    accession_ids: Optional[List[str]] = typer.Argument(
+        None, help="Accessions to assemble (default: every queued accession)"
+    ),
+    compact: bool = typer.Option(
+        False, help="Write the dataset JSON without indentation"
+    ),
+    compress: bool = typer.Option(
+        False, help="Gzip the dataset JSON"
+    ),
+    shard_regions: bool = typer.Option(
+        False, help="Write each region to its own file, with an index.json"
+    ),
+):
+    """Assemble and save the Dataset of each fully converted accession"""
+    from .work_queue import WorkQueue, reduce_all
+
+    queue = WorkQueue(queue_dir)
+    reduced = reduce_all(queue, accession_ids, compact, compress, shard_regions)
+    incomplete = [accession_id for accession_id, path in reduced.items() if path is None]
+    if incomplete:
+        rich.print(f"[red]Not yet complete: {', '.join(incomplete)}[/red]")
+        raise typer.Exit(code=1)
+
+
+@cache_app.command("stats")
+def cache_stats_command(
+    accession_id: Optional[str] = typer.Argument(None, help="Only this accession"),
+):
+    """Show the size of the cache per accession and kind of entry"""
+    import rich.table
+
+    from .cache import cache_stats
+
+    table = rich.table.Table(title=f"Cache in {get_cache_root()}")
+    for column in ("Accession", "Kind", "Files", "Size (MB)", "Last used"):
+        table.add_column(column)
+    total_files, total_bytes = 0, 0
+    for (stats_accession_id, kind), stats in cache_stats(accession_id).items():
+        table.add_row(
+            stats_accession_id,
+            kind or "-",
+            str(stats["files"]),
+            f"{stats['bytes'] / 1e6:.1f}",
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(stats["last_used"])),
+        )
+        total_files += stats["files"]
+        total_bytes += stats["bytes"]
+    table.add_row("Total", "", str(total_files), f"{total_bytes / 1e6:.1f}", "", style="bold")
+    rich.print(table)
+
+
+@cache_app.command("prune")
+def cache_prune_command(
+    max_size: Optional[str] = typer.Option(
+        None, help="Evict least recently used entries until the cache takes at most this much, e.g. 20G"
+    ),
+    older_than_days: Optional[float] = typer.Option(
+        None, help="Evict entries not used for this many days"
+    ),
+    accession_id: Optional[str] = typer.Option(None, help="Only prune this accession"),
+    dry_run: bool = typer.Option(False, help="Only show what would be evicted"),
+):
+    """Evict cache entries by age and/or least recent use"""
+    from .cache import prune_cache
+
+    if max_size is None and older_than_days is None:
+        raise typer.BadParameter("Give --max-size and/or --older-than-days")
+
+    evicted = prune_cache(
+        max_bytes=None if max_size is None else parse_size(max_size),
+        older_than=None if older_than_days is None else older_than_days * 86400,
+        accession_id=accession_id,
+        dry_run=dry_run,
+    )
+    verb = "Would evict" if dry_run else "Evicted"
+    rich.print(f"[green]{verb} {len(evicted)} entries ({sum(e.size_in_bytes for e in evicted) / 1e6:.1f} MB)[/green]")
 
 
 @app.command()
@@ -0,0 +1,14 @@
+"""
+Defaults shared by the CLI and the modules that implement it, kept apart from
+those modules so that the CLI can offer them without importing the network
+and CETS stacks.
+"""
+
+DEFAULT_FTP_CONNECTIONS = 4
+
+DEFAULT_LEASE_TIMEOUT = 600.0
+DEFAULT_HEARTBEAT_INTERVAL = 30.0
+
+# Seconds between cache budget checks of a queue worker, as each check scans
+# the whole cache
+DEFAULT_CACHE_BUDGET_INTERVAL = 300.0
@@ -1,11 +1,39 @@
-import json
-from pathlib import Path
-from typing import List
-from fs.ftpfs import FTPFS
-from pydantic import BaseModel, Field
-import rich
+import logging
+from array import array
+from collections import defaultdict
+from collections.abc import Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
+from fs.base import FS
+from fs.errors import ResourceNotFound
+from pydantic import BaseModel, Field, GetCoreSchemaHandler, PrivateAttr
+from pydantic_core import core_schema
 import parse
-import struct
+
+from .cache import cache_dir, mark_used
+from .entry_metadata import EntryVersion
+from .ftp_pool import (
+    DEFAULT_FTP_CONNECTIONS,
+    FTPConnectionPool,
+    read_range,
+)
+from .models import Entry, VersionHistory
+from .mrc_header import MRC_HEADER_SIZE, decode_mrc_header
+from .storage import EBI_DATA_ROOT, EntryStorage, get_storage
+from .yaml_parsing import (
+    RegionDirective,
+    RegionTemplate,
+    check_unique_titles,
+    fill_template,
+    parse_region_templates,
+    parse_regions,
+    template_field_names,
+)
+
+
+logger = logging.getLogger("empiar_cets.empiar_utils")
 
 
 class EMPIARFile(BaseModel, frozen=True):
@@ -13,9 +41,366 @@ class EMPIARFile(BaseModel, frozen=True):
     size_in_bytes: int
 
 
+def _normalise_path(path: str) -> str:
+    # Match the normalisation a pathlib.Path field applies, without building
+    # a Path for the paths that are already normal (i.e. nearly all of them)
+    if "//" in path or "./" in path or path.endswith("/") or path.endswith("/."):
+        return str(PurePosixPath(path))
+    return path
+
+
+class EMPIARFileSequence(Sequence):
+    """
+    Compact, append-only sequence of EMPIARFile.
+
+    Directory strings are interned into a table and referenced by index from
+    a typed array, file names are kept as plain strings and sizes in a typed
+    array; EMPIARFile models and Path objects are only built on access.
+    For frame-level EMPIAR paths this takes ~90 bytes per file, against
+    ~770 bytes per file for a list of EMPIARFile models (measured with
+    benchmarks/bench_file_list_memory.py).
+
+    Validates from (and serialises to) a list of EMPIARFile / dicts, so
+    EMPIARFileList keeps its JSON form. Unlike a list of EMPIARFile, it
+    serialises paths as str in Python mode too, so model_dump() yields str
+    paths rather than Path objects.
+    """
+
+    __slots__ = ("_directories", "_directory_indices", "_file_directories", "_names", "_sizes", "_path_indices")
+
+    def __init__(self, files: Iterable[Union[EMPIARFile, dict]] = ()):
+        self._directories: list[str] = []
+        self._directory_indices: dict[str, int] = {}
+        self._file_directories = array("I")
+        self._names: list[str] = []
+        self._sizes = array("Q")
+        self._path_indices: Optional[dict[str, int]] = None
+        self.extend(files)
+
+    def append_path(self, path: str, size_in_bytes: int) -> None:
+        directory, _, name = _normalise_path(path).rpartition("/")
+        directory_index = self._directory_indices.get(directory)
+        if directory_index is None:
+            directory_index = self._directory_indices[directory] = len(self._directories)
+            self._directories.append(directory)
+        self._file_directories.append(directory_index)
+        self._names.append(name)
+        self._sizes.append(size_in_bytes)
+        self._path_indices = None
+
+    def append(self, file: Union[EMPIARFile, dict]) -> None:
+        if isinstance(file, EMPIARFile):
+            self.append_path(str(file.path), file.size_in_bytes)
+        else:
+            self.append_path(str(file["path"]), int(file["size_in_bytes"]))
+
+    def extend(self, files: Iterable[Union[EMPIARFile, dict]]) -> None:
+        for file in files:
+            self.append(file)
+
+    def path(self, index: int) -> str:
+        directory = self._directories[self._file_directories[index]]
+        name = self._names[index]
+        return f"{directory}/{name}" if directory else name
+
+    def size(self, index: int) -> int:
+        return self._sizes[index]
+
+    def iter_paths(self) -> Iterator[str]:
+        directories = self._directories
+        for directory_index, name in zip(self._file_directories, self._names):
+            directory = directories[directory_index]
+            yield f"{directory}/{name}" if directory else name
+
+    def index_of(self, path: Union[str, Path]) -> Optional[int]:
+        if self._path_indices is None:
+            self._path_indices = {path: index for index, path in enumerate(self.iter_paths())}
+        return self._path_indices.get(_normalise_path(str(path)))
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return EMPIARFile(path=self.path(index), size_in_bytes=self._sizes[index])
+
+    def __iter__(self) -> Iterator[EMPIARFile]:
+        for path, size_in_bytes in zip(self.iter_paths(), self._sizes):
+            yield EMPIARFile(path=path, size_in_bytes=size_in_bytes)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, EMPIARFileSequence):
+            return list(self.iter_paths()) == list(other.iter_paths()) and self._sizes == other._sizes
+        if isinstance(other, Sequence):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"EMPIARFileSequence(<{len(self)} files>)"
+
+    def _serialise(self) -> list[dict]:
+        return [
+            {"path": path, "size_in_bytes": size_in_bytes}
+            for path, size_in_bytes in zip(self.iter_paths(), self._sizes)
+        ]
+
+    @classmethod
+    def _validate(cls, value: Any) -> "EMPIARFileSequence":
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, (str, bytes)) or not isinstance(value, Iterable):
+            raise ValueError("files must be a list of EMPIARFile")
+        files = cls()
+        for i, file in enumerate(value):
+            try:
+                files.append(file)
+            except (KeyError, TypeError, ValueError, OverflowError) as e:
+                raise ValueError(f"files[{i}] is not a valid EMPIARFile: {e!r}") from None
+        return files
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source_type: Any, handler: GetCoreSchemaHandler):
+        return core_schema.no_info_plain_validator_function(
+            cls._validate,
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda files: files._serialise(),
+                return_schema=core_schema.list_schema(core_schema.dict_schema()),
+            ),
+        )
+
+
+class ListedRoot(BaseModel, frozen=True):
+    """
+    A directory (relative to the entry's data directory) that has been listed.
+
+    Paths are compared case-insensitively, as file patterns are matched.
+    """
+    path: str = ""
+    recursive: bool = True
+
+    def covers(self, other: "ListedRoot") -> bool:
+        if self.path.lower() == other.path.lower():
+            return self.recursive or not other.recursive
+        return self.recursive and _is_under_directory(other.path, self.path)
+
+    def covers_file(self, file_path: str) -> bool:
+        parent = file_path.rpartition("/")[0]
+        if not self.recursive:
+            return parent.lower() == self.path.lower()
+        return _is_under_directory(parent, self.path)
+
+
 class EMPIARFileList(BaseModel):
 
-    files: List[EMPIARFile]
+    # Dumps as a list of {"path": str, "size_in_bytes": int} dicts, including
+    # in model_dump(): paths are str there, not Path (see EMPIARFileSequence)
+    files: EMPIARFileSequence
+    # None means the whole entry was listed (as in caches that predate pruning)
+    listed_roots: Optional[List[ListedRoot]] = None
+    # Modification times (POSIX timestamps) of the directories walked into,
+    # relative to the entry's data directory
+    directory_mtimes: Dict[str, float] = Field(default_factory=dict)
+    # State of the EMPIAR entry when the listing was last validated
+    entry_update_date: Optional[str] = None
+    entry_version_history: Optional[List[VersionHistory]] = None
+
+    _matcher: Optional["EMPIARFileMatcher"] = PrivateAttr(default=None)
+
+    @property
+    def matcher(self) -> "EMPIARFileMatcher":
+        """Pattern matcher over this file list, built on first use"""
+        if self._matcher is None:
+            self._matcher = EMPIARFileMatcher(self.files.iter_paths())
+        return self._matcher
+
+    def iter_paths(self) -> Iterator[str]:
+        return self.files.iter_paths()
+
+    def get(self, path: Union[str, Path]) -> Optional[EMPIARFile]:
+        """Look up a file by its path relative to the entry's data directory"""
+        index = self.files.index_of(path)
+        return None if index is None else self.files[index]
+
+    def close(self) -> None:
+        """Nothing to release; as EMPIARFileListView.close, for callers holding either"""
+
+    def __enter__(self) -> "EMPIARFileList":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class _CompiledPattern:
+    """A parse format compiled once, with the literal text around its fields"""
+
+    def __init__(self, file_pattern: str):
+        self.file_pattern = file_pattern
+        self.is_literal = "{" not in file_pattern and "}" not in file_pattern
+        self.parser = None if self.is_literal else parse.compile(file_pattern)
+
+        # parse matches literal text case-insensitively, so compare lowered text.
+        # Text before the first "{" and after the last "}" is always literal,
+        # even when the pattern contains escaped "{{" / "}}" braces.
+        lowered = file_pattern.lower()
+        self.prefix = lowered.split("{", 1)[0]
+        self.suffix = lowered.rsplit("}", 1)[-1]
+        self.directory_prefix = self.prefix.rpartition("/")[0]
+
+    def parse(self, lowered_path: str, path: str) -> Optional[parse.Result]:
+        if not lowered_path.startswith(self.prefix):
+            return None
+        if not lowered_path.endswith(self.suffix):
+            return None
+        if len(lowered_path) < len(self.prefix) + len(self.suffix):
+            return None
+        return self.parser.parse(path)
+
+    def matches(self, lowered_path: str, path: str) -> bool:
+        return self.parse(lowered_path, path) is not None
+
+
+@dataclass(frozen=True)
+class PatternMatch:
+    """A path matching a file pattern, with the values of the pattern's named fields"""
+    path: str
+    values: Dict[str, Any] = field(default_factory=dict)
+    # The matched text of each named field, as it appears in the path
+    texts: Dict[str, str] = field(default_factory=dict)
+
+
+class EMPIARFileMatcher:
+    """
+    Index over the paths of an EMPIARFileList for repeated pattern matching.
+
+    Paths are indexed by (lower-cased) parent directory and by full path, so
+    literal patterns are a dictionary lookup and templated patterns only run
+    their compiled parse format against files in directories under the
+    pattern's literal prefix. Results are memoised per pattern and always
+    returned in file list order.
+    """
+
+    def __init__(self, paths: Iterable[str]):
+        self.paths: list[str] = list(paths)
+        self._lowered_paths = [path.lower() for path in self.paths]
+
+        self._indices_by_path: dict[str, list[int]] = defaultdict(list)
+        self._indices_by_directory: dict[str, list[int]] = defaultdict(list)
+        for i, lowered_path in enumerate(self._lowered_paths):
+            self._indices_by_path[lowered_path].append(i)
+            self._indices_by_directory[lowered_path.rpartition("/")[0]].append(i)
+
+        self._results: dict[str, list[str]] = {}
+
+    def _candidate_indices(self, pattern: _CompiledPattern) -> Iterable[int]:
+        # Placeholders can match across "/", so the whole subtree under the
+        # literal directory prefix is a candidate.
+        directory_prefix = pattern.directory_prefix
+        candidates = []
+        for directory, indices in self._indices_by_directory.items():
+            if (
+                not directory_prefix
+                or directory == directory_prefix
+                or directory.startswith(directory_prefix + "/")
+            ):
+                candidates.extend(indices)
+        return sorted(candidates)
+
+    def match_patterns(self, file_patterns: Iterable[str]) -> dict[str, list[str]]:
+        """
+        Return the matching paths for each of the given patterns.
+
+        Templated patterns that are not already memoised are answered together
+        in a single pass over the union of their candidate files.
+        """
+        pending: dict[str, _CompiledPattern] = {}
+        for file_pattern in file_patterns:
+            if file_pattern in self._results or file_pattern in pending:
+                continue
+            pattern = _CompiledPattern(file_pattern)
+            if pattern.is_literal:
+                indices = self._indices_by_path.get(pattern.prefix, [])
+                self._results[file_pattern] = [self.paths[i] for i in indices]
+            else:
+                pending[file_pattern] = pattern
+
+        if pending:
+            matched = {
+                file_pattern: [path for path, _ in results]
+                for file_pattern, results in self._scan(pending).items()
+            }
+            for file_pattern, paths in matched.items():
+                logger.debug(f"Found {len(paths)} file references matching pattern {file_pattern}")
+            self._results.update(matched)
+
+        return {file_pattern: self._results[file_pattern] for file_pattern in file_patterns}
+
+    def _scan(self, patterns: dict[str, _CompiledPattern]) -> dict[str, list[tuple[str, parse.Result]]]:
+        """Parse the candidate files of all the templated patterns in a single pass"""
+
+        candidates = set()
+        for pattern in patterns.values():
+            candidates.update(self._candidate_indices(pattern))
+
+        results: dict[str, list[tuple[str, parse.Result]]] = {file_pattern: [] for file_pattern in patterns}
+        for i in sorted(candidates):
+            path, lowered_path = self.paths[i], self._lowered_paths[i]
+            for file_pattern, pattern in patterns.items():
+                result = pattern.parse(lowered_path, path)
+                if result is not None:
+                    results[file_pattern].append((path, result))
+
+        return results
+
+    def parse_patterns(self, file_patterns: Iterable[str]) -> dict[str, list[PatternMatch]]:
+        """
+        Return the matching paths for each of the given patterns, with the
+        values their named fields captured, in a single pass over the files.
+        """
+        patterns = {file_pattern: _CompiledPattern(file_pattern) for file_pattern in file_patterns}
+
+        parsed: dict[str, list[PatternMatch]] = {}
+        for file_pattern, pattern in patterns.items():
+            if pattern.is_literal:
+                indices = self._indices_by_path.get(pattern.prefix, [])
+                parsed[file_pattern] = [PatternMatch(path=self.paths[i]) for i in indices]
+
+        scanned = self._scan({
+            file_pattern: pattern for file_pattern, pattern in patterns.items() if not pattern.is_literal
+        })
+        for file_pattern, results in scanned.items():
+            parsed[file_pattern] = [
+                PatternMatch(
+                    path=path,
+                    values=result.named,
+                    texts={name: path[start:end] for name, (start, end) in result.spans.items() if isinstance(name, str)},
+                )
+                for path, result in results
+            ]
+
+        return parsed
+
+    def match(self, file_pattern: str) -> list[str]:
+        return self.match_patterns([file_pattern])[file_pattern]
+
+
+def get_region_directive_file_patterns(region: Union[RegionDirective, RegionTemplate]) -> list[str]:
+    """All file patterns referenced by a region directive (or template)"""
+
+    file_patterns = []
+    for field_name in RegionDirective.model_fields:
+        value = getattr(region, field_name)
+        if value is None or isinstance(value, str):
+            continue
+        for directive in value if isinstance(value, list) else [value]:
+            file_patterns.append(directive.file_pattern)
+
+    return file_patterns
 
 
 def get_files_matching_pattern(
@@ -23,86 +408,557 @@ def get_files_matching_pattern(
         file_pattern: str
 ) -> list[str]:
 
-    selected_file_references = []
-    for file in file_list.files:
-        result = parse.parse(file_pattern, str(file.path))
-        if result is not None:
-            selected_file_references.append(str(file.path))
-    rich.print(f"Found {len(selected_file_references)} file references matching pattern {file_pattern}")
+    return list(file_list.matcher.match(file_pattern))
 
-    return selected_file_references
 
+def get_files_matching_region_directive(
+        file_list: EMPIARFileList,
+        region: RegionDirective,
+) -> dict[str, list[str]]:
+    """Match every file pattern of a region directive in a single pass"""
 
-def get_list_of_empiar_files(accession_no: str) -> EMPIARFileList:
+    file_patterns = get_region_directive_file_patterns(region)
+    return file_list.matcher.match_patterns(file_patterns)
 
-    ftp_fs = FTPFS('ftp.ebi.ac.uk')
-    root_path = f"/empiar/world_availability/{accession_no}/data"
-    walker = ftp_fs.walk(root_path)
 
-    empiar_files = []
+def _escape_file_pattern(path: str) -> str:
+    # A matched path as a file pattern matching only itself
+    return path.replace("{", "{{").replace("}", "}}")
 
-    for path, dirs, files in walker:
-        for file in files:
-            relpath = Path(path).relative_to(root_path)
-            empiar_file = EMPIARFile(
-                path=relpath/file.name,
-                size_in_bytes=file.size
+
+def _expand_region_template(
+        template: RegionTemplate,
+        matches: dict[str, list[PatternMatch]],
+) -> list[RegionDirective]:
+    region_names = template_field_names(template.title)
+
+    # Each pattern's matches grouped by the values of the region captures it
+    # has; patterns with all of them say which regions exist
+    matches_by_region: dict[str, dict[tuple, list[PatternMatch]]] = {}
+    region_texts: dict[tuple, dict[str, str]] = {}
+    for file_pattern in get_region_directive_file_patterns(template):
+        if file_pattern in matches_by_region:
+            continue
+        pattern_region_names = [name for name in region_names if name in template_field_names(file_pattern)]
+        grouped = matches_by_region[file_pattern] = defaultdict(list)
+        for match in matches[file_pattern]:
+            grouped[tuple(match.values[name] for name in pattern_region_names)].append(match)
+            if len(pattern_region_names) == len(region_names):
+                region_texts.setdefault(
+                    tuple(match.values[name] for name in region_names),
+                    {name: match.texts[name] for name in region_names},
+                )
+
+    regions = []
+    for region_key in sorted(region_texts):
+        texts = region_texts[region_key]
+        region_values = dict(zip(region_names, region_key))
+        title = fill_template(template.title, texts)
+        region_dict: dict[str, Any] = {"title": title}
+
+        for field_name in RegionDirective.model_fields:
+            value = getattr(template, field_name)
+            if value is None or isinstance(value, str):
+                continue
+
+            directives = []
+            for directive in value if isinstance(value, list) else [value]:
+                pattern_names = template_field_names(directive.file_pattern)
+                item_names = [name for name in pattern_names if name not in region_values]
+                order_by = getattr(directive, "order_by", None) or item_names
+                item_matches = sorted(
+                    matches_by_region[directive.file_pattern].get(
+                        tuple(region_values[name] for name in region_names if name in pattern_names), []
+                    ),
+                    key=lambda match: (tuple(match.values[name] for name in order_by), match.path),
+                )
+                for match in item_matches:
+                    directives.append({
+                        "label": fill_template(directive.label, {**texts, **match.texts}),
+                        "file_pattern": _escape_file_pattern(match.path),
+                    })
+
+            if not directives:
+                continue
+            if isinstance(value, list):
+                region_dict[field_name] = directives
+            elif len(directives) == 1:
+                region_dict[field_name] = directives[0]
+            else:
+                raise ValueError(f"{field_name} of region {title} matches {len(directives)} files")
+
+        regions.append(RegionDirective.model_validate(region_dict))
+
+    return regions
+
+
+def expand_region_templates(
+        templates: Iterable[RegionTemplate],
+        file_list: EMPIARFileList,
+) -> list[RegionDirective]:
+    """
+    Expand region templates against a file list: every file pattern of every
+    template is parsed in one pass over the files, and the matches grouped
+    into regions by the values of the templates' title captures. The regions
+    of each template are ordered by those values.
+    """
+
+    templates = list(templates)
+    file_patterns = [
+        file_pattern for template in templates
+        for file_pattern in get_region_directive_file_patterns(template)
+    ]
+    matches = file_list.matcher.parse_patterns(dict.fromkeys(file_patterns))
+
+    regions = []
+    for template in templates:
+        template_regions = _expand_region_template(template, matches)
+        logger.info(f"Region template {template.title} expanded into {len(template_regions)} regions")
+        regions.extend(template_regions)
+
+    return regions
+
+
+def _is_under_directory(path: str, directory: str) -> bool:
+    path, directory = path.lower(), directory.lower()
+    return not directory or path == directory or path.startswith(directory + "/")
+
+
+def minimise_listing_roots(listing_roots: Iterable[ListedRoot]) -> list[ListedRoot]:
+    """Drop roots that are covered by another root, keeping a sorted list"""
+
+    unique_roots = {}
+    for root in sorted(listing_roots, key=lambda root: (root.path, not root.recursive)):
+        unique_roots.setdefault((root.path.lower(), root.recursive), root)
+    unique_roots = list(unique_roots.values())
+    return [
+        root for root in unique_roots
+        if not any(other != root and other.covers(root) for other in unique_roots)
+    ]
+
+
+def get_listing_roots(regions: Iterable[Union[RegionDirective, RegionTemplate]]) -> list[ListedRoot]:
+    """
+    The directories that need listing for some file pattern of the regions
+    to be able to match.
+
+    A templated pattern needs the subtree under the literal directory prefix
+    before its first placeholder; a literal path only needs its own directory.
+    The directories keep the case of the patterns, which need not be the
+    case on the server (see walk_files_concurrently).
+    """
+
+    listing_roots = []
+    for region in regions:
+        for file_pattern in get_region_directive_file_patterns(region):
+            if "{" in file_pattern or "}" in file_pattern:
+                directory = file_pattern.split("{", 1)[0].rpartition("/")[0]
+                listing_roots.append(ListedRoot(path=directory, recursive=True))
+            else:
+                directory = file_pattern.rpartition("/")[0]
+                listing_roots.append(ListedRoot(path=directory, recursive=False))
+
+    return minimise_listing_roots(listing_roots)
+
+
+def walk_files_concurrently(
+        pool: FTPConnectionPool,
+        root_path: str,
+        max_connections: int = DEFAULT_FTP_CONNECTIONS,
+        listing_roots: Optional[Iterable[ListedRoot]] = None,
+        known_directory_mtimes: Optional[Dict[str, float]] = None,
+) -> tuple[list[EMPIARFile], dict[str, float], list[str]]:
+    """
+    List all files under root_path, fanning subdirectories out over at most
+    max_connections concurrent listings on connections from the pool.
+
+    If listing_roots is given, only those directories (relative to root_path)
+    are visited, recursively or not as each root specifies. A root that does
+    not exist with the given case is matched case-insensitively against its
+    parent directories' listings, as file patterns are, and every match is
+    listed; roots that do not exist at all are skipped. Files are returned sorted by path (relative to
+    root_path), so the result does not depend on the order in which listings
+    complete.
+
+    Returns the files, the modification times of the subdirectories walked
+    into, and the subdirectories that were not listed because their
+    modification time matches known_directory_mtimes (all paths relative to
+    root_path). Such a directory's own entries are unchanged, so its files
+    can be taken from the listing the mtimes came from; the subdirectories
+    it had then are still walked, as changes below them do not change its
+    modification time.
+    """
+
+    if known_directory_mtimes is None:
+        known_directory_mtimes = {}
+    known_subdirectories = defaultdict(list)
+    for directory in known_directory_mtimes:
+        known_subdirectories[directory.rpartition("/")[0]].append(directory)
+
+    def resolve_directory(path: str) -> list[str]:
+        # The directories whose path below root_path matches that of path
+        # case-insensitively, found by listing each parent in turn
+        directories = [root_path]
+        for name in Path(path).relative_to(root_path).parts:
+            matches = []
+            for directory in directories:
+                try:
+                    with pool.connection() as fs:
+                        infos = list(fs.scandir(directory))
+                except ResourceNotFound:
+                    continue
+                matches.extend(
+                    f"{directory.rstrip('/')}/{info.name}" for info in infos
+                    if info.is_dir and info.name.lower() == name.lower()
+                )
+            directories = matches
+        return directories
+
+    def list_directory(
+            path: str, 
+            recursive: bool,
+            resolve_case: bool = False,
+    ) -> tuple[list[EMPIARFile], list[str], dict[str, float], list[str]]:
+        relpath = Path(path).relative_to(root_path)
+        files, subdirs, subdir_mtimes, skipped_subdirs = [], [], {}, []
+        try:
+            with pool.connection() as fs:
+                infos = list(fs.scandir(path, namespaces=["details"]))
+        except ResourceNotFound:
+            resolved = resolve_directory(path) if resolve_case and path != root_path else []
+            if not resolved:
+                logger.warning(f"Directory {path} not found, skipping")
+            for resolved_path in resolved:
+                logger.info(f"Directory {path} not found, listing {resolved_path} instead")
+                results = list_directory(resolved_path, recursive)
+                files.extend(results[0])
+                subdirs.extend(results[1])
+                subdir_mtimes.update(results[2])
+                skipped_subdirs.extend(results[3])
+            return files, subdirs, subdir_mtimes, skipped_subdirs
+        for info in infos:
+            if info.is_dir:
+                if not recursive:
+                    continue
+                subdir_relpath = str(relpath/info.name)
+                mtime = info.modified.timestamp() if info.modified else None
+                if mtime is not None:
+                    subdir_mtimes[subdir_relpath] = mtime
+                    if known_directory_mtimes.get(subdir_relpath) == mtime:
+                        skipped_subdirs.append(subdir_relpath)
+                        # Not listed, so the mtimes of its subdirectories
+                        # are carried over from the previous listing
+                        for known_subdir in known_subdirectories[subdir_relpath]:
+                            subdir_mtimes[known_subdir] = known_directory_mtimes[known_subdir]
+                            subdirs.append(f"{root_path.rstrip('/')}/{known_subdir}")
+                        continue
+                subdirs.append(f"{path.rstrip('/')}/{info.name}")
+            else:
+                files.append(EMPIARFile(path=relpath/info.name, size_in_bytes=info.size))
+        return files, subdirs, subdir_mtimes, skipped_subdirs
+
+    if listing_roots is None:
+        listing_roots = [ListedRoot()]
+
+    empiar_files, directory_mtimes, skipped_directories = [], {}, []
+    with ThreadPoolExecutor(max_workers=max(1, max_connections)) as executor:
+        pending = {
+            executor.submit(
+                list_directory, 
+                f"{root_path}/{root.path}" if root.path else root_path, 
+                root.recursive,
+                True,
             )
-            empiar_files.append(empiar_file)
+            for root in listing_roots
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs, subdir_mtimes, skipped_subdirs = future.result()
+                empiar_files.extend(files)
+                directory_mtimes.update(subdir_mtimes)
+                skipped_directories.extend(skipped_subdirs)
+                pending.update(executor.submit(list_directory, subdir, True) for subdir in subdirs)
+
+    empiar_files.sort(key=lambda file: str(file.path))
+    skipped_directories.sort()
+
+    return empiar_files, directory_mtimes, skipped_directories
+
+
+def get_list_of_empiar_files(
+        accession_no: str,
+        max_connections: int = DEFAULT_FTP_CONNECTIONS,
+        fs_factory: Optional[Callable[[], FS]] = None,
+        listing_roots: Optional[List[ListedRoot]] = None,
+        previous_files: Optional[EMPIARFileList] = None,
+        storage: Optional[EntryStorage] = None,
+) -> EMPIARFileList:
+    """
+    List the files of an EMPIAR entry (optionally only under listing_roots),
+    from the given storage backend, or the configured one (see storage).
+    With fs_factory, the entry is listed on filesystems it makes instead,
+    which are laid out like the EBI archive.
+
+    If previous_files is given, subdirectories whose modification time is
+    unchanged since that listing are not listed again: their own files are
+    taken from previous_files, while their subdirectories are still walked.
+    A directory's modification time changes when files are added to,
+    removed from or renamed within it, but not when a file in it is
+    overwritten in place, so the sizes of such files are not refreshed. The
+    roots themselves are always re-listed.
+    """
+
+    if fs_factory is not None:
+        pool = FTPConnectionPool(max_size=max_connections, fs_factory=fs_factory)
+        root_path = EBI_DATA_ROOT.format(accession_no=accession_no)
+    else:
+        if storage is None:
+            storage = get_storage(max_connections)
+        storage.check_offline(f"The file list of EMPIAR-{accession_no}")
+        pool = storage.pool
+        root_path = storage.data_root(accession_no)
+
+    known_directory_mtimes = previous_files.directory_mtimes if previous_files else None
+    try:
+        empiar_files, directory_mtimes, skipped_directories = walk_files_concurrently(
+            pool, 
+            root_path, 
+            max_connections, 
+            listing_roots, 
+            known_directory_mtimes
+        )
+    finally:
+        if fs_factory is not None:
+            pool.close()
 
-    return EMPIARFileList(files=empiar_files)
+    if skipped_directories:
+        logger.info(f"Reusing cached listing of {len(skipped_directories)} unchanged directories")
+        skipped = set(skipped_directories)
+        for file in previous_files.files:
+            if str(file.path).rpartition("/")[0] in skipped:
+                empiar_files.append(file)
+        empiar_files.sort(key=lambda file: str(file.path))
+
+    return EMPIARFileList(
+        files=empiar_files, 
+        listed_roots=listing_roots, 
+        directory_mtimes=directory_mtimes
+    )
+
+
+def file_list_matches_entry(file_list: EMPIARFileList, entry: Union[Entry, EntryVersion]) -> bool:
+    """Whether a file list was validated against this state of the entry"""
+
+    if file_list.entry_update_date is None and file_list.entry_version_history is None:
+        return False
+    return (
+        file_list.entry_update_date == entry.update_date
+        and file_list.entry_version_history == entry.version_history
+    )
+
+
+def merge_file_lists(
+        cached_files: EMPIARFileList,
+        new_files: EMPIARFileList,
+) -> EMPIARFileList:
+    """
+    Add a listing of further roots to a cached file list. Cached files under
+    the new roots are replaced by the new listing.
+    """
+
+    new_roots = new_files.listed_roots or [ListedRoot()]
+    kept_files = [
+        file for file in cached_files.files
+        if not any(root.covers_file(str(file.path)) for root in new_roots)
+    ]
+    files = sorted(kept_files + list(new_files.files), key=lambda file: str(file.path))
+
+    directory_mtimes = {
+        directory: mtime for directory, mtime in cached_files.directory_mtimes.items()
+        if not any(root.recursive and _is_under_directory(directory, root.path) for root in new_roots)
+    }
+    directory_mtimes.update(new_files.directory_mtimes)
+
+    listed_roots = minimise_listing_roots((cached_files.listed_roots or [ListedRoot()]) + new_roots)
+
+    return EMPIARFileList(
+        files=files, 
+        listed_roots=listed_roots, 
+        directory_mtimes=directory_mtimes,
+        entry_update_date=cached_files.entry_update_date,
+        entry_version_history=cached_files.entry_version_history,
+    )
+
+
+def _file_list_cache_paths(accession_id: str, cache_format: str) -> list[Path]:
+    # Where the file list cache is written in cache_format, then where else
+    # an existing one is looked for
+    cache_dirpath = cache_dir(accession_id)
+    json_fpath = cache_dirpath / "all_files.json"
+    binary_fpath = cache_dirpath / "all_files.bin"
+    file_list_fpath = json_fpath if cache_format == "json" else binary_fpath
+    return list(dict.fromkeys([file_list_fpath, binary_fpath, json_fpath]))
+
+
+def load_cached_file_list(
+        accession_id: str,
+        cache_format: str = "json",
+) -> Optional[EMPIARFileList]:
+    """The cached file list of an entry, as it is, or None if there is none (close it when done)"""
+    from .file_list_cache import load_file_list_cache
+
+    for fpath in _file_list_cache_paths(accession_id, cache_format):
+        if fpath.exists():
+            return load_file_list_cache(fpath)
+    return None
 
 
 def get_files_for_empiar_entry_cached(
-        accession_id: str
+        accession_id: str,
+        max_connections: int = DEFAULT_FTP_CONNECTIONS,
+        regions: Optional[List[Union[RegionDirective, RegionTemplate]]] = None,
+        entry: Optional[Union[Entry, EntryVersion]] = None,
+        refresh: bool = False,
+        cache_format: str = "json",
+        full_refresh: bool = False,
 ) -> EMPIARFileList:
+    """
+    Get the files of an EMPIAR entry, listing only what the cache is missing.
+
+    If regions are given, only the directories their file patterns can match
+    are listed (see get_listing_roots); otherwise the whole entry is. The cache
+    records which roots it covers, so a later call needing further
+    directories lists just those and merges them in.
+
+    With refresh, a cached listing is revalidated unless it was made against
+    the same update_date and version_history as the given entry. Revalidation
+    re-lists only directories whose modification time has changed, so files
+    overwritten in place keep their cached sizes (see
+    get_list_of_empiar_files). With full_refresh, the cached listing is
+    ignored and the entry listed again from scratch.
+
+    cache_format selects how the cache is written: "json", or the compact
+    "binary" format (see file_list_cache), optionally zstd-compressed with
+    "binary-zstd". An existing cache in either format is read; a binary
+    cache is returned as a lazily decoding EMPIARFileListView, which the
+    caller should close when done with it.
+    """
+    from .file_list_cache import load_file_list_cache, save_file_list_cache
+
+    if cache_format not in ("json", "binary", "binary-zstd"):
+        raise ValueError(f"Unknown file list cache format: {cache_format}")
     
-    #FIXME - do the caching properly, use a separately configurable path
-    cache_dirpath = Path(f"local-data/{accession_id}/cache")
-    cache_dirpath.mkdir(exist_ok=True, parents=True)
-    file_list_fpath = cache_dirpath / "all_files.json"
+    cache_fpaths = _file_list_cache_paths(accession_id, cache_format)
+    file_list_fpath = cache_fpaths[0]
+    existing_fpath = next((fpath for fpath in cache_fpaths if fpath.exists()), None)
 
     accession_no = accession_id.split("-")[1]
 
-    if file_list_fpath.exists():
-        with open(file_list_fpath) as fh:
-            model_data = json.load(fh)
-            list_of_files = EMPIARFileList.model_validate(model_data) # type: ignore
+    requested_roots = get_listing_roots(regions) if regions else [ListedRoot()]
+
+    cached_files = None
+    revalidated = False
+    if existing_fpath is not None and full_refresh:
+        logger.info(f"Ignoring cached file list for {accession_id}, listing it again")
+    elif existing_fpath is not None:
+        cached_files = load_file_list_cache(existing_fpath)
+        mark_used(existing_fpath)
+
+        if refresh and not (entry is not None and file_list_matches_entry(cached_files, entry)):
+            logger.info(f"Revalidating cached file list for {accession_id}")
+            with cached_files:
+                cached_files = get_list_of_empiar_files(
+                    accession_no,
+                    max_connections,
+                    listing_roots=cached_files.listed_roots,
+                    previous_files=cached_files,
+                )
+            revalidated = True
+
+        cached_roots = cached_files.listed_roots or [ListedRoot()]
+        requested_roots = [
+            root for root in requested_roots 
+            if not any(cached_root.covers(root) for cached_root in cached_roots)
+        ]
+
+    if requested_roots:
+        list_of_files = get_list_of_empiar_files(
+            accession_no, 
+            max_connections, 
+            listing_roots=requested_roots
+        )
+        if cached_files is not None:
+            with cached_files:
+                list_of_files = merge_file_lists(cached_files, list_of_files)
+    elif revalidated or existing_fpath != file_list_fpath:
+        list_of_files = cached_files
     else:
-        list_of_files = get_list_of_empiar_files(accession_no)
-        with open(file_list_fpath, "w") as fh:
-            model_json_str = list_of_files.model_dump_json(indent=2) # type: ignore
-            fh.write(model_json_str)
+        return cached_files
+
+    # Only a listing made entirely against the current entry gets its stamp
+    if entry is not None and (cached_files is None or revalidated):
+        list_of_files.entry_update_date = entry.update_date
+        list_of_files.entry_version_history = entry.version_history
+
+    if not isinstance(list_of_files, EMPIARFileList):
+        with list_of_files:
+            list_of_files = list_of_files.to_file_list()
+    save_file_list_cache(list_of_files, file_list_fpath, compress=cache_format == "binary-zstd")
 
     return list_of_files
 
 
-def read_mrc_header_pyfs(filepath):
+def get_regions_for_empiar_entry(
+        accession_id: str,
+        directive_dict: dict,
+        max_connections: int = DEFAULT_FTP_CONNECTIONS,
+        entry: Optional[Union[Entry, EntryVersion]] = None,
+        refresh: bool = False,
+        cache_format: str = "json",
+        full_refresh: bool = False,
+) -> tuple[list[RegionDirective], EMPIARFileList]:
+    """
+    The regions of a definition file, with any region templates expanded,
+    and the file list they were expanded against (which covers every
+    region's files, and is to be closed once done with; see
+    get_files_for_empiar_entry_cached).
+    """
 
-    ftp_url = 'ftp.ebi.ac.uk'
+    regions = parse_regions(directive_dict)
+    templates = parse_region_templates(directive_dict)
+    empiar_files = get_files_for_empiar_entry_cached(
+        accession_id, 
+        max_connections, 
+        regions + templates, 
+        entry=entry, 
+        refresh=refresh, 
+        cache_format=cache_format, 
+        full_refresh=full_refresh,
+    )
 
-    # Open FTP filesystem
-    with FTPFS(ftp_url) as ftp_fs:
-        # Open file and read only the first 1024 bytes (header)
-        with ftp_fs.open(filepath, 'rb') as f:
-            header_data = f.read(1024)
-    
-    # Parse MRC header - first 40 bytes contain key info
-    # Format: nx, ny, nz, mode, nxstart, nystart, nzstart, mx, my, mz
-    header_ints = struct.unpack('<10i', header_data[:40])
-    
-    # Extract more header info
-    # Bytes 40-52: cell dimensions (3 floats)
-    cell_dims = struct.unpack('<3f', header_data[40:52])
-    
-    # Bytes 52-64: cell angles (3 floats) 
-    cell_angles = struct.unpack('<3f', header_data[52:64])
-    
-    return {
-        'dimensions': header_ints[:3],  # nx, ny, nz
-        'mode': header_ints[3],         # data type
-        'cell_dimensions': cell_dims,
-        'cell_angles': cell_angles
-        # Add more fields as needed
-    }
+    try:
+        regions = regions + expand_region_templates(templates, empiar_files)
+        check_unique_titles(region.title for region in regions)
+    except BaseException:
+        empiar_files.close()
+        raise
+
+    return regions, empiar_files
 
+
+def read_mrc_header_pyfs(
+        filepath: str,
+        pool: Optional[FTPConnectionPool] = None,
+) -> dict:
+
+    if pool is None:
+        # Read only the header, from the configured storage
+        header_data = get_storage().read_range(filepath, 0, MRC_HEADER_SIZE)
+        return decode_mrc_header(header_data)
+
+    # Read only the header over a pooled connection
+    with pool.connection() as ftp_fs:
+        header_data = read_range(ftp_fs, filepath, 0, MRC_HEADER_SIZE)
+    
+    return decode_mrc_header(header_data)
@@ -0,0 +1,136 @@
+"""
+EMPIAR entry metadata from the EMPIAR API, cached on disk.
+
+The API response is cached as raw JSON together with its ETag and
+Last-Modified. A cached response younger than ENTRY_REVALIDATE_AFTER seconds
+is used as is; an older one is revalidated with a conditional request, so
+unchanged entries are never downloaded again. Offline, a cached response is
+used however old it is. Responses are validated straight from the bytes,
+either into the full Entry or, where only the entry's version is needed,
+into the much smaller EntryVersion.
+"""
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+import requests
+from pydantic import BaseModel, TypeAdapter
+
+from . import cache
+from .http_pool import DEFAULT_HTTP_CONNECTIONS, DEFAULT_HTTP_TIMEOUT, get_http_session
+from .models import Entry, VersionHistory
+from .storage import OfflineError, is_offline
+
+
+logger = logging.getLogger("empiar_cets.entry_metadata")
+
+
+EMPIAR_ENTRY_API_URL = "https://www.ebi.ac.uk/empiar/api/entry/"
+ENTRY_REVALIDATE_AFTER = 3600.0
+
+
+class EntryVersion(BaseModel):
+    """The fields of an Entry that identify which state of it a file list was made from"""
+    update_date: Optional[str] = None
+    version_history: Optional[List[VersionHistory]] = None
+
+
+_entries_adapter = TypeAdapter(Dict[str, Entry])
+_entry_versions_adapter = TypeAdapter(Dict[str, EntryVersion])
+
+
+def fetch_entry_json(
+        accession_id: str,
+        max_age: float = ENTRY_REVALIDATE_AFTER,
+) -> bytes:
+    """The EMPIAR API response for an entry, from the cache where it is fresh or unchanged"""
+
+    accession_no = accession_id.split("-")[1]
+    url = f"{EMPIAR_ENTRY_API_URL}{accession_no}"
+    entry_path = cache.cache_path(accession_id, "entry", "entry.json")
+    validators_path = cache.cache_path(accession_id, "entry", "entry.json.http.json")
+
+    validators = None
+    if entry_path.exists():
+        try:
+            with open(validators_path) as fh:
+                validators = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            # Never checked against the API, so revalidate it now
+            validators = {"checked": 0.0}
+        if is_offline() or time.time() - validators["checked"] < max_age:
+            cache.mark_used(entry_path)
+            return entry_path.read_bytes()
+    elif is_offline():
+        raise OfflineError(f"The metadata of entry {accession_id} is not cached, and the EMPIAR API cannot be reached offline")
+
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    try:
+        response = get_http_session().get(url, headers=headers, timeout=DEFAULT_HTTP_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if validators is None:
+            raise
+        logger.warning(f"Could not revalidate entry {accession_id}, using cached copy: {e}")
+        return entry_path.read_bytes()
+
+    if response.status_code == 304:
+        entry_json = entry_path.read_bytes()
+        cache.mark_used(entry_path)
+    else:
+        entry_json = response.content
+        cache.write_bytes_atomic(entry_path, entry_json)
+
+    cache.write_json_atomic(validators_path, {
+        "etag": response.headers.get("ETag", validators and validators.get("etag")),
+        "last_modified": response.headers.get("Last-Modified", validators and validators.get("last_modified")),
+        "checked": time.time(),
+    })
+
+    return entry_json
+
+
+def get_empiar_entry(
+        accession_id: str,
+        max_age: float = ENTRY_REVALIDATE_AFTER,
+) -> Entry:
+    return _entries_adapter.validate_json(fetch_entry_json(accession_id, max_age))[accession_id]
+
+
+def get_empiar_entry_version(
+        accession_id: str,
+        max_age: float = ENTRY_REVALIDATE_AFTER,
+) -> EntryVersion:
+    """Only the update date and version history of an entry, without validating the rest"""
+    return _entry_versions_adapter.validate_json(fetch_entry_json(accession_id, max_age))[accession_id]
+
+
+def prefetch_empiar_entries(
+        accession_ids: Iterable[str],
+        max_workers: int = DEFAULT_HTTP_CONNECTIONS,
+        max_age: float = ENTRY_REVALIDATE_AFTER,
+) -> Dict[str, Optional[str]]:
+    """
+    Fetch (or revalidate) the cached metadata of many entries concurrently,
+    over the shared HTTP session. Returns the error for each entry that
+    could not be fetched, or None.
+    """
+
+    def fetch(accession_id: str) -> Optional[str]:
+        try:
+            fetch_entry_json(accession_id, max_age)
+            return None
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+    accession_ids = list(dict.fromkeys(accession_ids))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return dict(zip(accession_ids, executor.map(fetch, accession_ids)))
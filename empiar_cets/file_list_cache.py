@@ -0,0 +1,311 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from .cache import atomic_write_path
+from .empiar_utils import EMPIARFile, EMPIARFileList, EMPIARFileMatcher, EMPIARFileSequence, _normalise_path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Binary layout (all integers little-endian):
+#
+#   preamble  magic "ECFL", u16 format version, u16 flags, u32 metadata length
+#   metadata  JSON of the EMPIARFileList fields other than files
+#   body      (zstd-compressed if FLAG_ZSTD is set)
+#     u64 counts: strings, string bytes, directories, files
+#     u64[strings + 1]  string offsets into the string bytes
+#     string bytes      utf-8 path components, each stored once, padded to 8
+#     u32[directories]  directory name (string index)
+#     i32[directories]  directory parent (directory index, -1 for the root)
+#     u32[files]        file name (string index)
+#     u32[files]        file parent (directory index)
+#     u64[files]        file size in bytes
+#
+# Directory 0 is the entry's data directory itself, with an empty name.
+
+MAGIC = b"ECFL"
+FORMAT_VERSION = 1
+FLAG_ZSTD = 1
+
+_PREAMBLE = struct.Struct("<4sHHI")
+_COUNTS = struct.Struct("<4Q")
+
+
+def _padding(length: int) -> bytes:
+    return b"\0" * (-length % 8)
+
+
+def _as_array(buffer: memoryview, typecode: str) -> Union[memoryview, array]:
+    """Zero-copy typed view of little-endian data (copied on big-endian hosts)"""
+    if sys.byteorder == "little":
+        return buffer.cast("B").cast(typecode)
+    values = array(typecode, buffer.tobytes())
+    values.byteswap()
+    return values
+
+
+def _to_le_bytes(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_file_list_binary(
+        file_list: EMPIARFileList,
+        filepath: Union[str, Path],
+        compress: bool = False,
+) -> None:
+    """Write a file list in the compact binary format"""
+
+    if compress and zstandard is None:
+        raise ImportError("zstandard is required to write compressed file list caches")
+
+    strings: list[str] = []
+    string_indices: dict[str, int] = {}
+
+    def intern(string: str) -> int:
+        index = string_indices.get(string)
+        if index is None:
+            index = string_indices[string] = len(strings)
+            strings.append(string)
+        return index
+
+    dir_names, dir_parents = array("I", [intern("")]), array("i", [-1])
+    dir_indices: dict[str, int] = {"": 0}
+
+    def directory_index(directory: str) -> int:
+        index = dir_indices.get(directory)
+        if index is None:
+            parent, _, name = directory.rpartition("/")
+            parent_index = directory_index(parent)
+            index = dir_indices[directory] = len(dir_names)
+            dir_names.append(intern(name))
+            dir_parents.append(parent_index)
+        return index
+
+    file_names, file_parents, file_sizes = array("I"), array("I"), array("Q")
+    for index, path in enumerate(file_list.iter_paths()):
+        directory, _, name = path.rpartition("/")
+        file_parents.append(directory_index(directory))
+        file_names.append(intern(name))
+        file_sizes.append(file_list.files.size(index))
+
+    encoded_strings = [string.encode("utf-8") for string in strings]
+    string_offsets = array("Q", [0])
+    for encoded in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+    string_bytes = b"".join(encoded_strings)
+
+    body = b"".join([
+        _COUNTS.pack(len(strings), len(string_bytes), len(dir_names), len(file_names)),
+        _to_le_bytes(string_offsets),
+        string_bytes, _padding(len(string_bytes)),
+        _to_le_bytes(dir_names),
+        _to_le_bytes(dir_parents),
+        _to_le_bytes(file_names),
+        _to_le_bytes(file_parents),
+        _to_le_bytes(file_sizes),
+    ])
+
+    flags = 0
+    if compress:
+        body = zstandard.ZstdCompressor().compress(body)
+        flags |= FLAG_ZSTD
+
+    metadata = json.dumps(file_list.model_dump(mode="json", exclude={"files"})).encode("utf-8")
+    metadata += _padding(_PREAMBLE.size + len(metadata))
+
+    with open(filepath, "wb") as fh:
+        fh.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, flags, len(metadata)))
+        fh.write(metadata)
+        fh.write(body)
+
+
+class EMPIARFileListView:
+    """
+    Read-only EMPIARFileList backed by the binary cache format.
+
+    Uncompressed files are memory-mapped and read in place; EMPIARFile models
+    and path strings are only built for the files that are accessed. The
+    non-file fields of EMPIARFileList (listed_roots, directory_mtimes, ...)
+    are available as attributes. Close the view (or use it as a context
+    manager) to unmap the file.
+    """
+
+    def __init__(self, filepath: Union[str, Path]):
+        self.filepath = Path(filepath)
+        with open(self.filepath, "rb") as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        magic, version, flags, metadata_length = _PREAMBLE.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{self.filepath} is not a version {FORMAT_VERSION} file list cache")
+        offset = _PREAMBLE.size
+        metadata = json.loads(bytes(buffer[offset:offset + metadata_length]).rstrip(b"\0"))
+        self.header = EMPIARFileList.model_validate({**metadata, "files": []})
+        offset += metadata_length
+
+        body = buffer[offset:]
+        if flags & FLAG_ZSTD:
+            if zstandard is None:
+                raise ImportError("zstandard is required to read compressed file list caches")
+            body = memoryview(zstandard.ZstdDecompressor().decompress(bytes(body)))
+
+        n_strings, n_string_bytes, n_dirs, n_files = _COUNTS.unpack_from(body)
+        offset = _COUNTS.size
+
+        def take(typecode: str, count: int, itemsize: int):
+            nonlocal offset
+            values = _as_array(body[offset:offset + count * itemsize], typecode)
+            offset += count * itemsize
+            return values
+
+        self._string_offsets = take("Q", n_strings + 1, 8)
+        self._string_bytes = body[offset:offset + n_string_bytes]
+        offset += n_string_bytes + (-n_string_bytes % 8)
+        self._dir_names = take("I", n_dirs, 4)
+        self._dir_parents = take("i", n_dirs, 4)
+        self._file_names = take("I", n_files, 4)
+        self._file_parents = take("I", n_files, 4)
+        self._file_sizes = take("Q", n_files, 8)
+
+        self._strings: dict[int, str] = {}
+        self._dir_paths: dict[int, str] = {}
+        self._file_indices: Optional[dict[str, int]] = None
+        self._matcher: Optional[EMPIARFileMatcher] = None
+
+    def close(self) -> None:
+        """Unmap the cache file; the view cannot be read afterwards"""
+        if self._mmap is None:
+            return
+        # The mmap cannot be closed while views into it are alive
+        for values in (
+                self._string_offsets, self._string_bytes, self._dir_names, self._dir_parents,
+                self._file_names, self._file_parents, self._file_sizes,
+        ):
+            if isinstance(values, memoryview):
+                values.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self) -> "EMPIARFileListView":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __getattr__(self, name: str):
+        if name == "header":
+            raise AttributeError(name)
+        return getattr(self.header, name)
+
+    def _string(self, index: int) -> str:
+        string = self._strings.get(index)
+        if string is None:
+            start, end = self._string_offsets[index], self._string_offsets[index + 1]
+            string = self._strings[index] = bytes(self._string_bytes[start:end]).decode("utf-8")
+        return string
+
+    def _dir_path(self, index: int) -> str:
+        path = self._dir_paths.get(index)
+        if path is None:
+            parent = self._dir_parents[index]
+            name = self._string(self._dir_names[index])
+            path = name if parent <= 0 else f"{self._dir_path(parent)}/{name}"
+            self._dir_paths[index] = path
+        return path
+
+    def path(self, index: int) -> str:
+        directory = self._dir_path(self._file_parents[index])
+        name = self._string(self._file_names[index])
+        return f"{directory}/{name}" if directory else name
+
+    def size(self, index: int) -> int:
+        return self._file_sizes[index]
+
+    def __len__(self) -> int:
+        return len(self._file_sizes)
+
+    def __getitem__(self, index: int) -> EMPIARFile:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return EMPIARFile(path=self.path(index), size_in_bytes=self._file_sizes[index])
+
+    def __iter__(self) -> Iterator[EMPIARFile]:
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def files(self) -> "EMPIARFileListView":
+        return self
+
+    def iter_paths(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self.path(index)
+
+    def get(self, path: Union[str, Path]) -> Optional[EMPIARFile]:
+        """Look up a file by its path relative to the entry's data directory"""
+        if self._file_indices is None:
+            self._file_indices = {path: index for index, path in enumerate(self.iter_paths())}
+        index = self._file_indices.get(_normalise_path(str(path)))
+        return None if index is None else self[index]
+
+    @property
+    def matcher(self) -> EMPIARFileMatcher:
+        if self._matcher is None:
+            self._matcher = EMPIARFileMatcher(self.iter_paths())
+        return self._matcher
+
+    def to_file_list(self) -> EMPIARFileList:
+        """Materialise the full EMPIARFileList"""
+        files = EMPIARFileSequence()
+        for index, path in enumerate(self.iter_paths()):
+            files.append_path(path, self.size(index))
+        return self.header.model_copy(update={"files": files})
+
+
+def read_file_list_binary(filepath: Union[str, Path]) -> EMPIARFileListView:
+    return EMPIARFileListView(filepath)
+
+
+def load_file_list_cache(
+        filepath: Union[str, Path],
+) -> Union[EMPIARFileList, EMPIARFileListView]:
+    """Load a file list cache, in the binary format (.bin) or as JSON"""
+
+    filepath = Path(filepath)
+    if filepath.suffix == ".bin":
+        return read_file_list_binary(filepath)
+
+    with open(filepath) as fh:
+        model_data = json.load(fh)
+    return EMPIARFileList.model_validate(model_data)
+
+
+def save_file_list_cache(
+        file_list: EMPIARFileList,
+        filepath: Union[str, Path],
+        compress: bool = False,
+) -> None:
+    """Save a file list cache, in the binary format (.bin) or as JSON"""
+
+    filepath = Path(filepath)
+    # Replaced atomically, as a binary cache may be memory-mapped by a reader
+    with atomic_write_path(filepath) as temp_path:
+        if filepath.suffix == ".bin":
+            write_file_list_binary(file_list, temp_path, compress=compress)
+        else:
+            with open(temp_path, "w") as fh:
+                fh.write(file_list.model_dump_json(indent=2))
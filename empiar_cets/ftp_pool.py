@@ -0,0 +1,193 @@
+import ftplib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from fs.base import FS
+from fs.errors import ResourceNotFound
+from fs.ftpfs import FTPFS
+
+from .defaults import DEFAULT_FTP_CONNECTIONS
+
+
+logger = logging.getLogger("empiar_cets.ftp_pool")
+
+
+EMPIAR_FTP_HOST = "ftp.ebi.ac.uk"
+DEFAULT_KEEPALIVE_INTERVAL = 30.0
+ABORT_REPLY_TIMEOUT = 10.0
+
+
+class FTPConnectionPool:
+    """
+    Bounded pool of reusable FTP filesystem connections (or, with
+    fs_factory, connections to any pyfilesystem2 filesystem).
+
+    At most max_size connections are checked out at once; callers beyond that
+    block until one is returned. Idle connections are kept open and, if they
+    have been idle for longer than keepalive_interval seconds, checked with a
+    NOOP before being handed out again. A connection whose use raised an
+    error (other than a missing resource) is discarded rather than returned.
+    """
+
+    def __init__(
+            self,
+            host: str = EMPIAR_FTP_HOST,
+            max_size: int = DEFAULT_FTP_CONNECTIONS,
+            keepalive_interval: float = DEFAULT_KEEPALIVE_INTERVAL,
+            fs_factory: Optional[Callable[[], FS]] = None,
+    ):
+        self.host = host
+        self.max_size = max(1, max_size)
+        self.keepalive_interval = keepalive_interval
+        self._fs_factory = fs_factory or (lambda: FTPFS(host))
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._lock = threading.Lock()
+        self._idle: list[tuple[FS, float]] = []
+
+    def _is_healthy(self, fs: FS) -> bool:
+        ftp = getattr(fs, "ftp", None)
+        if ftp is None:
+            return True
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except (ftplib.all_errors, EOFError):
+            return False
+
+    def _checkout(self) -> FS:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                fs, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.keepalive_interval or self._is_healthy(fs):
+                return fs
+            logger.debug(f"Discarding stale FTP connection to {self.host}")
+            self._discard(fs)
+        return self._fs_factory()
+
+    def _discard(self, fs: FS) -> None:
+        try:
+            fs.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self) -> Iterator[FS]:
+        """Check out a connection for the duration of the with block"""
+        with self._slots:
+            fs = self._checkout()
+            try:
+                yield fs
+            except ResourceNotFound:
+                self._release(fs)
+                raise
+            except BaseException:
+                self._discard(fs)
+                raise
+            else:
+                self._release(fs)
+
+    def _release(self, fs: FS) -> None:
+        with self._lock:
+            self._idle.append((fs, time.monotonic()))
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for fs, _ in idle:
+            self._discard(fs)
+
+
+_shared_pool: Optional[FTPConnectionPool] = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_ftp_pool(max_size: Optional[int] = None) -> FTPConnectionPool:
+    """
+    The process-wide pool of connections to the EMPIAR FTP server.
+
+    max_size only takes effect when the pool is first created (or after
+    close_ftp_pool).
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = FTPConnectionPool(max_size=max_size or DEFAULT_FTP_CONNECTIONS)
+        return _shared_pool
+
+
+def close_ftp_pool() -> None:
+    global _shared_pool
+    with _shared_pool_lock:
+        pool, _shared_pool = _shared_pool, None
+    if pool is not None:
+        pool.close()
+
+
+def _abort_transfer(ftp: ftplib.FTP, timeout: float = ABORT_REPLY_TIMEOUT) -> None:
+    # Once the data connection is closed, the server sends one final reply to
+    # the RETR (426 if it was cut short, 226 if it had completed). Servers
+    # differ on the ABOR: most answer it as well (226, or 225 if no transfer
+    # was left to abort), some stay silent when the transfer had already
+    # ended. Read the RETR's reply, then send a NOOP and skip any ABOR reply
+    # until the NOOP's 200 arrives, so the control connection is back in step
+    # either way. The short timeout bounds the wait on a wedged server; any
+    # error raises, and the pool discards the connection.
+    ftp.putcmd("ABOR")
+    previous_timeout = ftp.sock.gettimeout()
+    ftp.sock.settimeout(timeout)
+    try:
+        transfer_reply = ftp.getmultiline()
+        if transfer_reply[:3] not in ("225", "226", "250", "426", "451"):
+            raise ftplib.error_reply(transfer_reply)
+        ftp.putcmd("NOOP")
+        while True:
+            reply = ftp.getmultiline()
+            if reply[:3] == "200":
+                break
+            if reply[:3] not in ("225", "226", "426"):
+                raise ftplib.error_reply(reply)
+    finally:
+        ftp.sock.settimeout(previous_timeout)
+
+
+def read_range(fs: FS, path: str, offset: int, length: int) -> bytes:
+    """
+    Read length bytes from offset of a file, over the filesystem's existing
+    connection.
+
+    On an FTPFS this issues REST + RETR on the pooled control connection and
+    aborts the transfer once enough data has arrived, instead of opening a
+    new FTP session per file as FTPFS.openbin does.
+    """
+    ftp = getattr(fs, "ftp", None)
+    if not isinstance(ftp, ftplib.FTP):
+        with fs.openbin(path) as fh:
+            fh.seek(offset)
+            return fh.read(length)
+
+    ftp.voidcmd("TYPE I")
+    try:
+        conn = ftp.transfercmd(f"RETR {path}", rest=offset or None)
+    except ftplib.error_perm as e:
+        if str(e).startswith("550"):
+            raise ResourceNotFound(path) from e
+        raise
+
+    chunks, remaining = [], length
+    try:
+        while remaining > 0:
+            chunk = conn.recv(min(remaining, 65536))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+    finally:
+        conn.close()
+    _abort_transfer(ftp)
+
+    return b"".join(chunks)
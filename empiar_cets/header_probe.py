@@ -0,0 +1,238 @@
+import base64
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from .cache import cache_path, mark_used
+from .empiar_utils import EMPIARFile, EMPIARFileList, get_files_matching_pattern
+from .ftp_pool import DEFAULT_FTP_CONNECTIONS
+from .mrc_header import MRC_HEADER_SIZE, decode_mrc_headers, mrc_header_to_dict
+from .storage import EntryStorage, get_storage
+from .yaml_parsing import RegionDirective
+
+
+logger = logging.getLogger("empiar_cets.header_probe")
+
+
+MRC_FILE_EXTENSIONS = (".mrc", ".mrcs", ".st", ".ali", ".rec", ".map")
+MRC_HEADER_CACHE_NAME = "mrc_headers"
+
+# Entries already read or written by this process, by (accession, cache
+# name), and the (inode, offset) up to which the cache file has been read
+_loaded_headers: dict[tuple[str, str], dict[str, Any]] = {}
+_loaded_offsets: dict[tuple[str, str], tuple[int, int]] = {}
+_loaded_headers_lock = threading.Lock()
+
+
+def header_cache_key(file: EMPIARFile) -> str:
+    return f"{file.path}:{file.size_in_bytes}"
+
+
+def _header_cache_path(accession_id: str, cache_name: str) -> Path:
+    # One file per entry and cache, appended to a batch at a time, rather
+    # than one file per header: thousands of tiny files are slow to create
+    # and scan on shared storage. Each line is one {"key", "value"} record;
+    # concurrent appends from several machines may tear a line, which is
+    # then skipped on reading, so its header is probed again.
+    return cache_path(accession_id, "headers", f"{cache_name}.jsonl")
+
+
+def _read_header_cache(accession_id: str, cache_name: str) -> None:
+    """Read the records appended to a header cache since this process last read it"""
+
+    header_cache_path = _header_cache_path(accession_id, cache_name)
+    key = (accession_id, cache_name)
+    corrupt_lines = 0
+    with _loaded_headers_lock:
+        try:
+            with open(header_cache_path, "rb") as fh:
+                stat = os.fstat(fh.fileno())
+                inode, offset = _loaded_offsets.get(key, (stat.st_ino, 0))
+                if inode != stat.st_ino or offset > stat.st_size:
+                    # Evicted and written again since it was last read
+                    offset = 0
+                fh.seek(offset)
+                data = fh.read()
+        except FileNotFoundError:
+            return
+
+        # A last line without a newline may still be being appended
+        end = data.rfind(b"\n") + 1
+        loaded = _loaded_headers.setdefault(key, {})
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+                loaded[record["key"]] = record["value"]
+            except (ValueError, KeyError, TypeError):
+                corrupt_lines += 1
+        _loaded_offsets[key] = (stat.st_ino, offset + end)
+
+    if corrupt_lines:
+        logger.warning(f"Skipped {corrupt_lines} corrupt records in {header_cache_path}")
+    mark_used(header_cache_path)
+
+
+def load_header_cache(accession_id: str, cache_name: str, keys: Iterable[str]) -> dict[str, Any]:
+    """The cached entries for those of keys that have one"""
+
+    keys = list(keys)
+    with _loaded_headers_lock:
+        loaded = _loaded_headers.setdefault((accession_id, cache_name), {})
+        all_loaded = all(key in loaded for key in keys)
+    if not all_loaded:
+        _read_header_cache(accession_id, cache_name)
+
+    with _loaded_headers_lock:
+        return {key: loaded[key] for key in keys if key in loaded}
+
+
+def update_header_cache(accession_id: str, cache_name: str, entries: dict[str, Any]) -> None:
+    """Add entries to a header cache, on disk and in this process"""
+
+    if not entries:
+        return
+    data = "".join(
+        json.dumps({"key": key, "value": entry}) + "\n" for key, entry in entries.items()
+    ).encode("utf-8")
+    # A single O_APPEND write, so that the batch lands after any other
+    # writer's complete batch, starting on a new line if an earlier writer
+    # was cut off mid-line
+    fd = os.open(_header_cache_path(accession_id, cache_name), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b"\n":
+            data = b"\n" + data
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    with _loaded_headers_lock:
+        _loaded_headers.setdefault((accession_id, cache_name), {}).update(entries)
+
+
+def fetch_file_starts(
+        accession_id: str,
+        files: Iterable[EMPIARFile],
+        length: int,
+        max_workers: int = DEFAULT_FTP_CONNECTIONS,
+        storage: Optional[EntryStorage] = None,
+) -> dict[str, bytes]:
+    """Read the first length bytes of each file concurrently, keyed by path"""
+
+    if storage is None:
+        storage = get_storage(max_workers)
+    accession_no = accession_id.split("-")[1]
+
+    def fetch(file: EMPIARFile) -> bytes:
+        return storage.read_range(storage.file_path(accession_no, str(file.path)), 0, length)
+
+    files = list(files)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = executor.map(fetch, files)
+        return {str(file.path): data for file, data in zip(files, results)}
+
+
+def lookup_files(empiar_files: EMPIARFileList, paths: Iterable[str]) -> list[EMPIARFile]:
+    files = []
+    for path in paths:
+        file = empiar_files.get(path)
+        if file is None:
+            raise ValueError(f"File not found in EMPIAR file list: {path}")
+        files.append(file)
+    return files
+
+
+def _decode_cached_mrc_header(entry: Any) -> Optional[bytes]:
+    # None for an entry that is not a base64-encoded full header
+    try:
+        header_data = base64.b64decode(entry, validate=True)
+    except (TypeError, ValueError):
+        return None
+    return header_data if len(header_data) == MRC_HEADER_SIZE else None
+
+
+def _is_plausible_mrc_header(header_data: bytes) -> bool:
+    # Every axis of a real map or stack has at least one sample
+    return all(n > 0 for n in mrc_header_to_dict(decode_mrc_headers(header_data)[0])["dimensions"])
+
+
+def probe_mrc_headers(
+        accession_id: str,
+        empiar_files: EMPIARFileList,
+        paths: Iterable[str],
+        max_workers: int = DEFAULT_FTP_CONNECTIONS,
+) -> dict[str, dict]:
+    """
+    Get the MRC headers of many files of an entry, keyed by path.
+
+    Headers are cached on disk and in memory (raw bytes, keyed by path and
+    size in bytes), so probing a batch up front makes later lookups cheap;
+    any that are not cached are fetched concurrently with ranged reads from
+    the configured storage. A file whose header is short or not a plausible
+    MRC header is left out, with a warning, and not cached; a corrupt cache
+    entry is fetched again.
+    """
+
+    files = lookup_files(empiar_files, dict.fromkeys(paths))
+    cache = load_header_cache(accession_id, MRC_HEADER_CACHE_NAME, [header_cache_key(file) for file in files])
+
+    headers = {}
+    for file in files:
+        entry = cache.get(header_cache_key(file))
+        header_data = None if entry is None else _decode_cached_mrc_header(entry)
+        if header_data is not None:
+            headers[str(file.path)] = header_data
+
+    missing_files = [file for file in files if str(file.path) not in headers]
+    if missing_files:
+        logger.info(f"Probing {len(missing_files)} MRC headers for {accession_id}")
+        fetched = fetch_file_starts(accession_id, missing_files, MRC_HEADER_SIZE, max_workers)
+
+        new_entries = {}
+        for file in missing_files:
+            header_data = fetched[str(file.path)]
+            if len(header_data) < MRC_HEADER_SIZE:
+                logger.warning(f"Short read of MRC header for {file.path}: {len(header_data)} bytes, skipping")
+                continue
+            if not _is_plausible_mrc_header(header_data):
+                logger.warning(f"Header of {file.path} is not a valid MRC header, skipping")
+                continue
+            headers[str(file.path)] = header_data
+            new_entries[header_cache_key(file)] = base64.b64encode(header_data).decode("ascii")
+        update_header_cache(accession_id, MRC_HEADER_CACHE_NAME, new_entries)
+
+    # Decode all headers as one array operation
+    probed_paths = [str(file.path) for file in files if str(file.path) in headers]
+    records = decode_mrc_headers(headers[path] for path in probed_paths)
+
+    return {path: mrc_header_to_dict(record) for path, record in zip(probed_paths, records)}
+
+
+def get_mrc_header_cached(
+        accession_id: str,
+        empiar_files: EMPIARFileList,
+        path: str,
+) -> Optional[dict]:
+    return probe_mrc_headers(accession_id, empiar_files, [path]).get(path)
+
+
+def get_mrc_paths_for_regions(
+        empiar_files: EMPIARFileList,
+        regions: Iterable[RegionDirective],
+) -> list[str]:
+    """Paths of the tomograms and MRC-format tilt series of the regions"""
+
+    paths = []
+    for region in regions:
+        for tomogram in region.tomograms or []:
+            paths.extend(get_files_matching_pattern(empiar_files, tomogram.file_pattern))
+        for tilt_series in region.tilt_series or []:
+            paths.extend(
+                path for path in get_files_matching_pattern(empiar_files, tilt_series.file_pattern)
+                if path.lower().endswith(MRC_FILE_EXTENSIONS)
+            )
+
+    return list(dict.fromkeys(paths))
@@ -0,0 +1,55 @@
+import os
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+EMPIAR_HTTPS_BASE_URL = "https://ftp.ebi.ac.uk/empiar/world_availability/"
+DEFAULT_HTTP_CONNECTIONS = 8
+DEFAULT_HTTP_TIMEOUT = 60.0
+
+
+_shared_session: Optional[requests.Session] = None
+_shared_session_pid: Optional[int] = None
+_shared_session_lock = threading.Lock()
+
+
+def _make_session(max_connections: int) -> requests.Session:
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_http_session(max_connections: int = DEFAULT_HTTP_CONNECTIONS) -> requests.Session:
+    """
+    The process-wide keep-alive HTTP session, whose connections are reused
+    across requests and threads.
+
+    A process forked from one holding the session gets a session of its own
+    rather than sharing the parent's sockets.
+    """
+    global _shared_session, _shared_session_pid
+    with _shared_session_lock:
+        if _shared_session is None or _shared_session_pid != os.getpid():
+            _shared_session = _make_session(max_connections)
+            _shared_session_pid = os.getpid()
+        return _shared_session
+
+
+def close_http_session() -> None:
+    global _shared_session
+    with _shared_session_lock:
+        session, _shared_session = _shared_session, None
+    if session is not None:
+        session.close()
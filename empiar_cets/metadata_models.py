@@ -1,12 +1,28 @@
-from typing import Dict, List, Optional, Any
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Any, Union
 from dataclasses import dataclass, field
 
+import numpy as np
+
+
+# Format of the DateTime values SerialEM writes, e.g. "30-Jun-23  14:02:13"
+MDOC_DATETIME_FORMAT = "%d-%b-%y %H:%M:%S"
+
+
+def subframe_file_name(path: str) -> str:
+    """Case-folded file name of a path written on Windows or POSIX"""
+    return path.replace("\\", "/").rsplit("/", 1)[-1].casefold()
+
 
 @dataclass
 class ZValueSection:
     """Represents a single [ZValue = n] section from an .mdoc file"""
     z_value: int
     metadata: Dict[str, Any] = field(default_factory=dict)
+    # The MdocFile holding this section, whose cached columns are
+    # invalidated when the section is changed through __setitem__
+    parent: Optional['MdocFile'] = field(default=None, repr=False, compare=False)
     
     def __getitem__(self, key: str) -> Any:
         """Allow dictionary-style access to metadata"""
@@ -15,6 +31,8 @@ class ZValueSection:
     def __setitem__(self, key: str, value: Any) -> None:
         """Allow dictionary-style setting of metadata"""
         self.metadata[key] = value
+        if self.parent is not None:
+            self.parent.z_sections.generation += 1
     
     def get(self, key: str, default: Any = None) -> Any:
         """Get metadata value with optional default"""
@@ -35,6 +53,58 @@ class ZValueSection:
         return section
 
 
+def _mutates(method_name: str) -> Callable:
+    list_method = getattr(list, method_name)
+
+    def method(self, *args, **kwargs):
+        result = list_method(self, *args, **kwargs)
+        self._adopt_all()
+        return result
+
+    method.__name__ = method_name
+    return method
+
+
+class _SectionList(list):
+    """
+    List of the ZValueSections of an MdocFile, counting changes in generation
+    so that the file's cached columns know when to be rebuilt.
+    """
+
+    # Class-level defaults, as unpickling adds items before restoring state
+    owner: Optional['MdocFile'] = None
+    generation: int = 0
+
+    def __init__(self, sections: Iterable[ZValueSection] = (), owner: Optional['MdocFile'] = None):
+        super().__init__(sections)
+        self.owner = owner
+        self._adopt_all()
+
+    def _adopt_all(self) -> None:
+        self.generation += 1
+        if self.owner is not None:
+            for section in self:
+                section.parent = self.owner
+
+    def append(self, section: ZValueSection) -> None:
+        list.append(self, section)
+        if self.owner is not None:
+            section.parent = self.owner
+        self.generation += 1
+
+    extend = _mutates("extend")
+    insert = _mutates("insert")
+    pop = _mutates("pop")
+    remove = _mutates("remove")
+    clear = _mutates("clear")
+    sort = _mutates("sort")
+    reverse = _mutates("reverse")
+    __setitem__ = _mutates("__setitem__")
+    __delitem__ = _mutates("__delitem__")
+    __iadd__ = _mutates("__iadd__")
+    __imul__ = _mutates("__imul__")
+
+
 @dataclass
 class MdocFile:
     """Represents a parsed .mdoc file with global headers and ZValue sections"""
@@ -42,6 +112,15 @@ class MdocFile:
     global_headers: Dict[str, Any] = field(default_factory=dict)
     z_sections: List[ZValueSection] = field(default_factory=list)
     comments: List[str] = field(default_factory=list)
+    # Columns and indexes built from the sections, keyed by (key, kind), and
+    # the z_sections generation they were built at
+    _derived: Dict[tuple, Any] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _derived_generation: int = field(default=-1, init=False, repr=False, compare=False)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name == "z_sections" and not (isinstance(value, _SectionList) and value.owner is self):
+            value = _SectionList(value, owner=self)
+        super().__setattr__(name, value)
     
     def __len__(self) -> int:
         """Return number of Z sections"""
@@ -53,10 +132,7 @@ class MdocFile:
     
     def get_section_by_z_value(self, z_value: int) -> Optional[ZValueSection]:
         """Get a section by its Z value"""
-        for section in self.z_sections:
-            if section.z_value == z_value:
-                return section
-        return None
+        return self.z_value_index().get(z_value)
     
     def search_by_subframe_path(self, search_string: str, case_sensitive: bool = False) -> List[ZValueSection]:
         """
@@ -69,44 +145,157 @@ class MdocFile:
         Returns:
             List of ZValueSection objects that match the criteria
         """
-        matches = []
-        
-        for section in self.z_sections:
-            subframe_path = section.get('SubFramePath', '')
-            if not subframe_path:
-                continue
-                
-            # Convert to string if not already
-            subframe_path = str(subframe_path)
-            
-            # Perform case-insensitive comparison if requested
-            if not case_sensitive:
-                subframe_path = subframe_path.lower()
-                search_string = search_string.lower()
-            
-            # Check if the path ends with the search string
-            if subframe_path.endswith(search_string):
-                matches.append(section)
-        
-        return matches
+        if case_sensitive:
+            subframe_paths = self.string_column('SubFramePath')
+        else:
+            subframe_paths = self._cached(
+                'SubFramePath', "lower", 
+                lambda: [path.lower() if path else path for path in self.string_column('SubFramePath')]
+            )
+            search_string = search_string.lower()
+
+        return [
+            section for section, path in zip(self.z_sections, subframe_paths)
+            if path and path.endswith(search_string)
+        ]
     
+    def _cached(self, key: str, kind: str, build: Callable[[], Any]) -> Any:
+        if self._derived_generation != self.z_sections.generation:
+            self._derived.clear()
+            self._derived_generation = self.z_sections.generation
+        value = self._derived.get((key, kind))
+        if value is None:
+            value = self._derived[(key, kind)] = build()
+        return value
+
+    def _cached_column(self, key: str, kind: str, build: Callable[[], np.ndarray]) -> np.ndarray:
+        def build_read_only() -> np.ndarray:
+            column = build()
+            column.flags.writeable = False
+            return column
+        return self._cached(key, kind, build_read_only)
+
+    def z_value_index(self) -> Dict[int, ZValueSection]:
+        """Sections by Z value (the first, if a Z value is repeated)"""
+        def build() -> Dict[int, ZValueSection]:
+            index = {}
+            for section in self.z_sections:
+                index.setdefault(section.z_value, section)
+            return index
+        return self._cached("", "z_value_index", build)
+
+    def subframe_name_index(self) -> Dict[str, List[ZValueSection]]:
+        """Sections by the case-folded file name of their SubFramePath"""
+        def build() -> Dict[str, List[ZValueSection]]:
+            index = {}
+            for section, path in zip(self.z_sections, self.string_column('SubFramePath')):
+                if path:
+                    index.setdefault(subframe_file_name(path), []).append(section)
+            return index
+        return self._cached('SubFramePath', "name_index", build)
+
+    def get_sections_by_subframe_name(self, file_name: str) -> List[ZValueSection]:
+        """Sections whose SubFramePath has this file name, ignoring case and directories"""
+        return self.subframe_name_index().get(subframe_file_name(file_name), [])
+
+    def z_values(self) -> np.ndarray:
+        """Z values of the sections, in file order"""
+        return self._cached_column(
+            "", "z_value", lambda: np.fromiter((s.z_value for s in self.z_sections), dtype=np.int64, count=len(self))
+        )
+
+    def numeric_column(self, key: str) -> np.ndarray:
+        """
+        Values of a numeric key across the sections as a float array, NaN
+        where a section lacks the key or its value is not a number
+        """
+        def build() -> np.ndarray:
+            column = np.full(len(self), np.nan)
+            for i, section in enumerate(self.z_sections):
+                value = section.metadata.get(key)
+                if isinstance(value, (int, float)):
+                    column[i] = value
+                elif value is not None:
+                    try:
+                        column[i] = float(value)
+                    except ValueError:
+                        pass
+            return column
+
+        return self._cached_column(key, "numeric", build)
+
+    def string_column(self, key: str) -> np.ndarray:
+        """Values of a key across the sections as an object array, None where missing"""
+        def build() -> np.ndarray:
+            column = np.empty(len(self), dtype=object)
+            column[:] = [
+                None if (value := section.metadata.get(key)) is None else str(value)
+                for section in self.z_sections
+            ]
+            return column
+
+        return self._cached_column(key, "string", build)
+
+    def datetime_column(self, key: str = 'DateTime') -> np.ndarray:
+        """Values of a SerialEM date-time key as datetime64, NaT where missing or unparsable"""
+        def build() -> np.ndarray:
+            column = np.full(len(self), np.datetime64("NaT"), dtype="datetime64[s]")
+            for i, value in enumerate(self.string_column(key)):
+                if value is None:
+                    continue
+                try:
+                    column[i] = datetime.strptime(" ".join(value.split()), MDOC_DATETIME_FORMAT)
+                except ValueError:
+                    pass
+            return column
+
+        return self._cached_column(key, "datetime", build)
+
     def get_tilt_angles(self) -> List[float]:
         """Get all tilt angles from the Z sections"""
-        angles = []
-        for section in self.z_sections:
-            angle = section.get('TiltAngle')
-            if angle is not None:
-                angles.append(float(angle))
-        return angles
+        angles = self.numeric_column('TiltAngle')
+        return angles[~np.isnan(angles)].tolist()
     
     def get_subframe_paths(self) -> List[str]:
         """Get all SubFramePath values"""
-        paths = []
-        for section in self.z_sections:
-            path = section.get('SubFramePath')
-            if path:
-                paths.append(str(path))
-        return paths
+        return [path for path in self.string_column('SubFramePath') if path]
+
+    def acquisition_order(self) -> np.ndarray:
+        """
+        Indices of the sections in the order they were acquired: by DateTime
+        where every section has one, otherwise by Z value
+        """
+        acquired = self.datetime_column()
+        if len(acquired) and not np.isnat(acquired).any():
+            return np.lexsort((self.z_values(), acquired))
+        return np.argsort(self.z_values(), kind="stable")
+
+    def select(self, selection: Union[np.ndarray, Iterable[int]]) -> 'MdocFile':
+        """
+        A copy holding only the selected sections, given as a boolean mask
+        or as indices (in the order given); its sections' metadata are
+        copies, so changing them leaves this file (and its columns) as is
+        """
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            selection = np.flatnonzero(selection)
+        return MdocFile(
+            filename=self.filename,
+            global_headers=self.global_headers,
+            z_sections=[
+                ZValueSection(z_value=self.z_sections[i].z_value, metadata=dict(self.z_sections[i].metadata))
+                for i in selection.tolist()
+            ],
+            comments=self.comments,
+        )
+
+    def sorted_by_acquisition(self) -> 'MdocFile':
+        return self.select(self.acquisition_order())
+
+    def filter_by_tilt_angle(self, min_angle: float = -np.inf, max_angle: float = np.inf) -> 'MdocFile':
+        """Sections whose tilt angle lies within [min_angle, max_angle]"""
+        angles = self.numeric_column('TiltAngle')
+        return self.select((angles >= min_angle) & (angles <= max_angle))
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert MdocFile to dictionary for JSON serialization"""
@@ -131,3 +320,93 @@ class MdocFile:
         ]
         return mdoc
 
+
+
+@dataclass
+class XFAlignment:
+    """
+    IMOD .xf alignment: one row of a11 a12 a21 a22 dx dy per projection,
+    mapping x' = A x + d
+    """
+    transforms: np.ndarray = field(default_factory=lambda: np.empty((0, 6)))
+    # Line of the .xf file each transform came from, which names its projection
+    projection_indices: Optional[np.ndarray] = None
+
+    def __post_init__(self) -> None:
+        self.transforms = np.asarray(self.transforms, dtype=np.float64).reshape(-1, 6)
+        if self.projection_indices is None:
+            self.projection_indices = np.arange(len(self.transforms))
+        self.projection_indices = np.asarray(self.projection_indices, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.transforms)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, XFAlignment):
+            return NotImplemented
+        return (
+            np.array_equal(self.transforms, other.transforms) 
+            and np.array_equal(self.projection_indices, other.projection_indices)
+        )
+
+    @property
+    def affines(self) -> np.ndarray:
+        """(N, 2, 2) linear parts"""
+        return self.transforms[:, :4].reshape(-1, 2, 2)
+
+    @property
+    def translations(self) -> np.ndarray:
+        """(N, 2) shifts"""
+        return self.transforms[:, 4:]
+
+    def determinants(self) -> np.ndarray:
+        a11, a12, a21, a22 = self.transforms[:, :4].T
+        return a11 * a22 - a12 * a21
+
+    def degenerate_projections(self, min_abs_determinant: float = 1e-6) -> np.ndarray:
+        """Projection indices whose transform is singular (or not finite)"""
+        determinants = self.determinants()
+        degenerate = ~np.isfinite(self.transforms).all(axis=1) | ~(np.abs(determinants) >= min_abs_determinant)
+        return self.projection_indices[degenerate]
+
+    def composed_matrices(self) -> np.ndarray:
+        """(N, 3, 3) homogeneous matrices applying the affine then the shift"""
+        matrices = np.zeros((len(self), 3, 3))
+        matrices[:, :2, :2] = self.affines
+        matrices[:, :2, 2] = self.translations
+        matrices[:, 2, 2] = 1.0
+        return matrices
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Expand to the verbose transform-sequence dict (see parse_xf_file)"""
+        projection_alignments = []
+        for i, (a11, a12, a21, a22, dx, dy) in zip(self.projection_indices.tolist(), self.transforms.tolist()):
+            projection_alignments.append({
+                "type": "sequence",
+                "name": f"alignment_projection_{i}",
+                "sequence": [
+                    {
+                        "type": "affine",
+                        "name": f"rotation_projection_{i}",
+                        "output": f"rotated_projection_{i}",
+                        "affine": [[a11, a12, 0.0], [a21, a22, 0.0], [0.0, 0.0, 1.0]],
+                    },
+                    {
+                        "type": "translation",
+                        "name": f"translation_projection_{i}",
+                        "input": f"rotated_projection_{i}",
+                        "translation": [dx, dy],
+                    },
+                ],
+            })
+        return {"projection_alignments": projection_alignments}
+
+    def save(self, filepath: Union[str, Path]) -> None:
+        """Save as an uncompressed .npz of the two arrays"""
+        with open(filepath, "wb") as fh:
+            np.savez(fh, transforms=self.transforms, projection_indices=self.projection_indices)
+
+    @classmethod
+    def load(cls, filepath: Union[str, Path]) -> 'XFAlignment':
+        with np.load(filepath) as arrays:
+            return cls(transforms=arrays["transforms"], projection_indices=arrays["projection_indices"])
@@ -1,54 +1,131 @@
+import io
 import re
 import json
-import os
-import tempfile
-import urllib.request
-from typing import List, Optional, Union, Dict, Any
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Iterable, List, Optional, TypeVar, Union, Dict, Any
 from pathlib import Path
 
-from .metadata_models import MdocFile, ZValueSection
+import numpy as np
+import requests
+from fs.errors import FSError
 
+from . import cache
+from .http_pool import DEFAULT_HTTP_TIMEOUT, get_http_session
+from .metadata_models import MdocFile, XFAlignment, ZValueSection
+from .storage import get_storage, is_offline
 
-def download_mdoc_from_empiar(url: str) -> str:
 
-    suffix = '.mdoc'
-    temp_fd, local_path = tempfile.mkstemp(suffix=suffix, prefix='mdoc_')
-    os.close(temp_fd)
-    
-    try:
-        print(f"Downloading {url}...")
-        urllib.request.urlretrieve(url, local_path)
-        print(f"Downloaded to {local_path}")
-        return local_path
-    except Exception as e:
-        raise Exception(f"Failed to download {url}: {str(e)}")
-
-
-def download_xf_from_empiar(url: str) -> str:
-    """Download .xf file from EMPIAR"""
-    suffix = '.xf'
-    temp_fd, local_path = tempfile.mkstemp(suffix=suffix, prefix='xf_')
-    os.close(temp_fd)
-    
+# Versions of what the parsers produce, part of the keys of their cache entries
+MDOC_PARSER_VERSION = 1
+XF_PARSER_VERSION = 1
+
+# Seconds a cached parse is used before it is revalidated against its source
+METADATA_REVALIDATE_AFTER = 24 * 3600
+
+
+T = TypeVar("T")
+
+_in_flight_lock = threading.Lock()
+_in_flight: Dict[str, Future] = {}
+
+
+def _single_flight(key: str, fetch: Callable[[], T]) -> T:
+    """
+    Run fetch, unless a fetch with the same key is already running in another
+    thread, in which case wait for and share its result.
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _in_flight[key] = Future()
+
+    if not is_owner:
+        return future.result()
+
     try:
-        print(f"Downloading {url}...")
-        urllib.request.urlretrieve(url, local_path)
-        print(f"Downloaded to {local_path}")
-        return local_path
-    except Exception as e:
-        raise Exception(f"Failed to download {url}: {str(e)}")
+        result = fetch()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+class _ChunkReader(io.RawIOBase):
+    """Raw binary stream over an iterator of byte chunks"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def stream_and_parse(
+        url: str,
+        parse_lines: Callable[[Iterable[str]], T],
+        validators: Optional[Dict[str, Optional[str]]] = None,
+) -> tuple[Optional[T], Dict[str, Optional[str]]]:
+    """
+    Download a text file over the shared HTTP session and parse its lines as
+    they arrive, without writing it to disk.
+
+    With validators (the ETag and Last-Modified of an earlier download) the
+    request is conditional: if the file is unchanged, nothing is downloaded
+    and (None, validators) is returned. Otherwise returns the parse and the
+    response's validators.
+    """
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    print(f"{'Revalidating' if headers else 'Downloading'} {url}...")
+    session = get_http_session()
+    with session.get(url, headers=headers, stream=True, timeout=DEFAULT_HTTP_TIMEOUT) as response:
+        if response.status_code == 304:
+            return None, validators
+        response.raise_for_status()
+
+        chunks = _ChunkReader(response.iter_content(chunk_size=64 * 1024))
+        lines = io.TextIOWrapper(io.BufferedReader(chunks), encoding='utf-8', errors='ignore')
+        result = parse_lines(lines)
+
+        return result, {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
 
 
 def save_mdoc_to_json(mdoc: MdocFile, filepath: str) -> None:
     
-    with open(filepath, 'w') as f:
-        json.dump(mdoc.to_dict(), f, indent=2)
+    cache.write_json_atomic(filepath, mdoc.to_dict(), indent=2)
 
 
 def save_alignment_to_json(alignment: Dict[str, Any], filepath: str) -> None:
     """Save Alignment object to JSON file"""
-    with open(filepath, 'w') as f:
-        json.dump(alignment, f, indent=2)
+    cache.write_json_atomic(filepath, alignment, indent=2)
 
 
 def load_mdoc_from_json(filepath: str) -> MdocFile:
@@ -67,97 +144,157 @@ def load_alignment_from_json(filepath: str) -> Dict[str, Any]:
     return data
 
 
+def _entry_file_fetcher(
+        accession_id: str,
+        file_pattern: str,
+) -> tuple[str, Callable[[Callable[[Iterable[str]], T], Optional[Dict[str, Any]]], tuple[Optional[T], Dict[str, Any]]]]:
+    """
+    Where a text file of an entry is read from in the configured storage, and
+    a fetch(parse_lines, validators) that parses it from there: over HTTPS
+    from the EBI archive, or through the filesystem of a mirror.
+    """
+    storage = get_storage()
+    accession_no = accession_id.split("-")[1]
+
+    if storage.https_base_url is not None:
+        url = f"{storage.https_base_url}{accession_no}/data/{file_pattern}"
+
+        def fetch_url(parse_lines, validators):
+            storage.check_offline(url)
+            return stream_and_parse(url, parse_lines, validators)
+
+        return url, fetch_url
+
+    path = storage.file_path(accession_no, file_pattern)
+    return path, lambda parse_lines, validators: storage.fetch_text(path, parse_lines, validators)
+
+
+def _load_with_revalidation(
+        cache_path: Path,
+        source: str,
+        fetch: Callable[[Optional[Dict[str, Any]]], tuple[Optional[T], Dict[str, Any]]],
+        load_cached: Callable[[Path], T],
+        save_cached: Callable[[T, Path], None],
+) -> T:
+    """
+    Load a parse cached at cache_path. If it was last checked against its
+    source more than METADATA_REVALIDATE_AFTER seconds ago, revalidate it
+    first (fetch(validators) returns None for the parse if the source is
+    unchanged), re-parsing only if the source has changed. Offline, a cached
+    parse is never revalidated.
+    """
+    validators_path = cache_path.with_name(cache_path.name + ".http.json")
+    validators = None
+    if cache_path.exists():
+        try:
+            with open(validators_path) as fh:
+                validators = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            # An entry cached without validators has never been checked
+            # against its source, so revalidate it now (as entry_metadata
+            # does); it is still used offline
+            validators = {"checked": 0.0}
+
+        if is_offline() or time.time() - validators["checked"] < METADATA_REVALIDATE_AFTER:
+            cache.mark_used(cache_path)
+            return load_cached(cache_path)
+
+    try:
+        # Regions converted concurrently may share a file; fetch it only once.
+        # The result depends on the cache entry and its validators (a 304 is
+        # only meaningful to a caller holding that entry), so they are part
+        # of the key
+        flight_key = f"{source}\0{cache_path}\0{json.dumps(validators, sort_keys=True)}"
+        result, new_validators = _single_flight(flight_key, lambda: fetch(validators))
+    except (requests.RequestException, FSError) as e:
+        if validators is None:
+            raise
+        print(f"Warning: Could not revalidate {source}, using cached copy: {e}")
+        cache.mark_used(cache_path)
+        return load_cached(cache_path)
+
+    if result is None:
+        cache.mark_used(cache_path)
+        result = load_cached(cache_path)
+    else:
+        print(f"Caching to {cache_path}...")
+        save_cached(result, cache_path)
+    cache.write_json_atomic(validators_path, {**new_validators, "checked": time.time()})
+
+    return result
+
+
 def load_mdoc_with_cache(
         accession_id: str, 
         file_pattern: str,
         mdoc_label: str,
+        size_in_bytes: Optional[int] = None,
 ) -> MdocFile:
     
-    accession_no = accession_id.split("-")[1]
+    source, fetch = _entry_file_fetcher(accession_id, file_pattern)
 
-    url_base = "https://ftp.ebi.ac.uk/empiar/world_availability/" 
-    url = f"{url_base}{accession_no}/data/{file_pattern}"
+    key = cache.content_key(file_pattern, size_in_bytes, MDOC_PARSER_VERSION)
+    cache_path = cache.cache_path(accession_id, "mdoc", f"{mdoc_label}-{key}.json")
 
-    cache_dirpath = Path(f"local-data/{accession_id}/mdoc")
-    cache_dirpath.mkdir(exist_ok=True, parents=True)
-    cache_path = cache_dirpath / f"{mdoc_label}.json"
-    
-    if Path(cache_path).exists():
-        return load_mdoc_from_json(cache_path)
-    
-    temp_mdoc_path = download_mdoc_from_empiar(url)
-    
-    try:
-        print(f"Parsing {temp_mdoc_path}...")
-        mdoc = parse_mdoc_file(temp_mdoc_path)
-        
-        print(f"Caching to {cache_path}...")
-        save_mdoc_to_json(mdoc, cache_path)
-        
-        return mdoc
-        
-    finally:
-        Path(temp_mdoc_path).unlink()
+    return _load_with_revalidation(
+        cache_path,
+        source,
+        lambda validators: fetch(lambda lines: parse_mdoc_lines(lines, filename=source), validators),
+        load_mdoc_from_json,
+        save_mdoc_to_json,
+    )
+
+
+def _save_xf_alignment(alignment: XFAlignment, filepath: Path) -> None:
+    with cache.atomic_write_path(filepath) as temp_path:
+        alignment.save(temp_path)
 
 
 def load_xf_with_cache(
         accession_id: str, 
         file_pattern: str,
         xf_label: str,
-) -> Dict[str, Any]:
+        size_in_bytes: Optional[int] = None,
+) -> XFAlignment:
     
-    accession_no = accession_id.split("-")[1]
+    source, fetch = _entry_file_fetcher(accession_id, file_pattern)
 
-    url_base = "https://ftp.ebi.ac.uk/empiar/world_availability/" 
-    url = f"{url_base}{accession_no}/data/{file_pattern}"
+    key = cache.content_key(file_pattern, size_in_bytes, XF_PARSER_VERSION)
+    cache_path = cache.cache_path(accession_id, "xf", f"{xf_label}-{key}.npz")
 
-    cache_dirpath = Path(f"local-data/{accession_id}/xf")
-    cache_dirpath.mkdir(exist_ok=True, parents=True)
-    cache_path = cache_dirpath / f"{xf_label}.json"
-    
-    if Path(cache_path).exists():
-        return load_alignment_from_json(cache_path)
-    
-    temp_xf_path = download_xf_from_empiar(url)
-    
-    try:
-        print(f"Parsing {temp_xf_path}...")
-        alignment = parse_xf_file(temp_xf_path)
-        
-        print(f"Caching to {cache_path}...")
-        save_alignment_to_json(alignment, cache_path)
-        
-        return alignment
-        
-    finally:
-        Path(temp_xf_path).unlink()
+    return _load_with_revalidation(
+        cache_path,
+        source,
+        lambda validators: fetch(parse_xf_lines, validators),
+        XFAlignment.load,
+        _save_xf_alignment,
+    )
 
 
-def clear_cache(cache_dir: str = "mdoc_cache") -> None:
-    """Remove all cached files"""
-    cache_path = Path(cache_dir)
-    if cache_path.exists():
-        for file in cache_path.glob("*.json"):
-            file.unlink()
-        print(f"Cleared cache directory: {cache_dir}")
+def _cached_files(kind: str, accession_id: Optional[str] = None) -> List[Path]:
+    return [
+        entry.path for entry in cache.iter_cache_entries(accession_id) 
+        if entry.kind == kind
+    ]
+
+
+def clear_cache(accession_id: Optional[str] = None) -> None:
+    """Remove all cached mdoc files (of one accession, or all)"""
+    for path in _cached_files("mdoc", accession_id):
+        path.unlink(missing_ok=True)
+    print(f"Cleared mdoc cache under {cache.get_cache_root()}")
 
 
 def clear_xf_cache(accession_id: str) -> None:
     """Remove all cached .xf files for a specific accession"""
-    cache_path = Path(f"local-data/{accession_id}/cache/xf")
-    if cache_path.exists():
-        for file in cache_path.glob("*.json"):
-            file.unlink()
-        print(f"Cleared XF cache directory: {cache_path}")
+    for path in _cached_files("xf", accession_id):
+        path.unlink(missing_ok=True)
+    print(f"Cleared XF cache directory: {cache.cache_dir(accession_id, 'xf')}")
 
 
-def list_cached_files(cache_dir: str = "mdoc_cache") -> List[str]:
-    """List all cached JSON files"""
-    cache_path = Path(cache_dir)
-    if not cache_path.exists():
-        return []
-    
-    return [str(f) for f in cache_path.glob("*.json")]
+def list_cached_files(accession_id: Optional[str] = None) -> List[str]:
+    """List all cached mdoc files (of one accession, or all)"""
+    return [str(path) for path in _cached_files("mdoc", accession_id)]
 
 
 def parse_value(value_str: str) -> Union[str, int, float]:
@@ -182,124 +319,148 @@ def parse_value(value_str: str) -> Union[str, int, float]:
     return value_str
 
 
-def parse_xf_file(
-    filepath: str, 
-) -> Dict[str, Any]:
-    
-    projection_alignments = []
-    
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
-    
+def parse_xf_lines(lines: Iterable[str]) -> XFAlignment:
+    """
+    Parse the lines of an IMOD .xf file (a11 a12 a21 a22 dx dy per
+    projection) into an XFAlignment. Projections are numbered by line;
+    malformed lines are skipped with a warning.
+    """
+    rows = []
+    projection_indices = []
     for i, line in enumerate(lines):
-        line = line.strip()
+        values = line.split()
         
         # Skip empty lines
-        if not line:
+        if not values:
             continue
         
-        # Parse the six values: a11 a12 a21 a22 dx dy
-        values = line.split()
         if len(values) != 6:
             print(f"Warning: Line {i+1} has {len(values)} values instead of 6, skipping")
             continue
         
         try:
-            a11, a12, a21, a22, dx, dy = [float(v) for v in values]
+            rows.append([float(v) for v in values])
         except ValueError as e:
-            print(f"Warning: Could not parse line {i+1}: {line}, error: {e}")
+            print(f"Warning: Could not parse line {i+1}: {line.strip()}, error: {e}")
             continue
-        
-        # Create the transformation sequence
-        # Option 1: Separate Affine (rotation) and Translation
-        affine_transform = {
-            "type": "affine",
-            "name": f"rotation_projection_{i}",
-            "output": f"rotated_projection_{i}",
-            "affine": [
-                [a11, a12, 0.0],
-                [a21, a22, 0.0],
-                [0.0, 0.0, 1.0]
-            ]
-        }
-        
-        translation_transform = {
-            "type": "translation",
-            "name": f"translation_projection_{i}",
-            "input": f"rotated_projection_{i}",
-            "translation": [dx, dy]
-        }
-        
-        # Create ProjectionAlignment
-        projection_alignment = {
-            "type": "sequence",
-            "name": f"alignment_projection_{i}",
-            "sequence": [affine_transform, translation_transform]
-        }
-        
-        projection_alignments.append(projection_alignment)
-    
-    # Create the main Alignment object
-    alignment = {
-        "projection_alignments": projection_alignments
-    }
+        projection_indices.append(i)
+
+    alignment = XFAlignment(transforms=np.array(rows, dtype=np.float64).reshape(-1, 6), projection_indices=projection_indices)
+
+    degenerate = alignment.degenerate_projections()
+    if len(degenerate):
+        print(f"Warning: Singular transforms for projections {degenerate.tolist()}")
     
     return alignment
 
 
-def parse_mdoc_file(filepath: str) -> MdocFile:
-    """
-    Parse an .mdoc file and return a MdocFile object
+def load_xf_file(filepath: str) -> XFAlignment:
     
-    Args:
-        filepath: Path to the .mdoc file
-        
-    Returns:
-        MdocFile object containing parsed data
+    with open(filepath, 'r') as f:
+        return parse_xf_lines(f)
+
+
+def parse_xf_file(
+    filepath: str, 
+) -> Dict[str, Any]:
     """
-    mdoc = MdocFile(filename=str(filepath))
-    
-    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-        lines = f.readlines()
-    
-    current_section = None
-    in_global_headers = True
+    Parse an .xf file into a dict of affine + translation transform
+    sequences, one per projection
+    """
+    return load_xf_file(filepath).to_dict()
+
+
+# Types inferred for mdoc values, memoised per key by parse_mdoc_lines
+_INT, _FLOAT, _STR = 0, 1, 2
+
+_Z_VALUE_MATCH = re.compile(r'\[ZValue\s*=\s*(\d+)\]').match
+
+# Characters one of which any float that int() rejects must contain
+# ("1.5", "1e5", "nan", "inf")
+_NON_INT_CHARS = frozenset(".eEnNiI")
+
+# First characters of values that int() or float() could accept
+_NUMERIC_START_CHARS = frozenset("0123456789+-.iInN")
+
+
+def parse_mdoc_lines(lines: Iterable[str], filename: Optional[str] = None) -> MdocFile:
+    """
+    Parse the lines of an .mdoc file into a MdocFile, as they are read.
+
+    Gives the same result as parsing each value with parse_value, but keys
+    are assumed to keep the type of their previous value, so most values are
+    converted with a single call and no exception.
+    """
+    mdoc = MdocFile(filename=filename)
+    comments = mdoc.comments
+    z_sections = mdoc.z_sections
+    metadata = mdoc.global_headers
+    key_types: Dict[str, int] = {}
     
     for line in lines:
         line = line.strip()
-        
-        # Skip empty lines
         if not line:
             continue
-        
-        # Handle comments (lines starting with [T = )
-        if line.startswith('[T =') and line.endswith(']'):
-            comment = line[4:-1].strip()  # Remove [T = and ]
-            mdoc.comments.append(comment)
+
+        if line[0] == '[':
+            if line.startswith('[T =') and line.endswith(']'):
+                comments.append(line[4:-1].strip())
+                continue
+
+            z_value_match = _Z_VALUE_MATCH(line)
+            if z_value_match:
+                section = ZValueSection(z_value=int(z_value_match.group(1)))
+                z_sections.append(section)
+                metadata = section.metadata
             continue
-        
-        # Handle ZValue sections
-        z_value_match = re.match(r'\[ZValue\s*=\s*(\d+)\]', line)
-        if z_value_match:
-            z_value = int(z_value_match.group(1))
-            current_section = ZValueSection(z_value=z_value)
-            mdoc.z_sections.append(current_section)
-            in_global_headers = False
+
+        key, sep, value = line.partition('=')
+        if not sep:
             continue
-        
-        # Handle key-value pairs
-        if '=' in line and not line.startswith('['):
-            key, value = line.split('=', 1)
-            key = key.strip()
-            value = value.strip()
-            
-            # Parse value to appropriate type
+        key = key.strip()
+        value = value.strip()
+
+        key_type = key_types.get(key)
+        parsed_value = None
+        if key_type == _FLOAT:
+            if not _NON_INT_CHARS.isdisjoint(value):
+                try:
+                    parsed_value = float(value)
+                except ValueError:
+                    pass
+        elif key_type == _INT:
+            try:
+                parsed_value = int(value)
+            except ValueError:
+                pass
+        elif key_type == _STR:
+            # Numbers cannot contain inner spaces ("123.4 -56.7") or start
+            # with most other characters ("X:\\frames\\...")
+            if (
+                not value 
+                or ' ' in value 
+                or (value[0] not in _NUMERIC_START_CHARS and value[0].isascii())
+            ):
+                parsed_value = value
+
+        if parsed_value is None:
             parsed_value = parse_value(value)
-            
-            # Add to appropriate section
-            if in_global_headers:
-                mdoc.global_headers[key] = parsed_value
-            elif current_section is not None:
-                current_section[key] = parsed_value
+            key_types[key] = _INT if type(parsed_value) is int else _FLOAT if type(parsed_value) is float else _STR
+
+        metadata[key] = parsed_value
+    
+    return mdoc
+
+
+def parse_mdoc_file(filepath: str) -> MdocFile:
+    """
+    Parse an .mdoc file and return a MdocFile object
     
-    return mdoc
\ No newline at end of file
+    Args:
+        filepath: Path to the .mdoc file
+        
+    Returns:
+        MdocFile object containing parsed data
+    """
+    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+        return parse_mdoc_lines(f, filename=str(filepath))
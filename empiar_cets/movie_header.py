@@ -0,0 +1,227 @@
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+from .empiar_utils import EMPIARFile, EMPIARFileList, get_files_matching_pattern
+from .ftp_pool import DEFAULT_FTP_CONNECTIONS
+from .header_probe import header_cache_key, load_header_cache, lookup_files, update_header_cache
+from .storage import EntryStorage, get_storage
+from .yaml_parsing import RegionDirective
+
+
+logger = logging.getLogger("empiar_cets.movie_header")
+
+
+MOVIE_FILE_EXTENSIONS = (".tif", ".tiff", ".eer")
+
+TIFF_TAG_IMAGE_WIDTH = 256
+TIFF_TAG_IMAGE_LENGTH = 257
+TIFF_TAG_BITS_PER_SAMPLE = 258
+TIFF_TAG_COMPRESSION = 259
+
+# Compression values used by EER (electron event representation) files
+EER_COMPRESSIONS = (65000, 65001, 65002)
+
+# Size in bytes of each TIFF field type
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+_TIFF_TYPE_FORMATS = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 16: "Q", 17: "q", 18: "Q"}
+
+MAX_FRAMES = 1_000_000
+
+# Version of parse_tiff_header's output, part of the name of its cache
+MOVIE_HEADER_PARSER_VERSION = 1
+MOVIE_HEADER_CACHE_NAME = f"movie_headers_v{MOVIE_HEADER_PARSER_VERSION}"
+
+
+class BlockReader:
+    """
+    Reads byte ranges of one file through read_at(offset, length). A read
+    outside the current window fetches a new window starting at its offset,
+    and the reads that follow are served from it while they fall inside, so
+    that walking an IFD chain (interleaved with the image data in EER files)
+    costs one request per window rather than one per IFD. The window doubles
+    (up to max_window_size) each time the walk runs just past its end, and
+    shrinks back when the IFDs turn out to be further apart than that.
+    """
+
+    def __init__(
+            self,
+            read_at: Callable[[int, int], bytes],
+            window_size: int = 64 * 1024,
+            max_window_size: int = 4 * 1024 * 1024,
+    ):
+        self.read_at = read_at
+        self.window_size = self.initial_window_size = window_size
+        self.max_window_size = max_window_size
+        self._window_start = 0
+        self._window = b""
+
+    def read(self, offset: int, length: int) -> bytes:
+        window_end = self._window_start + len(self._window)
+        if not self._window_start <= offset <= offset + length <= window_end:
+            if self._window and offset >= window_end:
+                # A walk that only just ran past the window would have been
+                # served by a larger one; one that jumped far past it would
+                # only have fetched more image data
+                if offset - window_end < self.window_size:
+                    self.window_size = min(2 * self.window_size, self.max_window_size)
+                else:
+                    self.window_size = self.initial_window_size
+            self._window_start = offset
+            self._window = self.read_at(offset, max(length, self.window_size))
+        start = offset - self._window_start
+        result = self._window[start:start + length]
+        if len(result) < length:
+            raise ValueError(f"Unexpected end of file reading {length} bytes at {offset}")
+        return result
+
+
+def parse_tiff_header(reader: BlockReader) -> dict:
+    """
+    Get frame count, dimensions and bit depth of a (multi-frame) TIFF or EER
+    file by walking its IFD chain, without reading any image data.
+    """
+
+    byte_order = reader.read(0, 2)
+    if byte_order == b"II":
+        endian = "<"
+    elif byte_order == b"MM":
+        endian = ">"
+    else:
+        raise ValueError("Not a TIFF file")
+
+    (version,) = struct.unpack(endian + "H", reader.read(2, 2))
+    if version == 42:
+        big_tiff = False
+        (ifd_offset,) = struct.unpack(endian + "I", reader.read(4, 4))
+        count_format, entry_format, offset_format, inline_size = "H", "HHII", "I", 4
+    elif version == 43:
+        big_tiff = True
+        (ifd_offset,) = struct.unpack(endian + "Q", reader.read(8, 8))
+        count_format, entry_format, offset_format, inline_size = "Q", "HHQQ", "Q", 8
+    else:
+        raise ValueError(f"Unsupported TIFF version {version}")
+
+    count_size = struct.calcsize(count_format)
+    entry_size = struct.calcsize(endian + entry_format)
+    offset_size = struct.calcsize(offset_format)
+
+    def first_value(field_type: int, count: int, value_bytes: bytes) -> Optional[int]:
+        value_format = _TIFF_TYPE_FORMATS.get(field_type)
+        if value_format is None or count < 1:
+            return None
+        value_size = _TIFF_TYPE_SIZES[field_type]
+        if value_size * count > inline_size:
+            (value_offset,) = struct.unpack(endian + offset_format, value_bytes)
+            value_bytes = reader.read(value_offset, value_size)
+        return struct.unpack(endian + value_format, value_bytes[:value_size])[0]
+
+    first_ifd_tags: dict[int, Optional[int]] = {}
+    n_frames = 0
+    visited = set()
+    while ifd_offset and ifd_offset not in visited and n_frames < MAX_FRAMES:
+        visited.add(ifd_offset)
+        (n_entries,) = struct.unpack(endian + count_format, reader.read(ifd_offset, count_size))
+        entries = reader.read(ifd_offset + count_size, n_entries * entry_size + offset_size)
+
+        if n_frames == 0:
+            for i in range(n_entries):
+                tag, field_type, count, _ = struct.unpack_from(endian + entry_format, entries, i * entry_size)
+                if tag in (TIFF_TAG_IMAGE_WIDTH, TIFF_TAG_IMAGE_LENGTH, TIFF_TAG_BITS_PER_SAMPLE, TIFF_TAG_COMPRESSION):
+                    value_start = i * entry_size + entry_size - inline_size
+                    value_bytes = entries[value_start:value_start + inline_size]
+                    first_ifd_tags[tag] = first_value(field_type, count, value_bytes)
+
+        n_frames += 1
+        (ifd_offset,) = struct.unpack_from(endian + offset_format, entries, n_entries * entry_size)
+
+    compression = first_ifd_tags.get(TIFF_TAG_COMPRESSION)
+    return {
+        'format': "eer" if compression in EER_COMPRESSIONS else "tiff",
+        'big_tiff': big_tiff,
+        'frames': n_frames,
+        'width': first_ifd_tags.get(TIFF_TAG_IMAGE_WIDTH),
+        'height': first_ifd_tags.get(TIFF_TAG_IMAGE_LENGTH),
+        'bits_per_sample': first_ifd_tags.get(TIFF_TAG_BITS_PER_SAMPLE),
+        'compression': compression,
+    }
+
+
+def _probe_movie_header(
+        accession_id: str,
+        file: EMPIARFile,
+        storage: EntryStorage,
+) -> Optional[dict]:
+    accession_no = accession_id.split("-")[1]
+    with storage.range_reader(storage.file_path(accession_no, str(file.path))) as read_at:
+        try:
+            return parse_tiff_header(BlockReader(read_at))
+        except (ValueError, struct.error) as e:
+            logger.warning(f"Could not parse the header of movie {file.path}: {e}")
+            return None
+
+
+def probe_movie_headers(
+        accession_id: str,
+        empiar_files: EMPIARFileList,
+        paths: Iterable[str],
+        max_workers: int = DEFAULT_FTP_CONNECTIONS,
+) -> dict[str, dict]:
+    """
+    Get frame count, dimensions and bit depth of many TIFF/EER movie stacks,
+    keyed by path.
+
+    Only the IFD chain of each movie is read, with ranged reads from the
+    configured storage (see storage; a local mirror is read through mmap),
+    concurrently across movies. Results are cached on disk keyed by path and
+    size in bytes. Movies whose header cannot be parsed are left out, with a
+    warning.
+    """
+
+    files = lookup_files(empiar_files, dict.fromkeys(paths))
+    cache = load_header_cache(accession_id, MOVIE_HEADER_CACHE_NAME, [header_cache_key(file) for file in files])
+    # A corrupt entry is probed again
+    cache = {key: header for key, header in cache.items() if isinstance(header, dict)}
+
+    missing_files = [file for file in files if header_cache_key(file) not in cache]
+    if missing_files:
+        logger.info(f"Probing {len(missing_files)} movie headers for {accession_id}")
+        storage = get_storage(max_workers)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            headers = executor.map(
+                lambda file: _probe_movie_header(accession_id, file, storage),
+                missing_files
+            )
+            new_entries = {
+                header_cache_key(file): header for file, header in zip(missing_files, headers)
+                if header is not None
+            }
+        update_header_cache(accession_id, MOVIE_HEADER_CACHE_NAME, new_entries)
+        cache.update(new_entries)
+
+    return {str(file.path): cache[header_cache_key(file)] for file in files if header_cache_key(file) in cache}
+
+
+def get_movie_header_cached(
+        accession_id: str,
+        empiar_files: EMPIARFileList,
+        path: str,
+) -> Optional[dict]:
+    return probe_movie_headers(accession_id, empiar_files, [path]).get(path)
+
+
+def get_movie_paths_for_region(
+        empiar_files: EMPIARFileList,
+        region: RegionDirective,
+) -> list[str]:
+    """Paths of the TIFF/EER movie stacks of a region"""
+
+    paths = []
+    for movie_stack in region.movie_stacks or []:
+        paths.extend(
+            path for path in get_files_matching_pattern(empiar_files, movie_stack.file_pattern)
+            if path.lower().endswith(MOVIE_FILE_EXTENSIONS)
+        )
+
+    return list(dict.fromkeys(paths))
@@ -0,0 +1,122 @@
+from typing import Iterable, Union
+
+import numpy as np
+
+
+MRC_HEADER_SIZE = 1024
+
+# MRC2014 main header, see https://www.ccpem.ac.uk/mrc_format/mrc2014.php
+_MRC_HEADER_FIELDS = [
+    ("nx", "i4"), ("ny", "i4"), ("nz", "i4"),
+    ("mode", "i4"),
+    ("nxstart", "i4"), ("nystart", "i4"), ("nzstart", "i4"),
+    ("mx", "i4"), ("my", "i4"), ("mz", "i4"),
+    ("cella", "f4", (3,)),
+    ("cellb", "f4", (3,)),
+    ("mapc", "i4"), ("mapr", "i4"), ("maps", "i4"),
+    ("dmin", "f4"), ("dmax", "f4"), ("dmean", "f4"),
+    ("ispg", "i4"),
+    ("nsymbt", "i4"),
+    ("extra1", "V8"),
+    ("exttyp", "S4"),
+    ("nversion", "i4"),
+    ("extra2", "V84"),
+    ("origin", "f4", (3,)),
+    ("map", "S4"),
+    ("machst", "u1", (4,)),
+    ("rms", "f4"),
+    ("nlabl", "i4"),
+    ("label", "S80", (10,)),
+]
+
+MRC_HEADER_DTYPE = np.dtype([(name, "<" + t, *shape) for name, t, *shape in _MRC_HEADER_FIELDS])
+_MRC_HEADER_DTYPE_BE = MRC_HEADER_DTYPE.newbyteorder(">")
+assert MRC_HEADER_DTYPE.itemsize == MRC_HEADER_SIZE
+
+# Data type of the voxels for each MRC mode (mode 101 is packed 4-bit)
+MRC_MODE_DTYPES = {
+    0: np.dtype("i1"),
+    1: np.dtype("<i2"),
+    2: np.dtype("<f4"),
+    3: np.dtype([("real", "<i2"), ("imag", "<i2")]),
+    4: np.dtype("<c8"),
+    6: np.dtype("<u2"),
+    12: np.dtype("<f2"),
+    101: np.dtype("u1"),
+}
+
+# Machine stamp byte 0: 0x44 ("DD"/"DA") little-endian, 0x11 big-endian
+_BIG_ENDIAN_STAMP = 0x11
+
+
+def decode_mrc_headers(headers: Union[bytes, bytearray, memoryview, Iterable[bytes]]) -> np.ndarray:
+    """
+    Decode MRC headers into a structured array with one record per header.
+
+    Accepts a buffer of concatenated 1024-byte headers, which is viewed in
+    place, or an iterable of individual headers, which are concatenated once.
+    Headers with a big-endian machine stamp are byte-swapped, so all records
+    of the result are little-endian; their machine stamps are kept as is.
+    """
+    if not isinstance(headers, (bytes, bytearray, memoryview)):
+        headers = b"".join(header[:MRC_HEADER_SIZE] for header in headers)
+
+    records = np.frombuffer(headers, dtype=MRC_HEADER_DTYPE)
+    big_endian = records["machst"][:, 0] == _BIG_ENDIAN_STAMP
+    if big_endian.any():
+        records = records.copy()
+        swapped = np.frombuffer(headers, dtype=_MRC_HEADER_DTYPE_BE)[big_endian]
+        records[big_endian] = swapped.astype(MRC_HEADER_DTYPE)
+
+    return records
+
+
+def mrc_header_to_dict(record: np.void) -> dict:
+    """Plain-Python summary of one decoded header record"""
+
+    dimensions = (int(record["nx"]), int(record["ny"]), int(record["nz"]))
+    sampling = (int(record["mx"]), int(record["my"]), int(record["mz"]))
+    cell_dimensions = tuple(float(v) for v in record["cella"])
+
+    # Pixel size in Angstrom per axis, undefined if the sampling is not set
+    pixel_size = tuple(
+        cell / n if n > 0 else None for cell, n in zip(cell_dimensions, sampling)
+    )
+
+    mode = int(record["mode"])
+    dtype = MRC_MODE_DTYPES.get(mode)
+    # The header fields were byte-swapped, but the voxels are in the file's
+    # own byte order, as given by its (unswapped) machine stamp
+    if dtype is not None and record["machst"][0] == _BIG_ENDIAN_STAMP:
+        dtype = dtype.newbyteorder(">")
+    nsymbt = int(record["nsymbt"])
+    nlabl = min(max(int(record["nlabl"]), 0), 10)
+
+    return {
+        'dimensions': dimensions,
+        'mode': mode,
+        'dtype': None if dtype is None else dtype.str,
+        'start': (int(record["nxstart"]), int(record["nystart"]), int(record["nzstart"])),
+        'sampling': sampling,
+        'cell_dimensions': cell_dimensions,
+        'cell_angles': tuple(float(v) for v in record["cellb"]),
+        'pixel_size': pixel_size,
+        'origin': tuple(float(v) for v in record["origin"]),
+        'axis_order': (int(record["mapc"]), int(record["mapr"]), int(record["maps"])),
+        'min': float(record["dmin"]),
+        'max': float(record["dmax"]),
+        'mean': float(record["dmean"]),
+        'rms': float(record["rms"]),
+        'space_group': int(record["ispg"]),
+        'extended_header_size': nsymbt,
+        'extended_header_type': record["exttyp"].decode("ascii", errors="replace").strip("\0 ") or None,
+        'nversion': int(record["nversion"]),
+        'data_offset': MRC_HEADER_SIZE + nsymbt,
+        'labels': [
+            label.decode("ascii", errors="replace").rstrip("\0 ") for label in record["label"][:nlabl]
+        ],
+    }
+
+
+def decode_mrc_header(header_data: bytes) -> dict:
+    return mrc_header_to_dict(decode_mrc_headers(header_data[:MRC_HEADER_SIZE])[0])
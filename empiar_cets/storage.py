@@ -0,0 +1,266 @@
+"""
+Where the data of EMPIAR entries is read from.
+
+The storage backend is chosen by EMPIAR_CETS_STORAGE:
+
+    ebi (default)     the EBI archive: listings and ranged reads over FTP,
+                      text files over HTTPS
+    a directory       a local mirror, laid out as <accession_no>/data/...
+                      like the archive's world_availability directory; file
+                      ranges are read through mmap
+    a pyfilesystem2   any filesystem opened with fs.open_fs, with the same
+    URL               layout as a local mirror, e.g. s3://bucket/empiar
+
+With EMPIAR_CETS_OFFLINE set, nothing is fetched over the network: cached
+data is used however old it is, and anything that is not cached (and is not
+in a local mirror) raises an OfflineError straight away.
+"""
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, TypeVar
+
+from .defaults import DEFAULT_FTP_CONNECTIONS
+
+if TYPE_CHECKING:
+    from fs.base import FS
+
+    from .ftp_pool import FTPConnectionPool
+
+
+T = TypeVar("T")
+
+
+STORAGE_ENV_VAR = "EMPIAR_CETS_STORAGE"
+OFFLINE_ENV_VAR = "EMPIAR_CETS_OFFLINE"
+EBI_STORAGE = "ebi"
+
+EBI_DATA_ROOT = "/empiar/world_availability/{accession_no}/data"
+MIRROR_DATA_ROOT = "/{accession_no}/data"
+
+# pyfilesystem2 protocols that do not go over the network
+_LOCAL_PROTOCOLS = ("osfs", "mem", "temp", "tar", "zip")
+
+
+class OfflineError(RuntimeError):
+    """Data that is not cached was needed in offline mode"""
+
+
+def get_storage_spec() -> str:
+    return os.environ.get(STORAGE_ENV_VAR) or EBI_STORAGE
+
+
+def set_storage_spec(spec: str) -> None:
+    """Set the storage backend, for this process and any it starts"""
+    os.environ[STORAGE_ENV_VAR] = spec
+
+
+def is_offline() -> bool:
+    return os.environ.get(OFFLINE_ENV_VAR, "").lower() in ("1", "true", "yes")
+
+
+def set_offline(offline: bool) -> None:
+    """Set offline mode, for this process and any it starts"""
+    os.environ[OFFLINE_ENV_VAR] = "1" if offline else "0"
+
+
+class EntryStorage:
+    """
+    Entries' data directories on a pyfilesystem2 filesystem, reached through
+    a pool of connections to it.
+
+    Text files are read through the filesystem too, unless https_base_url
+    is set, in which case they are fetched over HTTPS from there.
+    """
+
+    https_base_url: Optional[str] = None
+
+    def __init__(
+            self,
+            description: str,
+            pool: "FTPConnectionPool",
+            data_root: str = MIRROR_DATA_ROOT,
+            remote: bool = True,
+            owns_pool: bool = True,
+    ):
+        self.description = description
+        self.pool = pool
+        self.data_root_template = data_root
+        self.remote = remote
+        self._owns_pool = owns_pool
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.description!r})"
+
+    def data_root(self, accession_no: str) -> str:
+        return self.data_root_template.format(accession_no=accession_no)
+
+    def file_path(self, accession_no: str, relpath: str) -> str:
+        return f"{self.data_root(accession_no)}/{relpath}"
+
+    def check_offline(self, what: str) -> None:
+        """Fail fast if what has to be fetched over the network in offline mode"""
+        if self.remote and is_offline():
+            raise OfflineError(f"{what} is not cached, and {self.description} cannot be reached offline")
+
+    @contextmanager
+    def connection(self) -> Iterator["FS"]:
+        with self.pool.connection() as fs:
+            yield fs
+
+    def read_range(self, path: str, offset: int, length: int) -> bytes:
+        with self.range_reader(path) as read_at:
+            return read_at(offset, length)
+
+    @contextmanager
+    def range_reader(self, path: str) -> Iterator[Callable[[int, int], bytes]]:
+        """A read_at(offset, length) function over one file, for the duration of the with block"""
+        from .ftp_pool import read_range
+
+        self.check_offline(path)
+        with self.connection() as fs:
+            yield lambda offset, length: read_range(fs, path, offset, length)
+
+    def fetch_text(
+            self,
+            path: str,
+            parse_lines: Callable[[Iterable[str]], T],
+            validators: Optional[dict] = None,
+    ) -> tuple[Optional[T], dict]:
+        """
+        Parse the lines of a text file. With validators (the size and
+        modification time it had when last parsed) returns (None, validators)
+        if the file is unchanged. Otherwise returns the parse and the file's
+        current validators.
+        """
+
+        self.check_offline(path)
+        with self.connection() as fs:
+            info = fs.getinfo(path, namespaces=["details"])
+            new_validators = {
+                "size": info.size,
+                "modified": info.modified.timestamp() if info.modified else None,
+            }
+            if (
+                validators
+                and new_validators["modified"] is not None
+                and all(validators.get(key) == value for key, value in new_validators.items())
+            ):
+                return None, validators
+
+            print(f"Reading {path} from {self.description}...")
+            with fs.open(path, "r", encoding="utf-8", errors="ignore") as fh:
+                return parse_lines(fh), new_validators
+
+    def close(self) -> None:
+        if self._owns_pool:
+            self.pool.close()
+
+
+class EBIStorage(EntryStorage):
+    """The EBI archive, over the shared FTP connection pool and HTTPS"""
+
+    def __init__(self, max_connections: int = DEFAULT_FTP_CONNECTIONS):
+        from .ftp_pool import get_ftp_pool
+        from .http_pool import EMPIAR_HTTPS_BASE_URL
+
+        super().__init__(
+            "the EBI archive", get_ftp_pool(max_connections), EBI_DATA_ROOT, remote=True, owns_pool=False
+        )
+        self.https_base_url = EMPIAR_HTTPS_BASE_URL
+
+
+class LocalMirrorStorage(EntryStorage):
+    """
+    A mirror of the archive on a local or parallel filesystem. Listings go
+    through OSFS; file ranges are read straight from the memory-mapped file.
+    """
+
+    def __init__(self, root: str, max_connections: int = DEFAULT_FTP_CONNECTIONS):
+        from fs.osfs import OSFS
+
+        from .ftp_pool import FTPConnectionPool
+
+        self.root = os.path.abspath(os.path.expanduser(root))
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(f"Mirror directory not found: {self.root}")
+        super().__init__(
+            f"the mirror in {self.root}",
+            FTPConnectionPool(host=self.root, max_size=max_connections, fs_factory=lambda: OSFS(self.root)),
+            MIRROR_DATA_ROOT,
+            remote=False,
+        )
+
+    def syspath(self, path: str) -> str:
+        return os.path.join(self.root, path.lstrip("/"))
+
+    @contextmanager
+    def range_reader(self, path: str) -> Iterator[Callable[[int, int], bytes]]:
+        from fs.errors import ResourceNotFound
+
+        try:
+            fh = open(self.syspath(path), "rb")
+        except FileNotFoundError as e:
+            raise ResourceNotFound(path) from e
+        with fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                yield lambda offset, length: b""
+                return
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield lambda offset, length: mapped[offset:offset + length]
+
+
+def create_storage(spec: str, max_connections: int = DEFAULT_FTP_CONNECTIONS) -> EntryStorage:
+    """The storage backend described by spec: ebi, a mirror directory or a pyfilesystem2 URL"""
+
+    if spec == EBI_STORAGE:
+        return EBIStorage(max_connections)
+
+    protocol, separator, location = spec.partition("://")
+    if not separator:
+        return LocalMirrorStorage(spec, max_connections)
+    if protocol == "osfs":
+        return LocalMirrorStorage(location, max_connections)
+
+    from fs import open_fs
+
+    from .ftp_pool import FTPConnectionPool
+
+    return EntryStorage(
+        spec,
+        FTPConnectionPool(host=spec, max_size=max_connections, fs_factory=lambda: open_fs(spec)),
+        MIRROR_DATA_ROOT,
+        remote=protocol not in _LOCAL_PROTOCOLS,
+    )
+
+
+_shared_storage: Optional[EntryStorage] = None
+_shared_storage_spec: Optional[str] = None
+_shared_storage_lock = threading.Lock()
+
+
+def get_storage(max_connections: Optional[int] = None) -> EntryStorage:
+    """
+    The process-wide storage backend, as currently configured.
+
+    max_connections only takes effect when the backend is first created (or
+    after close_storage or a change of configuration).
+    """
+    global _shared_storage, _shared_storage_spec
+    spec = get_storage_spec()
+    with _shared_storage_lock:
+        if _shared_storage is None or _shared_storage_spec != spec:
+            if _shared_storage is not None:
+                _shared_storage.close()
+            _shared_storage = create_storage(spec, max_connections or DEFAULT_FTP_CONNECTIONS)
+            _shared_storage_spec = spec
+        return _shared_storage
+
+
+def close_storage() -> None:
+    global _shared_storage
+    with _shared_storage_lock:
+        storage, _shared_storage = _shared_storage, None
+    if storage is not None:
+        storage.close()
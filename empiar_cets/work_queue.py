@@ -0,0 +1,436 @@
+"""
+Work queue for spreading czii conversions across machines that share only a
+filesystem.
+
+A unit of work is one region of one accession. The queue is a directory:
+
+    pending/   units waiting for a worker
+    leased/    units claimed by a worker, named <unit>.<claim token>.json; the
+               file's mtime is its heartbeat. A worker finishing a unit first
+               renames its lease to <unit>.<token>.taken, then writes the
+               unit's record there and renames it into its new state.
+    done/      units whose result has been written
+    failed/    units whose conversion raised, with the error recorded
+    results/   <accession>/<index>.json, the converted region dicts
+
+A unit is claimed by renaming it from pending/ to leased/ under a name unique
+to the claim, which succeeds for exactly one worker. Leases whose heartbeat
+is older than the lease timeout are renamed back to pending/ by any worker,
+or to failed/ if their unit has had its maximum number of attempts: each
+attempt is counted in the lease before the work starts.
+A worker whose lease was re-queued can then no longer touch or finish it,
+even once another worker has claimed the unit again. Once every unit of an accession
+is done, reduce_accession assembles its Dataset from the results.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+import cryoet_metadata._base._models
+from pydantic import BaseModel
+
+from .cache import enforce_cache_budget, write_json_atomic
+from .cets_object_utils import list_item_model_class, trusted_cets_model, validate_cets_model, write_cets_dataset
+from .cets.czii.region import create_cets_czii_region_from_region_directive
+from .defaults import DEFAULT_CACHE_BUDGET_INTERVAL, DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_LEASE_TIMEOUT
+from .empiar_utils import DEFAULT_FTP_CONNECTIONS, EMPIARFileList, get_regions_for_empiar_entry
+from .header_probe import get_mrc_paths_for_regions, probe_mrc_headers
+from .yaml_parsing import RegionDirective, load_empiar_yaml_for_czii
+
+
+logger = logging.getLogger("empiar_cets.work_queue")
+
+
+QUEUE_STATES = ("pending", "leased", "done", "failed")
+
+
+def _unit_name_of_lease(lease_path: Path) -> str:
+    # <unit>.<claim token>.json or <unit>.<token>.taken -> <unit>.json
+    return f"{lease_path.name.split('.', 1)[0]}.json"
+
+
+class WorkQueue:
+
+    def __init__(
+            self,
+            queue_dirpath: Union[str, Path],
+            lease_timeout: float = DEFAULT_LEASE_TIMEOUT,
+    ):
+        self.root = Path(queue_dirpath)
+        self.lease_timeout = lease_timeout
+
+    def state_dir(self, state: str) -> Path:
+        return self.root / state
+
+    def results_dir(self, accession_id: str) -> Path:
+        return self.root / "results" / accession_id
+
+    def create(self) -> None:
+        for state in QUEUE_STATES:
+            self.state_dir(state).mkdir(parents=True, exist_ok=True)
+        (self.root / "results").mkdir(parents=True, exist_ok=True)
+
+    def unit_name(self, accession_id: str, region_index: int) -> str:
+        return f"{accession_id}__{region_index:05d}.json"
+
+    def add_accession(
+            self,
+            accession_id: str,
+            regions: list[RegionDirective],
+            definitions_dirpath: Optional[Path] = None,
+    ) -> int:
+        """Queue one unit per region of an accession, replacing any earlier units of it"""
+
+        for state in QUEUE_STATES:
+            for unit_path in self.state_dir(state).glob(f"{accession_id}__*.json"):
+                unit_path.unlink(missing_ok=True)
+        results_dirpath = self.results_dir(accession_id)
+        results_dirpath.mkdir(parents=True, exist_ok=True)
+        for result_path in results_dirpath.glob("*.json"):
+            result_path.unlink()
+
+        for index, region in enumerate(regions):
+            unit = {
+                "accession_id": accession_id,
+                "region_index": index,
+                "region_title": region.title,
+                "n_regions": len(regions),
+                "definitions_dirpath": None if definitions_dirpath is None else str(definitions_dirpath),
+                "attempts": 0,
+            }
+            write_json_atomic(self.state_dir("pending") / self.unit_name(accession_id, index), unit)
+
+        return len(regions)
+
+    def requeue_expired(self, max_attempts: Optional[int] = None) -> int:
+        """
+        Return leases whose heartbeat has stopped to pending/, or to failed/
+        if their unit has already had max_attempts (so that a unit that
+        kills its workers is not retried forever)
+        """
+
+        n_requeued = 0
+        now = time.time()
+        leased_dirpath = self.state_dir("leased")
+        # Taken leases are left behind by workers that died while finishing
+        for lease_path in [*leased_dirpath.glob("*.json"), *leased_dirpath.glob("*.taken")]:
+            try:
+                if now - lease_path.stat().st_mtime <= self.lease_timeout:
+                    continue
+                taken_path = self._take(lease_path)
+                if taken_path is None:
+                    continue
+                with open(taken_path) as fh:
+                    unit = json.load(fh)
+            except FileNotFoundError:
+                # Finished or re-queued by another worker in the meantime
+                continue
+
+            if max_attempts is not None and unit["attempts"] >= max_attempts:
+                unit["error"] = f"Lease expired on attempt {unit['attempts']} (worker {unit.get('worker')})"
+                self._move_taken(taken_path, "failed", unit)
+                logger.warning(f"Failed expired lease {lease_path.name} after {unit['attempts']} attempts")
+            else:
+                os.rename(taken_path, self.state_dir("pending") / _unit_name_of_lease(taken_path))
+                logger.info(f"Re-queued expired lease {lease_path.name}")
+                n_requeued += 1
+
+        return n_requeued
+
+    def claim(self) -> Optional[Path]:
+        """Lease one pending unit, or return None if there are none"""
+
+        for unit_path in sorted(self.state_dir("pending").glob("*.json")):
+            lease_path = self.state_dir("leased") / f"{unit_path.stem}.{uuid.uuid4().hex}.json"
+            try:
+                os.rename(unit_path, lease_path)
+            except FileNotFoundError:
+                continue
+            os.utime(lease_path)
+            return lease_path
+
+        return None
+
+    def start(self, lease_path: Path, worker: str) -> Optional[dict]:
+        """
+        Count a new attempt at a leased unit, recording it (and the worker)
+        in the lease before any work starts; None if the lease was lost
+        """
+
+        try:
+            with open(lease_path) as fh:
+                unit = json.load(fh)
+        except FileNotFoundError:
+            return None
+        unit["attempts"] += 1
+        unit["worker"] = worker
+        # Just claimed, so the lease is far from expiring
+        write_json_atomic(lease_path, unit)
+        return unit
+
+    def _take(self, lease_path: Path) -> Optional[Path]:
+        # Rename a lease to a name no other worker will look for, so that
+        # its unit can be updated and moved on without racing anyone
+        taken_path = lease_path.with_name(f"{lease_path.name.split('.', 1)[0]}.{uuid.uuid4().hex}.taken")
+        try:
+            os.rename(lease_path, taken_path)
+        except FileNotFoundError:
+            return None
+        os.utime(taken_path)
+        return taken_path
+
+    def _move_taken(self, taken_path: Path, state: str, unit: dict) -> None:
+        # The unit is written before the one atomic rename that makes it
+        # visible in its new state
+        write_json_atomic(taken_path, unit)
+        os.rename(taken_path, self.state_dir(state) / _unit_name_of_lease(taken_path))
+
+    def finish(self, lease_path: Path, state: str, unit: dict) -> bool:
+        """Move a leased unit to a new state with its record updated; False if the lease was lost"""
+
+        taken_path = self._take(lease_path)
+        if taken_path is None:
+            logger.warning(f"Lease on {_unit_name_of_lease(lease_path)} expired before it finished")
+            return False
+        self._move_taken(taken_path, state, unit)
+        return True
+
+    def counts(self, accession_id: Optional[str] = None) -> dict[str, int]:
+        pattern = "*.json" if accession_id is None else f"{accession_id}__*.json"
+        return {state: sum(1 for _ in self.state_dir(state).glob(pattern)) for state in QUEUE_STATES}
+
+    def accession_ids(self) -> list[str]:
+        results_dirpath = self.root / "results"
+        return sorted(path.name for path in results_dirpath.iterdir() if path.is_dir())
+
+
+class _RegionMismatch(RuntimeError):
+    """The regions of an accession no longer match those it was queued with"""
+
+
+class _Heartbeat:
+    """Touch a lease file periodically while its unit is being worked on"""
+
+    def __init__(self, lease_path: Path, interval: float):
+        self.lease_path = lease_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.lease_path)
+            except FileNotFoundError:
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def prepare_accession(
+        queue: WorkQueue,
+        accession_id: str,
+        ftp_connections: int = DEFAULT_FTP_CONNECTIONS,
+        cache_format: str = "json",
+        definitions_dirpath: Optional[Path] = None,
+) -> int:
+    """
+    Queue the regions of an accession, listing its files first so that
+    workers only ever read the file list cache.
+    """
+
+    regions, empiar_files = get_regions_for_empiar_entry(
+        accession_id,
+        load_empiar_yaml_for_czii(accession_id, definitions_dirpath),
+        ftp_connections,
+        cache_format=cache_format,
+    )
+    empiar_files.close()
+
+    return queue.add_accession(accession_id, regions, definitions_dirpath)
+
+
+def _iter_leases(
+        queue: WorkQueue,
+        poll_interval: float,
+        wait: bool,
+        max_attempts: Optional[int] = None,
+) -> Iterator[Path]:
+    while True:
+        queue.requeue_expired(max_attempts)
+        lease_path = queue.claim()
+        if lease_path is not None:
+            yield lease_path
+            continue
+        if not wait or not any(queue.state_dir("leased").glob("*.json")):
+            return
+        # Other workers still hold leases that may expire and come back
+        time.sleep(poll_interval)
+
+
+def run_worker(
+        queue: WorkQueue,
+        ftp_connections: int = DEFAULT_FTP_CONNECTIONS,
+        cache_format: str = "json",
+        heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+        max_attempts: int = 3,
+        wait: bool = True,
+        cache_budget_interval: float = DEFAULT_CACHE_BUDGET_INTERVAL,
+) -> dict[str, int]:
+    """
+    Convert queued regions until the queue is drained.
+
+    With wait, the worker keeps polling while other workers hold leases, so
+    that it can pick up any of their units whose lease expires. The cache is
+    pruned to its budget at most every cache_budget_interval seconds, and
+    when the worker stops.
+    """
+
+    regions_by_accession: dict[str, list[RegionDirective]] = {}
+    files_by_accession: dict[str, EMPIARFileList] = {}
+    n_done, n_failed = 0, 0
+    last_budget_check = time.monotonic()
+
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    for lease_path in _iter_leases(queue, heartbeat_interval, wait, max_attempts):
+        unit = queue.start(lease_path, worker)
+        if unit is None:
+            continue
+
+        accession_id = unit["accession_id"]
+        logger.info(f"Converting {accession_id} region {unit['region_title']} (attempt {unit['attempts']})")
+
+        with _Heartbeat(lease_path, heartbeat_interval):
+            try:
+                if accession_id not in regions_by_accession:
+                    definitions_dirpath = unit["definitions_dirpath"]
+                    # Templates expand against the same cached file list as
+                    # when the accession was queued, so region indices agree
+                    regions, empiar_files = get_regions_for_empiar_entry(
+                        accession_id,
+                        load_empiar_yaml_for_czii(
+                            accession_id, None if definitions_dirpath is None else Path(definitions_dirpath)
+                        ),
+                        ftp_connections,
+                        cache_format=cache_format,
+                    )
+                    regions_by_accession[accession_id] = regions
+                    files_by_accession[accession_id] = empiar_files
+                regions = regions_by_accession[accession_id]
+                region = regions[unit["region_index"]] if unit["region_index"] < len(regions) else None
+                if region is None or region.title != unit["region_title"]:
+                    raise _RegionMismatch(
+                        f"Region {unit['region_index']} of {accession_id} is "
+                        f"{region.title if region else 'missing'}, not {unit['region_title']} as queued; "
+                        f"re-queue the accession"
+                    )
+                empiar_files = files_by_accession[accession_id]
+
+                probe_mrc_headers(
+                    accession_id,
+                    empiar_files,
+                    get_mrc_paths_for_regions(empiar_files, [region]),
+                    max_workers=ftp_connections,
+                )
+                # Validated here, as each region finishes, so that reduce can
+                # trust the results
+                cets_region = validate_cets_model(
+                    create_cets_czii_region_from_region_directive(accession_id, region, empiar_files),
+                    _region_model_class(),
+                    f"region {unit['region_title']} of {accession_id}",
+                )
+
+                result_path = queue.results_dir(accession_id) / f"{unit['region_index']:05d}.json"
+                write_json_atomic(result_path, cets_region.model_dump(mode="json"))
+                state = "done"
+            except Exception as e:
+                logger.debug(traceback.format_exc())
+                unit["error"] = f"{type(e).__name__}: {e}"
+                retry = not isinstance(e, _RegionMismatch) and unit["attempts"] < max_attempts
+                state = "pending" if retry else "failed"
+
+        if time.monotonic() - last_budget_check >= cache_budget_interval:
+            enforce_cache_budget()
+            last_budget_check = time.monotonic()
+        if queue.finish(lease_path, state, unit):
+            if state == "done":
+                n_done += 1
+            elif state == "failed":
+                n_failed += 1
+
+    for empiar_files in files_by_accession.values():
+        empiar_files.close()
+    enforce_cache_budget()
+
+    return {"done": n_done, "failed": n_failed}
+
+
+def _region_model_class():
+    return list_item_model_class(cryoet_metadata._base._models.Dataset, "regions")
+
+
+def _iter_region_results(queue: WorkQueue, accession_id: str) -> Iterator[tuple[str, BaseModel]]:
+    # Results were validated by the worker that wrote them, so they are not
+    # validated again
+    region_model_class = _region_model_class()
+    for unit_path in sorted(queue.state_dir("done").glob(f"{accession_id}__*.json")):
+        with open(unit_path) as fh:
+            unit = json.load(fh)
+        with open(queue.results_dir(accession_id) / f"{unit['region_index']:05d}.json") as fh:
+            yield unit["region_title"], trusted_cets_model(json.load(fh), region_model_class)
+
+
+def reduce_accession(
+        queue: WorkQueue,
+        accession_id: str,
+        compact: bool = False,
+        compress: bool = False,
+        shard: bool = False,
+) -> Path:
+    """Assemble the Dataset of a fully converted accession and save it, one region at a time"""
+
+    counts = queue.counts(accession_id)
+    if counts["done"] == 0 or counts["done"] != sum(counts.values()):
+        raise RuntimeError(f"Regions of {accession_id} are not all converted: {counts}")
+
+    return write_cets_dataset(
+        accession_id,
+        cryoet_metadata._base._models.Dataset,
+        _iter_region_results(queue, accession_id),
+        compact=compact,
+        compress=compress,
+        shard=shard,
+    )
+
+
+def reduce_all(
+        queue: WorkQueue,
+        accession_ids: Optional[Iterable[str]] = None,
+        compact: bool = False,
+        compress: bool = False,
+        shard: bool = False,
+) -> dict[str, Optional[Path]]:
+    """Reduce every given (or every queued) accession that is complete"""
+
+    reduced = {}
+    for accession_id in accession_ids or queue.accession_ids():
+        try:
+            reduced[accession_id] = reduce_accession(queue, accession_id, compact, compress, shard)
+        except RuntimeError as e:
+            logger.warning(str(e))
+            reduced[accession_id] = None
+
+    return reduced
@@ -1,8 +1,10 @@
 import re
+from collections import Counter
 from pathlib import Path
+from string import Formatter
 from ruamel.yaml import YAML
-from typing import Optional, List
-from pydantic import BaseModel
+from typing import Iterable, Optional, List
+from pydantic import BaseModel, model_validator
 
 
 class MovieMetadata(BaseModel):
@@ -46,14 +48,121 @@ class RegionDirective(BaseModel):
     tomograms: Optional[List[Tomogram]] = None 
 
 
-def load_empiar_yaml_for_tomobabel(accession_id: str) -> dict:
+def template_field_names(template: str) -> list[str]:
+    """Names of the fields of a parse format or label template, in order, e.g. ["ts", "index"]"""
+    return list(dict.fromkeys(
+        field_name for _, field_name, _, _ in Formatter().parse(template) if field_name
+    ))
+
+
+def check_unique_titles(titles: Iterable[str], what: str = "region") -> None:
+    duplicates = sorted(title for title, count in Counter(titles).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"Duplicate {what} titles: {', '.join(duplicates)}")
+
+
+def fill_template(template: str, values: dict[str, str]) -> str:
+    """Substitute the text of values for the fields of a template, ignoring their format specs"""
+    return "".join(
+        literal_text + (values[field_name] if field_name else "")
+        for literal_text, field_name, _, _ in Formatter().parse(template)
+    )
+
+
+class MovieStackTemplate(MovieStack):
+    # Captures to order the movie stacks of a region by; by default, those
+    # of the file pattern that are not the region's, in pattern order
+    order_by: Optional[List[str]] = None
+
+
+class RegionTemplate(BaseModel):
+    """
+    A region directive that expands into one region per distinct value of
+    the named captures in its title, e.g. title "{ts}" with file patterns
+    such as "Control/metadata/{ts}.st".
+
+    Captures of a list's file pattern that are not in the title expand into
+    one item per matching file, e.g. a movie stack per tilt with
+    "Control/frames/{ts}_{index:d}_{angle:g}.tif". Labels may use any of
+    the captures of their file pattern and title.
+    """
+    title: str
+    movie_metadata: Optional[MovieMetadata] = None
+    movie_stacks: Optional[List[MovieStackTemplate]] = None
+    tilt_series_metadata: Optional[TiltSeriesMetadata] = None
+    tilt_series: Optional[List[TiltSeries]] = None
+    alignments: Optional[Alignment] = None
+    tomograms: Optional[List[Tomogram]] = None
+
+    @model_validator(mode="after")
+    def check_captures(self) -> "RegionTemplate":
+        region_names = set(template_field_names(self.title))
+        if not region_names:
+            raise ValueError(f"Region template title has no named captures: {self.title}")
+
+        # A capture must parse to the same type in every file pattern, or
+        # the regions could neither be grouped nor ordered by its values
+        capture_specs: dict[str, str] = {}
+
+        for field_name in RegionDirective.model_fields:
+            value = getattr(self, field_name)
+            if value is None or isinstance(value, str):
+                continue
+            for directive in value if isinstance(value, list) else [value]:
+                for _, name, format_spec, _ in Formatter().parse(directive.file_pattern):
+                    if name and capture_specs.setdefault(name, format_spec) != format_spec:
+                        raise ValueError(
+                            f"Capture {name} of region template {self.title} has format spec "
+                            f"{format_spec!r} in {directive.file_pattern} but {capture_specs[name]!r} elsewhere"
+                        )
+                pattern_names = set(template_field_names(directive.file_pattern))
+                if not isinstance(value, list) and not pattern_names <= region_names:
+                    raise ValueError(
+                        f"{field_name} file pattern {directive.file_pattern} may only capture {sorted(region_names)}"
+                    )
+                if not set(template_field_names(directive.label)) <= pattern_names | region_names:
+                    raise ValueError(f"{field_name} label {directive.label} uses captures its file pattern lacks")
+                if not set(getattr(directive, "order_by", None) or []) <= pattern_names:
+                    raise ValueError(f"{field_name} order_by {directive.order_by} names unknown captures")
+
+        return self
+
+
+def get_definition_file_path(
+        accession_id: str,
+        cets_implementation: str,
+        definitions_dirpath: Optional[Path] = None,
+) -> Path:
 
     if not re.match(r'^EMPIAR-\d+$', accession_id):
         raise ValueError(f"Invalid EMPIAR accession ID format: {accession_id}")
     
+    if definitions_dirpath is None:
+        definitions_dirpath = Path("definition_files") / cets_implementation
+
     numeric_id = accession_id.split('-')[1]
     yaml_filename = f"empiar_{numeric_id}.yaml"
-    yaml_fpath = Path("definition_files/tomobabel/")/yaml_filename
+    return Path(definitions_dirpath)/yaml_filename
+
+
+def accession_ids_from_definitions_dir(definitions_dirpath: Path) -> list[str]:
+    """Accession IDs of all empiar_<no>.yaml definition files in a directory"""
+
+    accession_ids = []
+    for yaml_fpath in sorted(Path(definitions_dirpath).glob("empiar_*.yaml")):
+        match = re.match(r'^empiar_(\d+)$', yaml_fpath.stem)
+        if match:
+            accession_ids.append(f"EMPIAR-{match.group(1)}")
+    
+    return accession_ids
+
+
+def load_empiar_yaml_for_tomobabel(
+        accession_id: str,
+        definitions_dirpath: Optional[Path] = None,
+) -> dict:
+
+    yaml_fpath = get_definition_file_path(accession_id, "tomobabel", definitions_dirpath)
     
     yaml = YAML()
     try:
@@ -66,14 +175,12 @@ def load_empiar_yaml_for_tomobabel(accession_id: str) -> dict:
         raise type(e)(f"Error parsing YAML file {yaml_fpath}: {str(e)}")
     
 
-def load_empiar_yaml_for_czii(accession_id: str) -> dict:
+def load_empiar_yaml_for_czii(
+        accession_id: str,
+        definitions_dirpath: Optional[Path] = None,
+) -> dict:
 
-    if not re.match(r'^EMPIAR-\d+$', accession_id):
-        raise ValueError(f"Invalid EMPIAR accession ID format: {accession_id}")
-    
-    numeric_id = accession_id.split('-')[1]
-    yaml_filename = f"empiar_{numeric_id}.yaml"
-    yaml_fpath = Path("definition_files/czii/")/yaml_filename
+    yaml_fpath = get_definition_file_path(accession_id, "czii", definitions_dirpath)
     
     yaml = YAML()
     try:
@@ -91,13 +198,24 @@ def parse_regions(
 ) -> list[RegionDirective]:
     
     regions = []
-    for region in directive_dict["regions"]:
+    for region in directive_dict.get("regions") or []:
         region_directive = RegionDirective.model_validate(region)
         regions.append(region_directive)
+    check_unique_titles(region.title for region in regions)
     
     return regions
 
 
+def parse_region_templates(
+        directive_dict: dict,
+) -> list[RegionTemplate]:
+    """The templated regions of a definition file, still to be expanded against the entry's files"""
+
+    templates = [RegionTemplate.model_validate(template) for template in directive_dict.get("region_templates") or []]
+    check_unique_titles((template.title for template in templates), "region template")
+    return templates
+
+
 
 # def get_assigned_images_and_context(
 #         study_uuid: str, 